@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.batch
+    ~~~~~~~~~~~~~~~~
+
+    This module contains the envelope that carries several requests
+    (or responses) inside one stego medium and the batcher that collects
+    the requests of the browser.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+import struct
+import threading
+
+log = logging.getLogger(__name__)
+# Marks a stego-message as a batch. A plain request always starts with
+# the request line so it can't be mistaken for a batch.
+BATCH_MAGIC = b"\x00STEGOBATCH\x00"
+# Takes the place of a response that is too large for a batch, the request
+# is sent again on its own then
+UNBATCHED = b"\x00STEGOUNBATCHED\x00"
+_LENGTH = struct.Struct("!I")
+
+
+def is_batch(data):
+    """Checks if an extracted stego-message is a batch."""
+    return data.startswith(BATCH_MAGIC)
+
+
+def is_unbatched(data):
+    """Checks if a response of a batch has to be requested on its own."""
+    return data == UNBATCHED
+
+
+def pack_batch(messages):
+    """Packs a list of messages into a batch."""
+    return BATCH_MAGIC + b"".join(_LENGTH.pack(len(m)) + m for m in messages)
+
+
+def batch_size(messages):
+    """Returns the size of the batch that contains the given messages."""
+    return len(BATCH_MAGIC) + sum(_LENGTH.size + len(m) for m in messages)
+
+
+def unpack_batch(data):
+    """Returns the list of messages that are packed into a batch."""
+    if not is_batch(data):
+        raise ValueError("Not a batch.")
+
+    messages = []
+    offset = len(BATCH_MAGIC)
+    while offset < len(data):
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        if offset + length > len(data):
+            raise ValueError("Truncated batch.")
+        messages.append(data[offset : offset + length])
+        offset += length
+    return messages
+
+
+class _Entry(object):
+    def __init__(self, message):
+        self.message = message
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Batch(object):
+    def __init__(self):
+        self.entries = []
+        self.full = threading.Event()
+
+
+class RequestBatcher(object):
+    """Collects the requests that arrive within a short window and sends
+    them together.
+
+    The first request of a batch waits for ``window`` seconds (or until
+    the batch is full) and then sends the whole batch on behalf of all
+    the requests in it; the others wait for their response. A request
+    that no other request has joined isn't batched.
+
+    :param window: The number of seconds to wait for further requests.
+    :param max_size: The maximum size of a packed batch in bytes.
+    :param max_requests: The maximum number of requests in a batch.
+    """
+
+    def __init__(self, window, max_size, max_requests=16):
+        self.window = window
+        self.max_size = max_size
+        self.max_requests = max_requests
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def _close(self, batch):
+        # must be called with the lock held
+        if self._batch is batch:
+            self._batch = None
+        batch.full.set()
+
+    def submit(self, message, send):
+        """Adds a message to the current batch and returns its response.
+
+        :param message: The request to send.
+        :param send: A callable that takes a list of messages and returns
+                     the list of their responses. It is called by the
+                     first request of a batch.
+        :return: The response, or ``None`` if the message is the only one
+                 in its batch and has to be sent on its own.
+        """
+        entry = _Entry(message)
+        with self._lock:
+            batch = self._batch
+            if batch is not None:
+                messages = [e.message for e in batch.entries] + [message]
+                if batch_size(messages) > self.max_size:
+                    # Send the current batch right away and start a new one
+                    self._close(batch)
+                    batch = None
+
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.entries.append(entry)
+            if len(batch.entries) >= self.max_requests:
+                self._close(batch)
+
+        if not leader:
+            entry.done.wait()
+            if entry.error is not None:
+                raise entry.error
+            return entry.response
+
+        batch.full.wait(self.window)
+        with self._lock:
+            self._close(batch)
+
+        entries = batch.entries
+        if len(entries) == 1:
+            return None
+        log.debug(f"Sending a batch of {len(entries)} requests")
+        try:
+            responses = send([e.message for e in entries])
+            if len(responses) != len(entries):
+                raise ValueError(
+                    f"Got {len(responses)} responses "
+                    f"for {len(entries)} requests."
+                )
+            for e, response in zip(entries, responses):
+                e.response = response
+        except Exception as e:
+            for other in entries:
+                other.error = e
+        finally:
+            for other in entries:
+                other.done.set()
+
+        if entry.error is not None:
+            raise entry.error
+        return entry.response
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.cache
+    ~~~~~~~~~~~~~~~~
+
+    This module contains an HTTP cache (RFC 7234) for the responses that
+    went through the stego channel. It keeps the responses in memory and,
+    optionally, on disk.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from http.client import parse_headers
+
+log = logging.getLogger(__name__)
+# Responses with these status codes may be cached without explicit
+# freshness information (RFC 7231, section 6.1)
+HEURISTIC_STATUSES = (200, 203, 204, 300, 301, 404, 405, 410, 414, 501)
+# Headers of a 304 response that must not replace the stored ones
+_NOT_UPDATED = ("content-length", "content-encoding", "transfer-encoding")
+
+
+def parse_cache_control(value):
+    """Parses a Cache-Control header into a dict. Directives without an
+    argument are mapped to ``None``.
+    """
+    directives = {}
+    for directive in (value or "").split(","):
+        name, _, arg = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') or None
+    return directives
+
+
+def _seconds(directives, name):
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _http_date(value):
+    """Returns a timestamp from an HTTP date or ``None``."""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _header_values(headers, name):
+    values = []
+    for value in headers.get_all(name) or []:
+        values.extend(v.strip() for v in value.split(",") if v.strip())
+    return values
+
+
+def _normalize(value):
+    return " ".join((value or "").split())
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+class CacheEntry(object):
+    """A response that is kept in the cache.
+
+    :param url: The URL of the request.
+    :param status: The status code of the response.
+    :param reason: The reason phrase of the response.
+    :param headers: The headers of the response as HTTPMessage object.
+    :param body: The body of the response.
+    :param vary: The values of the request headers the response varies on.
+    :param request_time: When the request has been sent.
+    :param response_time: When the response has been received.
+    """
+
+    def __init__(
+        self,
+        url,
+        status,
+        reason,
+        headers,
+        body,
+        vary,
+        request_time,
+        response_time,
+    ):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.vary = vary
+        self.request_time = request_time
+        self.response_time = response_time
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.headers.as_bytes())
+
+    @property
+    def etag(self):
+        return self.headers.get("ETag")
+
+    @property
+    def last_modified(self):
+        return self.headers.get("Last-Modified")
+
+    @property
+    def cache_control(self):
+        return parse_cache_control(
+            ", ".join(self.headers.get_all("Cache-Control") or [])
+        )
+
+    def matches(self, request_headers):
+        """Checks if the entry can be used for a request with the given
+        headers (the Vary header of the response).
+        """
+        return all(
+            _normalize(request_headers.get(name)) == value
+            for name, value in self.vary.items()
+        )
+
+    def age(self, now):
+        """Returns the current age of the response in seconds."""
+        date = _http_date(self.headers.get("Date")) or self.response_time
+        apparent_age = max(0, self.response_time - date)
+        try:
+            age = max(0, int(self.headers.get("Age", 0)))
+        except ValueError:
+            age = 0
+        corrected_age = age + (self.response_time - self.request_time)
+        return max(apparent_age, corrected_age) + (now - self.response_time)
+
+    def lifetime(self, shared, heuristic_max):
+        """Returns the number of seconds the response is fresh."""
+        cc = self.cache_control
+        if shared and _seconds(cc, "s-maxage") is not None:
+            return _seconds(cc, "s-maxage")
+        if _seconds(cc, "max-age") is not None:
+            return _seconds(cc, "max-age")
+
+        date = _http_date(self.headers.get("Date")) or self.response_time
+        if "Expires" in self.headers:
+            # An invalid date means "already expired"
+            expires = _http_date(self.headers["Expires"])
+            return max(0, expires - date) if expires is not None else 0
+
+        # Heuristic freshness: 10% of the time since the last modification
+        last_modified = _http_date(self.last_modified)
+        if last_modified is not None and self.status in HEURISTIC_STATUSES:
+            return min(heuristic_max, max(0, date - last_modified) / 10)
+        return 0
+
+    def is_fresh(self, request_cc, shared, heuristic_max, now):
+        """Checks if the response may be used without revalidation."""
+        if "no-cache" in request_cc or "no-cache" in self.cache_control:
+            return False
+
+        age = self.age(now)
+        lifetime = self.lifetime(shared, heuristic_max)
+        max_age = _seconds(request_cc, "max-age")
+        if max_age is not None and age > max_age:
+            return False
+        min_fresh = _seconds(request_cc, "min-fresh") or 0
+        return lifetime - age > min_fresh
+
+    def not_modified(self, request_headers):
+        """Checks if the conditional headers of a request match this
+        response, i.e. if it can be answered with 304 Not Modified.
+        """
+        if_none_match = _header_values(request_headers, "If-None-Match")
+        if if_none_match:
+            if self.etag is None:
+                return False
+            etag = _strip_weak(self.etag)
+            return any(
+                tag == "*" or _strip_weak(tag) == etag
+                for tag in if_none_match
+            )
+
+        since = _http_date(request_headers.get("If-Modified-Since"))
+        modified = _http_date(self.last_modified)
+        return since is not None and modified is not None and modified <= since
+
+    def dumps(self):
+        """Serializes the entry for the disk tier."""
+        meta = {
+            "url": self.url,
+            "status": self.status,
+            "reason": self.reason,
+            "headers": self.headers.as_bytes().decode("latin-1"),
+            "vary": self.vary,
+            "request_time": self.request_time,
+            "response_time": self.response_time,
+        }
+        return json.dumps(meta).encode("utf-8") + b"\n" + self.body
+
+    @classmethod
+    def loads(cls, data):
+        meta, _, body = data.partition(b"\n")
+        meta = json.loads(meta.decode("utf-8"))
+        headers = parse_headers(io.BytesIO(meta["headers"].encode("latin-1")))
+        return cls(
+            meta["url"],
+            meta["status"],
+            meta["reason"],
+            headers,
+            body,
+            meta["vary"],
+            meta["request_time"],
+            meta["response_time"],
+        )
+
+
+class DiskStore(object):
+    """The disk tier of the cache. It keeps one response per URL.
+
+    :param directory: The directory the responses are stored in.
+    :param max_size: The maximum number of bytes on disk.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # file name -> size, least recent first
+        os.makedirs(directory, exist_ok=True)
+
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith(".cache"):
+                st = os.stat(os.path.join(directory, name))
+                files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._files[name] = size
+            self.size += size
+
+    def _name(self, url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest() + ".cache"
+
+    def _remove(self, name):
+        # must be called with the lock held
+        self.size -= self._files.pop(name)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def get(self, url):
+        name = self._name(url)
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                return CacheEntry.loads(f.read())
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f"Couldn't read cached response for {url}: {e}")
+            self.delete(url)
+            return None
+
+    def put(self, entry):
+        data = entry.dumps()
+        if len(data) > self.max_size:
+            return
+        name = self._name(entry.url)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, os.path.join(self.directory, name))
+        except OSError as e:
+            log.warning(f"Couldn't write cached response to disk: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self.size -= self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                self._remove(next(iter(self._files)))
+
+    def delete(self, url):
+        with self._lock:
+            name = self._name(url)
+            if name in self._files:
+                self._remove(name)
+
+
+class CachingReader(object):
+    """Wraps the body of a response and calls ``on_complete`` with the
+    whole body once it has been read to the end. Bodies larger than
+    ``max_size`` are passed through without being kept.
+    """
+
+    def __init__(self, fp, max_size, on_complete):
+        self.fp = fp
+        self.max_size = max_size
+        self.on_complete = on_complete
+        self._body = bytearray()
+
+    def read(self, amt=None):
+        data = self.fp.read() if amt is None else self.fp.read(amt)
+        return self._keep(data, complete=amt is None)
+
+    def read1(self, amt=-1):
+        return self._keep(self.fp.read1(amt))
+
+    def _keep(self, data, complete=False):
+        if self._body is not None:
+            self._body += data
+            if len(self._body) > self.max_size:
+                self._body = None
+            elif complete or not data:
+                body, self._body = bytes(self._body), None
+                self.on_complete(body)
+        return data
+
+
+class HTTPCache(object):
+    """A size-bounded LRU cache of HTTP responses.
+
+    :param max_size: The maximum number of bytes kept in memory.
+    :param max_entry_size: Larger responses are not cached.
+    :param shared: ``True`` for a cache that is shared between users. It
+                   doesn't store ``private`` responses and prefers
+                   ``s-maxage``.
+    :param directory: The directory of the disk tier. ``None`` keeps the
+                      responses in memory only.
+    :param disk_max_size: The maximum number of bytes kept on disk.
+    :param heuristic_max: The maximum number of seconds a response without
+                          explicit freshness information is fresh.
+    """
+
+    def __init__(
+        self,
+        max_size=64 * 1024 * 1024,
+        max_entry_size=8 * 1024 * 1024,
+        shared=False,
+        directory=None,
+        disk_max_size=512 * 1024 * 1024,
+        heuristic_max=86400,
+    ):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.shared = shared
+        self.heuristic_max = heuristic_max
+        self.disk = None
+        if directory is not None:
+            self.disk = DiskStore(directory, disk_max_size)
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # url -> [entry, ...]
+        self._stats = dict(
+            requests=0,
+            hits=0,
+            revalidations=0,
+            misses=0,
+            bytes_saved=0,
+            stores=0,
+            evictions=0,
+        )
+
+    def _add(self, entry):
+        # must be called with the lock held
+        variants = self._entries.setdefault(entry.url, [])
+        for other in [e for e in variants if e.vary == entry.vary]:
+            variants.remove(other)
+            self.size -= other.size
+        variants.append(entry)
+        self._entries.move_to_end(entry.url)
+        self.size += entry.size
+
+        while self.size > self.max_size:
+            url, variants = self._entries.popitem(last=False)
+            self.size -= sum(e.size for e in variants)
+            self._stats["evictions"] += len(variants)
+
+    def lookup(self, method, url, headers):
+        """Returns the cached response for a request and whether it may be
+        used without revalidation, or ``(None, False)``.
+        """
+        request_cc = parse_cache_control(headers.get("Cache-Control"))
+        if "no-cache" in (headers.get("Pragma") or "").lower():
+            request_cc.setdefault("no-cache", None)
+        if method not in ("GET", "HEAD") or "no-store" in request_cc:
+            return None, False
+
+        with self._lock:
+            self._stats["requests"] += 1
+            variants = self._entries.get(url)
+            entry = None
+            if variants:
+                self._entries.move_to_end(url)
+                entry = next(
+                    (e for e in reversed(variants) if e.matches(headers)),
+                    None,
+                )
+
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(url)
+            if entry is not None and entry.matches(headers):
+                with self._lock:
+                    self._add(entry)
+            else:
+                entry = None
+
+        if entry is None:
+            return None, False
+        fresh = entry.is_fresh(
+            request_cc, self.shared, self.heuristic_max, time.time()
+        )
+        return entry, fresh
+
+    def is_storable(self, method, status, request_headers, headers):
+        """Checks if a response may be stored (RFC 7234, section 3)."""
+        if method != "GET":
+            return False
+        request_cc = parse_cache_control(request_headers.get("Cache-Control"))
+        cc = parse_cache_control(
+            ", ".join(headers.get_all("Cache-Control") or [])
+        )
+        if "no-store" in request_cc or "no-store" in cc:
+            return False
+        if "*" in _header_values(headers, "Vary"):
+            return False
+        if self.shared:
+            if "private" in cc or "Set-Cookie" in headers:
+                return False
+            if "Authorization" in request_headers and not (
+                "public" in cc or "s-maxage" in cc or "must-revalidate" in cc
+            ):
+                return False
+
+        explicit = (
+            "max-age" in cc
+            or "Expires" in headers
+            or (self.shared and "s-maxage" in cc)
+            or "public" in cc
+        )
+        if explicit:
+            return True
+        # Without explicit freshness information the response is only
+        # worth storing if it can be revalidated
+        return status in HEURISTIC_STATUSES and (
+            "ETag" in headers or "Last-Modified" in headers
+        )
+
+    def store(
+        self,
+        method,
+        url,
+        request_headers,
+        status,
+        reason,
+        headers,
+        body,
+        request_time,
+        response_time=None,
+    ):
+        """Stores a response if it is storable. Returns the new entry or
+        ``None``.
+        """
+        if len(body) > self.max_entry_size:
+            return None
+        if not self.is_storable(method, status, request_headers, headers):
+            return None
+
+        vary = {
+            name.lower(): _normalize(request_headers.get(name))
+            for name in _header_values(headers, "Vary")
+        }
+        entry = CacheEntry(
+            url,
+            status,
+            reason,
+            headers,
+            body,
+            vary,
+            request_time,
+            response_time or time.time(),
+        )
+        with self._lock:
+            self._add(entry)
+            self._stats["stores"] += 1
+        if self.disk is not None:
+            self.disk.put(entry)
+        log.debug(f"Cached {url} ({len(body)} bytes)")
+        return entry
+
+    def freshen(self, entry, headers, request_time, response_time=None):
+        """Updates a cached response with the headers of a 304 response
+        (RFC 7234, section 4.3.4).
+        """
+        # Entries are read by other threads - update a copy of the headers
+        updated = parse_headers(io.BytesIO(entry.headers.as_bytes()))
+        for name in dict.fromkeys(headers.keys()):
+            if name.lower() in _NOT_UPDATED or name not in headers:
+                continue
+            del updated[name]
+            for value in headers.get_all(name):
+                updated[name] = value
+        with self._lock:
+            entry.headers = updated
+            entry.request_time = request_time
+            entry.response_time = response_time or time.time()
+        if self.disk is not None:
+            self.disk.put(entry)
+
+    def conditional_headers(self, entry):
+        """Returns the headers that revalidate a cached response."""
+        headers = {}
+        if entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def invalidate(self, url):
+        """Removes all responses for a URL, e.g. after a POST to it."""
+        with self._lock:
+            variants = self._entries.pop(url, [])
+            self.size -= sum(e.size for e in variants)
+        if self.disk is not None:
+            self.disk.delete(url)
+
+    def record_hit(self, entry, revalidated=False):
+        """Counts a request that has been answered from the cache."""
+        with self._lock:
+            self._stats["revalidations" if revalidated else "hits"] += 1
+            self._stats["bytes_saved"] += len(entry.body)
+
+    def record_miss(self):
+        """Counts a request that had to be forwarded."""
+        with self._lock:
+            self._stats["misses"] += 1
+
+    def stats(self):
+        """Returns the hit ratio, the number of bytes saved and other
+        counters of the cache.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = sum(len(v) for v in self._entries.values())
+            stats["size"] = self.size
+        answered = stats["hits"] + stats["revalidations"]
+        total = answered + stats["misses"]
+        stats["hit_ratio"] = answered / total if total else 0.0
+        if self.disk is not None:
+            stats["disk_size"] = self.disk.size
+        return stats
@@ -17,7 +17,7 @@ import click
 
 from stegoproxy.config import cfg
 from stegoproxy.demoapp import app
-from stegoproxy.httpserver import run_server
+from stegoproxy.httpserver import LISTEN_QUEUE, run_server
 from stegoproxy.stegoclient import ClientProxyHandler
 from stegoproxy.stegoserver import ServerProxyHandler
 
@@ -65,19 +65,127 @@ def main(args=None):
 @click.option(
     "--no-threading", is_flag=True, default=True, help="Disable multithreading"
 )
+@click.option(
+    "--pool-size",
+    default=0,
+    show_default=True,
+    help="Number of worker threads. 0 starts a new thread per request",
+)
+@click.option(
+    "--pool-queue",
+    default=LISTEN_QUEUE,
+    show_default=True,
+    help="Number of connections that may wait for a free worker thread",
+)
+@click.option(
+    "--workers",
+    "-w",
+    default=1,
+    show_default=True,
+    help="Number of worker processes. 0 starts one per CPU",
+)
+@click.option(
+    "--reuse-port",
+    is_flag=True,
+    default=False,
+    help="Let every worker process bind its own socket with SO_REUSEPORT",
+)
+@click.option(
+    "--prewarm",
+    default=0,
+    show_default=True,
+    help="Number of connections to the stegoserver to open in advance",
+)
+@click.option(
+    "--tunnel",
+    is_flag=True,
+    default=False,
+    help="Multiplex the requests over persistent tunnels to the stegoserver",
+)
+@click.option(
+    "--batch-window",
+    default=0.0,
+    show_default=True,
+    help="Seconds to wait for further small requests to embed them "
+    "together. 0 disables batching",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    default=False,
+    help="Don't cache the responses of the websites",
+)
+@click.option(
+    "--prefetch",
+    is_flag=True,
+    default=False,
+    help="Let the stegoserver send the subresources of pages along",
+)
+@click.option(
+    "--no-delta",
+    is_flag=True,
+    default=False,
+    help="Always get the whole responses instead of deltas",
+)
+@click.option(
+    "--no-compression",
+    is_flag=True,
+    default=False,
+    help="Don't ask the websites for compressed responses",
+)
+@click.option(
+    "--no-resume",
+    is_flag=True,
+    default=False,
+    help="Don't resume responses if the stegoserver connection breaks",
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    help="Keep the cached responses on disk in this directory as well",
+)
 @click.option(
     "--log-level",
     default="INFO",
     show_default=True,
     help="DEBUG, INFO, WARNING or ERROR",
 )
-def client(host, remote, algorithm, no_reloader, no_threading, log_level):
+def client(
+    host,
+    remote,
+    algorithm,
+    no_reloader,
+    no_threading,
+    pool_size,
+    pool_queue,
+    workers,
+    reuse_port,
+    prewarm,
+    tunnel,
+    batch_window,
+    no_cache,
+    prefetch,
+    no_delta,
+    no_compression,
+    no_resume,
+    cache_dir,
+    log_level,
+):
     """Runs the client side proxy."""
     log.setLevel(LOG_LEVELS.get(log_level, "INFO"))
     host, port = host.split(":")
     remote_ip, remote_port = remote.split(":")
 
     cfg.REMOTE_ADDR = (remote_ip, int(remote_port))
+    cfg.POOL_PREWARM = prewarm
+    cfg.TUNNEL = tunnel
+    cfg.BATCH_WINDOW = batch_window
+    cfg.CACHE_ENABLED = not no_cache
+    cfg.CACHE_DIR = cache_dir
+    cfg.PREFETCH = prefetch
+    cfg.DELTA = not no_delta
+    cfg.COMPRESSION = not no_compression
+    cfg.RESUME = not no_resume
     cfg.ALGORITHM = algorithm.lower()
     cfg.STEGO_ALGORITHM = cfg.AVAILABLE_STEGOS[cfg.ALGORITHM]
 
@@ -87,6 +195,10 @@ def client(host, remote, algorithm, no_reloader, no_threading, log_level):
         request_handler=ClientProxyHandler,
         use_reloader=no_reloader,
         threaded=no_threading,
+        pool_size=pool_size,
+        pool_queue_size=pool_queue,
+        workers=workers or os.cpu_count(),
+        reuse_port=reuse_port,
         what="client",
         algorithm=cfg.ALGORITHM
     )
@@ -114,27 +226,129 @@ def client(host, remote, algorithm, no_reloader, no_threading, log_level):
 @click.option(
     "--no-threading", is_flag=True, default=True, help="Disable multithreading"
 )
+@click.option(
+    "--pool-size",
+    default=0,
+    show_default=True,
+    help="Number of worker threads. 0 starts a new thread per request",
+)
+@click.option(
+    "--pool-queue",
+    default=LISTEN_QUEUE,
+    show_default=True,
+    help="Number of connections that may wait for a free worker thread",
+)
+@click.option(
+    "--workers",
+    "-w",
+    default=1,
+    show_default=True,
+    help="Number of worker processes. 0 starts one per CPU",
+)
+@click.option(
+    "--reuse-port",
+    is_flag=True,
+    default=False,
+    help="Let every worker process bind its own socket with SO_REUSEPORT",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    default=False,
+    help="Don't cache the responses of the websites",
+)
+@click.option(
+    "--prefetch",
+    is_flag=True,
+    default=False,
+    help="Send the subresources of pages along with them",
+)
+@click.option(
+    "--no-delta",
+    is_flag=True,
+    default=False,
+    help="Always send the whole responses instead of deltas",
+)
+@click.option(
+    "--no-compression",
+    is_flag=True,
+    default=False,
+    help="Don't compress the responses before embedding them",
+)
+@click.option(
+    "--transcode",
+    is_flag=True,
+    default=False,
+    help="Re-encode images to smaller variants before embedding them",
+)
+@click.option(
+    "--minify",
+    is_flag=True,
+    default=False,
+    help="Remove whitespace and comments from HTML, CSS, JS and JSON",
+)
+@click.option(
+    "--no-resume",
+    is_flag=True,
+    default=False,
+    help="Don't keep embedded chunks to resume broken responses",
+)
 @click.option(
     "--log-level",
     default="INFO",
     show_default=True,
     help="DEBUG, INFO, WARNING or ERROR",
 )
-def server(host, algorithm, no_reloader, no_threading, log_level):
+def server(
+    host,
+    algorithm,
+    no_reloader,
+    no_threading,
+    pool_size,
+    pool_queue,
+    workers,
+    reuse_port,
+    no_cache,
+    prefetch,
+    no_delta,
+    no_compression,
+    transcode,
+    minify,
+    no_resume,
+    log_level,
+):
     """Runs the server side proxy."""
     log.setLevel(LOG_LEVELS.get(log_level, "INFO"))
     host, port = host.split(":")
 
     cfg.REMOTE_ADDR = (host, int(port))
+    cfg.UPSTREAM_CACHE_ENABLED = not no_cache
+    cfg.PREFETCH = prefetch
+    cfg.DELTA = not no_delta
+    cfg.COMPRESSION = not no_compression
+    cfg.TRANSCODE = transcode
+    cfg.MINIFY = minify
+    cfg.RESUME = not no_resume
     cfg.ALGORITHM = algorithm.lower()
     cfg.STEGO_ALGORITHM = cfg.AVAILABLE_STEGOS[cfg.ALGORITHM]
 
+    workers = workers or os.cpu_count()
+    if cfg.RESUME and workers > 1:
+        # Every worker process keeps its own transfers, a resume request
+        # would hardly ever reach the one that has got the transfer
+        log.warning("Transfers can't be resumed with several workers")
+        cfg.RESUME = False
+
     run_server(
         hostname=host,
         port=int(port),
         request_handler=ServerProxyHandler,
         use_reloader=no_reloader,
         threaded=no_threading,
+        pool_size=pool_size,
+        pool_queue_size=pool_queue,
+        workers=workers,
+        reuse_port=reuse_port,
         what="server",
         algorithm=cfg.ALGORITHM
     )
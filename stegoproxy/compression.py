@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.compression
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the compression policy of the stego channel.
+    Every byte of a response has to be embedded, so text that arrives
+    uncompressed is compressed before it is embedded, while images, video
+    and archives that are compressed already are left alone.
+
+    The stegoserver marks a response it has compressed itself with the
+    X-Stego-Encoding header. The stegoclient decompresses it again before
+    the response is relayed to the browser, like a transfer coding that
+    only applies to the stego channel.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+# Marks a response whose body has been compressed for the stego channel
+STEGO_ENCODING_HEADER = "X-Stego-Encoding"
+# The content codings that can be decoded again
+DECODABLE_CODINGS = ("gzip", "x-gzip", "deflate")
+# Media types that aren't text, but compress well nevertheless
+_COMPRESSIBLE_TYPES = (
+    "application/ecmascript",
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "application/vnd.ms-fontobject",
+    "application/wasm",
+    "application/x-javascript",
+    "application/x-www-form-urlencoded",
+    "application/xml",
+    "font/otf",
+    "font/ttf",
+    "image/bmp",
+    "image/svg+xml",
+    "image/x-icon",
+)
+
+
+def is_compressible(content_type):
+    """Checks if a body of the given media type is worth compressing.
+    Types that are compressed already (images, video, audio, archives,
+    WOFF fonts) and unknown types aren't.
+    """
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return (
+        content_type.startswith("text/")
+        or content_type.endswith(("+json", "+xml"))
+        or content_type in _COMPRESSIBLE_TYPES
+    )
+
+
+def accepts_encoding(accept_encoding, coding):
+    """Checks if an Accept-Encoding header allows a content coding.
+    Without the header, only the identity coding is acceptable.
+    """
+    coding = coding.lower()
+    if coding == "x-gzip":
+        coding = "gzip"
+    qvalues = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        qvalue = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues["gzip" if name == "x-gzip" else name] = qvalue
+
+    if coding in qvalues:
+        return qvalues[coding] > 0
+    if coding == "identity":
+        return qvalues.get("*", 1.0) > 0
+    return qvalues.get("*", 0.0) > 0
+
+
+def widen_accept_encoding(accept_encoding):
+    """Returns an Accept-Encoding header that asks for the decodable
+    codings in addition to the ones that are accepted already.
+    """
+    codings = [
+        item.strip()
+        for item in (accept_encoding or "").split(",")
+        if item.strip()
+    ]
+    names = [item.split(";")[0].strip().lower() for item in codings]
+    for coding in ("gzip", "deflate"):
+        if coding not in names:
+            codings.append(coding)
+    return ", ".join(codings)
+
+
+def parse_stego_encoding(value):
+    """Returns the coding and the original length (or ``None``) from an
+    X-Stego-Encoding header.
+    """
+    coding, _, params = value.partition(";")
+    length = None
+    for param in params.split(";"):
+        key, _, arg = param.partition("=")
+        if key.strip().lower() == "length" and arg.strip().isdigit():
+            length = int(arg)
+    return coding.strip().lower(), length
+
+
+def compress(body, level):
+    """Compresses a body in the deflate coding."""
+    return zlib.compress(body, level)
+
+
+class Decoder(object):
+    """Decodes a body in the gzip or deflate coding while it is arriving.
+
+    :raises ValueError: If the body is invalid.
+    """
+
+    def __init__(self, coding):
+        self._buffer = b""
+        self._decompressor = None
+        if coding.lower() in ("gzip", "x-gzip"):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data, max_length=0):
+        if self._decompressor is None:
+            # Some websites send raw deflate data instead of zlib data
+            self._buffer += data
+            if len(self._buffer) < 2:
+                return b""
+            data, self._buffer = self._buffer, b""
+            zlib_header = data[0] & 0x0F == 8 and (
+                (data[0] << 8) + data[1]
+            ) % 31 == 0
+            wbits = zlib.MAX_WBITS if zlib_header else -zlib.MAX_WBITS
+            self._decompressor = zlib.decompressobj(wbits)
+        try:
+            return self._decompressor.decompress(data, max_length)
+        except zlib.error as e:
+            raise ValueError(f"Invalid compressed body: {e}")
+
+    def flush(self):
+        if self._decompressor is None:
+            if self._buffer:
+                raise ValueError("Truncated compressed body.")
+            return b""
+        try:
+            return self._decompressor.flush()
+        except zlib.error as e:
+            raise ValueError(f"Invalid compressed body: {e}")
+
+
+def decode(body, coding, max_size=None):
+    """Decodes a whole body in the gzip or deflate coding.
+
+    :raises ValueError: If the body is invalid or decodes to more than
+                        ``max_size`` bytes.
+    """
+    decoder = Decoder(coding)
+    limit = max_size + 1 if max_size is not None else 0
+    data = decoder.decompress(body, limit) + decoder.flush()
+    if max_size is not None and len(data) > max_size:
+        raise ValueError("The decompressed body is too large.")
+    return data
+
+
+def iter_decoded(pieces, coding):
+    """Decodes the pieces of a body in the gzip or deflate coding."""
+    decoder = Decoder(coding)
+    for piece in pieces:
+        data = decoder.decompress(piece)
+        if data:
+            yield data
+    data = decoder.flush()
+    if data:
+        yield data
+
+
+class CompressingReader(object):
+    """Wraps the reader of a body and compresses the body while it is
+    read. Every read is flushed so that a body that arrives slowly is
+    relayed without delay.
+
+    :param on_complete: Called with the size of the body and its
+                        compressed size once the body has been read.
+    """
+
+    def __init__(self, fp, level, on_complete=None):
+        self._fp = fp
+        self._compressor = zlib.compressobj(level)
+        self._buffer = bytearray()
+        self._eof = False
+        self._on_complete = on_complete
+        self.size = 0
+        self.compressed_size = 0
+
+    def read(self, amt=None):
+        while not self._eof and (amt is None or not self._buffer):
+            self._compress(self._fp.read(amt))
+        return self._take(amt)
+
+    def read1(self, amt=-1):
+        if not self._eof and not self._buffer:
+            self._compress(self._fp.read1(amt))
+        return self._take(amt if amt >= 0 else None)
+
+    def _compress(self, data):
+        if data:
+            self.size += len(data)
+            self._buffer += self._compressor.compress(data)
+            self._buffer += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            self._buffer += self._compressor.flush()
+            self._eof = True
+
+    def _take(self, amt):
+        if amt is None:
+            amt = len(self._buffer)
+        data = bytes(self._buffer[:amt])
+        del self._buffer[:amt]
+        self.compressed_size += len(data)
+        if self._eof and not self._buffer and self._on_complete is not None:
+            self._on_complete(self.size, self.compressed_size)
+            self._on_complete = None
+        return data
+
+
+class CompressionStats(object):
+    """Counts the decisions of the compression policy along with the
+    number of bytes before and after it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._decisions = {}
+
+    def record(self, decision, size, sent_size):
+        with self._lock:
+            counts = self._decisions.setdefault(
+                decision, dict(responses=0, size=0, sent_size=0)
+            )
+            counts["responses"] += 1
+            counts["size"] += size
+            counts["sent_size"] += sent_size
+
+    def stats(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._decisions.items()}
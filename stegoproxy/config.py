@@ -54,6 +54,147 @@ class Config(object):
     STEGO_HTTP_VERSION = "HTTP/1.1"
     # Used to hide the stegoserver behind a real website
     REVERSE_HOSTNAME = "peterjustin.me"
+    # Seconds the stegoserver keeps an idle connection from a stegoclient
+    KEEP_ALIVE_TIMEOUT = 15
+    # Persistent connections from the stegoclient to the stegoserver
+    POOL_MAXSIZE = 10  # Connections per host
+    POOL_IDLE_TIMEOUT = 10  # Keep it below KEEP_ALIVE_TIMEOUT
+    POOL_BLOCK_TIMEOUT = 30  # Seconds to wait for a free connection
+    POOL_PREWARM = 0  # Connections to open in advance
+    # Relay responses in the plain proxy path while they are still arriving
+    # instead of reading them completely first
+    STREAM_RESPONSES = True
+    STREAM_BUFFER_SIZE = 65536
+    # Bytes of a streamed request body that are kept for the debug log
+    LOG_BODY_SIZE = 1024
+    # Number of slices of a response from a website that are buffered while
+    # the stegoserver is embedding the previous ones
+    PIPELINE_DEPTH = 4
+    # Chunks of a stego-response start small so that the header of the
+    # response reaches the browser quickly and then grow towards the
+    # capacity of the cover: "none", "linear" or "exponential"
+    CHUNK_RAMP = "exponential"
+    CHUNK_RAMP_START = 8192  # Size of the first chunk in bytes
+    CHUNK_RAMP_FACTOR = 2
+    # Small GET and HEAD requests of the browser that arrive within
+    # BATCH_WINDOW seconds are embedded together in one stego medium. A
+    # batch buffers the whole responses, so it is disabled (0) by default.
+    BATCH_WINDOW = 0
+    BATCH_MAX_REQUESTS = 16
+    BATCH_MAX_SIZE = 8192  # Larger requests are sent on their own
+    # Only responses of a known length up to this size are sent in a
+    # batch, the others are streamed on their own
+    BATCH_MAX_RESPONSE_SIZE = 65536
+    # Multiplex the requests over a few persistent tunnels to the
+    # stegoserver instead of sending a stego-request per request
+    TUNNEL = False
+    TUNNEL_CONNECTIONS = 2  # Tunnels to open at most
+    TUNNEL_WINDOW = 262144  # Bytes in flight per stream
+    TUNNEL_MAX_FRAME = 16384  # Bytes per frame
+    TUNNEL_IDLE_TIMEOUT = 60  # Seconds until a tunnel without streams closes
+    # Seconds to collect further frames (e.g. TLS records of a CONNECT
+    # tunnel) before a stego medium that isn't full is embedded
+    TUNNEL_FLUSH_DELAY = 0.005
+    # Bytes of the table that compresses the heads of the HTTP messages
+    # sent over a tunnel. Repeated headers are sent as references to it.
+    TUNNEL_HEADER_TABLE_SIZE = 4096
+    # HTTP cache of the stegoclient. Responses are kept in memory and, if
+    # CACHE_DIR is set, on disk.
+    CACHE_ENABLED = True
+    CACHE_MAX_SIZE = 64 * 1024 * 1024  # Bytes in memory
+    CACHE_MAX_ENTRY_SIZE = 8 * 1024 * 1024  # Larger responses aren't cached
+    CACHE_DIR = None
+    CACHE_DISK_MAX_SIZE = 512 * 1024 * 1024  # Bytes on disk
+    # Maximum seconds a response without explicit freshness information
+    # is considered fresh
+    CACHE_HEURISTIC_MAX = 86400
+    # Collapse identical GET and HEAD requests that are in flight at the
+    # same time into one. Larger responses aren't shared, the waiting
+    # requests are sent on their own then.
+    SINGLEFLIGHT = True
+    SINGLEFLIGHT_MAX_SIZE = 8 * 1024 * 1024
+    # Send the same-origin stylesheets, scripts and images of an HTML page
+    # along with it. The stegoserver prefetches them, the stegoclient
+    # keeps them in its cache until the browser asks for them.
+    PREFETCH = False
+    PREFETCH_MAX_RESOURCES = 16  # Subresources per page
+    PREFETCH_MAX_RESOURCE_SIZE = 1024 * 1024  # Larger ones aren't sent
+    PREFETCH_MAX_HTML_SIZE = 1024 * 1024  # Larger pages aren't bundled
+    PREFETCH_CONCURRENCY = 6  # Subresources fetched at the same time
+    # Seconds to wait for the subresources of a page (stegoserver) or for
+    # a subresource that is still on its way (stegoclient)
+    PREFETCH_TIMEOUT = 10
+    # Send the differences to the last version of a response the
+    # stegoclient has got instead of the whole response, if they are
+    # smaller. Both sides keep the last version of every URL in memory.
+    DELTA = True
+    DELTA_STORE_MAX_SIZE = 32 * 1024 * 1024  # Bytes of kept versions
+    DELTA_MAX_SIZE = 1024 * 1024  # Larger responses are sent as they are
+    # A body is sent whole if its delta would take more than this share of
+    # it, which also stops the search for bodies that mostly differ
+    DELTA_MAX_RATIO = 0.5
+    # Ask the websites for compressed responses and compress text that
+    # arrives uncompressed before it is embedded. Media that is compressed
+    # already is left alone.
+    COMPRESSION = True
+    COMPRESSION_LEVEL = 6  # zlib level, 1 is the fastest
+    COMPRESSION_MIN_SIZE = 256  # Smaller bodies are sent as they are
+    # Larger bodies (and those of unknown length) are compressed while
+    # they are arriving
+    COMPRESSION_BUFFER_SIZE = 1024 * 1024
+    # Re-encode the JPEG, PNG and GIF images of the websites to smaller
+    # variants (scaled down, lower quality) before they are embedded
+    TRANSCODE = False
+    TRANSCODE_QUALITY = 60  # JPEG quality of the variants
+    TRANSCODE_MAX_WIDTH = 1280
+    TRANSCODE_MAX_HEIGHT = 1280
+    TRANSCODE_MIN_SIZE = 16 * 1024  # Smaller images are sent as they are
+    TRANSCODE_MAX_SIZE = 16 * 1024 * 1024  # Larger ones as well
+    # Remove the whitespace and the comments from the bodies of these media
+    # types before they are embedded
+    MINIFY = False
+    MINIFY_TYPES = (
+        "application/javascript",
+        "application/json",
+        "text/css",
+        "text/html",
+        "text/javascript",
+    )
+    MINIFY_MAX_SIZE = 1024 * 1024  # Larger bodies are sent as they are
+    # Keep the last chunks of a chunked stego-response the stegoserver has
+    # embedded for a while, so that the stegoclient can resume it over
+    # another connection if its connection to the stegoserver breaks. The
+    # transfers are kept per process, so a stegoserver with several worker
+    # processes doesn't resume them.
+    RESUME = True
+    RESUME_WINDOW = 8 * 1024 * 1024  # Bytes of chunks kept per response
+    RESUME_MAX_TRANSFERS = 8  # Responses kept at most
+    RESUME_TTL = 30  # Seconds a response is kept after it has been sent
+    RESUME_ATTEMPTS = 3  # Attempts of the stegoclient without progress
+    RESUME_DELAY = 1  # Seconds between the attempts
+    # Seconds to wait for a TCP connection to be established
+    CONNECT_TIMEOUT = 30
+    # Seconds to wait for data from the stegoserver before the connection is
+    # considered broken. Tunnels don't time out. Keep it above
+    # KEEP_ALIVE_TIMEOUT, so that the stegoserver has given up on a stalled
+    # connection by the time the stegoclient resumes its transfer.
+    READ_TIMEOUT = 60
+    # Seconds to wait for data from a website. None waits as long as it
+    # takes, for long polling and slowly streamed responses.
+    UPSTREAM_READ_TIMEOUT = None
+    # Seconds the resolved addresses of a host are cached
+    DNS_CACHE_TTL = 60
+    # Seconds to wait before the next address of a host is tried while the
+    # previous connection attempts are still pending (RFC 8305)
+    HAPPY_EYEBALLS_DELAY = 0.25
+    # Keep-alive connections from the stegoserver to the websites
+    UPSTREAM_POOL_MAXSIZE = 6  # Connections per website
+    UPSTREAM_POOL_IDLE_TIMEOUT = 15  # Shortened by the Keep-Alive header
+    UPSTREAM_POOL_BLOCK_TIMEOUT = 30
+    # HTTP cache of the stegoserver which is shared by all stegoclients
+    UPSTREAM_CACHE_ENABLED = True
+    UPSTREAM_CACHE_MAX_SIZE = 256 * 1024 * 1024  # Bytes in memory
+    UPSTREAM_CACHE_MAX_ENTRY_SIZE = 8 * 1024 * 1024
 
     AVAILABLE_STEGOS = {
         "null": {
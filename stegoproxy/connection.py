@@ -10,7 +10,9 @@
     :license: GPLv3, see LICENSE for more details.
 """
 import logging
-import socket
+
+from stegoproxy.config import cfg
+from stegoproxy.resolver import create_connection
 
 log = logging.getLogger(__name__)
 
@@ -27,6 +29,10 @@ class Connection(object):
         """Sends data down the socket."""
         return self.conn.send(data)
 
+    def sendall(self, data):
+        """Sends all data down the socket."""
+        return self.conn.sendall(data)
+
     def recv(self, bytes=8192):
         """Recieves data from the socket."""
         try:
@@ -71,12 +77,19 @@ class Connection(object):
 
 
 class Server(Connection):
-    """Establish connection to destination server."""
+    """Establish connection to destination server.
 
-    def __init__(self, conn=None, host=None, port=None):
+    :param timeout: The number of seconds to wait for data from the server.
+                    ``None`` waits as long as it takes.
+    """
+
+    def __init__(self, conn=None, host=None, port=None, timeout=None):
         super(Server, self).__init__(b"server")
         if host and port:
-            self.conn = socket.create_connection((host, port))
+            self.conn = create_connection(
+                (host, port), timeout=cfg.CONNECT_TIMEOUT
+            )
+            self.conn.settimeout(timeout)
         else:
             self.conn = conn
 
@@ -87,6 +100,8 @@ class Client(Connection):
     def __init__(self, conn=None, host=None, port=None):
         super(Client, self).__init__(b"client")
         if host and port:
-            self.conn = socket.create_connection((host, port))
+            self.conn = create_connection(
+                (host, port), timeout=cfg.CONNECT_TIMEOUT
+            )
         else:
             self.conn = conn
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.delta
+    ~~~~~~~~~~~~~~~~
+
+    This module contains the delta encoding of responses. Polling
+    endpoints and dynamic pages often return a body that differs only a
+    little from the last one for the same URL. The stegoclient tells the
+    stegoserver which version of the body it has got and the stegoserver
+    sends the differences to that version instead of the whole body, if
+    they are smaller.
+
+    A delta starts with the digest of the body it results in, followed by
+    a sequence of instructions: copy a range of the old body or insert
+    some new bytes.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+# Sent by the stegoclient with the digest of the body it has got
+DELTA_BASE_HEADER = "X-Stego-Delta-Base"
+# Marks a response whose body is a delta to the body with this digest
+DELTA_HEADER = "X-Stego-Delta"
+# Matches between the bodies are searched for in blocks of this size
+BLOCK_SIZE = 16
+# Number of blocks of a body that are looked up to tell if it differs too
+# much from the base to search it byte by byte
+SAMPLES = 32
+_DIGEST_SIZE = 16
+_COPY = 0x00
+_INSERT = 0x01
+
+
+def digest(body):
+    """Returns the digest a body is identified with."""
+    return hashlib.blake2b(body, digest_size=_DIGEST_SIZE).hexdigest()
+
+
+def _encode_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return data
+
+
+def _decode_varint(data, offset):
+    value = shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated delta.")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def _match_length(base, base_offset, target, offset):
+    """Returns the number of bytes that are the same in both bodies from
+    the given offsets on.
+    """
+    length = 0
+    step = 256
+    while step:
+        while (
+            offset + length + step <= len(target)
+            and base_offset + length + step <= len(base)
+            and target[offset + length : offset + length + step]
+            == base[base_offset + length : base_offset + length + step]
+        ):
+            length += step
+        step //= 16
+    return length
+
+
+def make_delta(base, target, max_size=None):
+    """Returns the delta that turns ``base`` into ``target``, or ``None``
+    if it isn't smaller than ``target`` or ``max_size`` bytes.
+
+    Every byte of ``target`` that isn't found in ``base`` is looked up on
+    its own, so the search gives up as soon as the bytes that differ
+    exceed ``max_size``. A sample of blocks is looked up first to skip
+    bodies that mostly differ right away.
+    """
+    if max_size is None or max_size > len(target):
+        max_size = len(target)
+    step = max(len(target) // SAMPLES, BLOCK_SIZE)
+    samples = range(0, len(target) - BLOCK_SIZE + 1, step)
+    missing = sum(
+        base.find(target[offset : offset + BLOCK_SIZE]) == -1
+        for offset in samples
+    )
+    if samples and missing * len(target) >= max_size * len(samples):
+        return None
+
+    index = {}
+    for offset in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(base[offset : offset + BLOCK_SIZE], offset)
+
+    delta = bytearray(bytes.fromhex(digest(target)))
+    literal = 0
+    offset = 0
+    while offset + BLOCK_SIZE <= len(target):
+        base_offset = index.get(target[offset : offset + BLOCK_SIZE])
+        if base_offset is None:
+            offset += 1
+            if len(delta) + offset - literal >= max_size:
+                return None
+            continue
+
+        # Extend the match backwards into the pending literal bytes
+        while (
+            offset > literal
+            and base_offset > 0
+            and target[offset - 1] == base[base_offset - 1]
+        ):
+            offset -= 1
+            base_offset -= 1
+        length = _match_length(base, base_offset, target, offset)
+
+        if offset > literal:
+            delta.append(_INSERT)
+            delta += _encode_varint(offset - literal)
+            delta += target[literal:offset]
+        delta.append(_COPY)
+        delta += _encode_varint(base_offset)
+        delta += _encode_varint(length)
+        offset += length
+        literal = offset
+        if len(delta) >= max_size:
+            return None
+
+    if literal < len(target):
+        delta.append(_INSERT)
+        delta += _encode_varint(len(target) - literal)
+        delta += target[literal:]
+    if len(delta) >= max_size:
+        return None
+    return bytes(delta)
+
+
+def apply_delta(base, delta):
+    """Returns the body that results from applying a delta to ``base``.
+
+    :raises ValueError: If the delta is invalid or doesn't belong to
+                        ``base``.
+    """
+    if len(delta) < _DIGEST_SIZE:
+        raise ValueError("Truncated delta.")
+    target = bytearray()
+    offset = _DIGEST_SIZE
+    while offset < len(delta):
+        op = delta[offset]
+        if op == _COPY:
+            start, offset = _decode_varint(delta, offset + 1)
+            length, offset = _decode_varint(delta, offset)
+            if start + length > len(base):
+                raise ValueError("Delta copies beyond the end of the base.")
+            target += base[start : start + length]
+        elif op == _INSERT:
+            length, offset = _decode_varint(delta, offset + 1)
+            if offset + length > len(delta):
+                raise ValueError("Truncated delta.")
+            target += delta[offset : offset + length]
+            offset += length
+        else:
+            raise ValueError(f"Invalid delta instruction {op}.")
+
+    target = bytes(target)
+    if digest(target) != delta[:_DIGEST_SIZE].hex():
+        raise ValueError("The delta doesn't match the base.")
+    return target
+
+
+class DeltaStore(object):
+    """Keeps the last version of the body of the responses for each URL,
+    so that the next response for it can be sent as a delta. The least
+    recently used versions are dropped once they take up more than
+    ``max_size`` bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._versions = OrderedDict()  # url -> (digest, body)
+        self._stats = dict(deltas=0, bytes_saved=0)
+
+    def get(self, url):
+        """Returns the digest and the body of the last version for a URL,
+        or ``None``.
+        """
+        with self._lock:
+            version = self._versions.get(url)
+            if version is not None:
+                self._versions.move_to_end(url)
+            return version
+
+    def put(self, url, body):
+        with self._lock:
+            old = self._versions.pop(url, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(body) > self.max_size:
+                return
+            self._versions[url] = (digest(body), body)
+            self.size += len(body)
+            while self.size > self.max_size:
+                _, (_, dropped) = self._versions.popitem(last=False)
+                self.size -= len(dropped)
+
+    def record_delta(self, size, delta_size):
+        """Counts a body of ``size`` bytes that has been sent as a delta."""
+        with self._lock:
+            self._stats["deltas"] += 1
+            self._stats["bytes_saved"] += size - delta_size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._versions)
+            stats["size"] = self.size
+        return stats
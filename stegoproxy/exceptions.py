@@ -21,3 +21,15 @@ class UnsupportedStegoAlgorithm(Exception):
 
 class MessageToLong(Exception):
     pass
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class StreamReset(Exception):
+    pass
+
+
+class TunnelClosed(Exception):
+    pass
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.framing
+    ~~~~~~~~~~~~~~~~~~
+
+    This module contains the frames that multiplex several streams
+    over one stego tunnel.
+
+    Every frame starts with a 10 byte header::
+
+        +--------+--------+-----------------+-----------------+
+        | type   | flags  | stream id       | length          |
+        | 1 byte | 1 byte | 4 bytes         | 4 bytes         |
+        +--------+--------+-----------------+-----------------+
+
+    followed by ``length`` bytes of payload. Frames don't have to line
+    up with the stego media they are carried in, a frame may start in one
+    medium and end in the next one.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import struct
+from collections import namedtuple
+
+# The payload of a stream
+DATA = 0x0
+# Allows the peer to send ``increment`` more bytes on a stream
+WINDOW_UPDATE = 0x1
+# Aborts a stream
+RST_STREAM = 0x2
+# A piece of the compressed head of an HTTP message (see
+# :mod:`stegoproxy.hpack`). The pieces of a head are never interleaved
+# with the pieces of another one.
+HEADERS = 0x3
+
+# The sender won't send any more data on the stream
+END_STREAM = 0x1
+# The last piece of a head
+END_HEADERS = 0x4
+
+FRAME_HEADER = struct.Struct("!BBII")
+_INCREMENT = struct.Struct("!I")
+
+Frame = namedtuple("Frame", "type flags stream_id payload")
+
+
+def pack_frame(type, stream_id, payload=b"", flags=0):
+    """Returns the bytes of a frame."""
+    return FRAME_HEADER.pack(type, flags, stream_id, len(payload)) + payload
+
+
+def data_frame(stream_id, data, end_stream=False):
+    return pack_frame(
+        DATA, stream_id, data, flags=END_STREAM if end_stream else 0
+    )
+
+
+def headers_frame(stream_id, block, end_headers=True):
+    return pack_frame(
+        HEADERS, stream_id, block, flags=END_HEADERS if end_headers else 0
+    )
+
+
+def window_update_frame(stream_id, increment):
+    return pack_frame(WINDOW_UPDATE, stream_id, _INCREMENT.pack(increment))
+
+
+def rst_stream_frame(stream_id):
+    return pack_frame(RST_STREAM, stream_id)
+
+
+def parse_increment(payload):
+    """Returns the increment of a WINDOW_UPDATE frame."""
+    return _INCREMENT.unpack(payload)[0]
+
+
+class FrameParser(object):
+    """Parses the frames from the payloads of the stego media."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Adds data and returns the list of frames that are complete."""
+        self._buffer += data
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= FRAME_HEADER.size:
+            type, flags, stream_id, length = FRAME_HEADER.unpack_from(
+                self._buffer, offset
+            )
+            end = offset + FRAME_HEADER.size + length
+            if end > len(self._buffer):
+                break
+            payload = bytes(self._buffer[offset + FRAME_HEADER.size : end])
+            frames.append(Frame(type, flags, stream_id, payload))
+            offset = end
+        del self._buffer[:offset]
+        return frames
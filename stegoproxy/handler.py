@@ -14,13 +14,20 @@ import email
 import io
 import json
 import logging
+import math
 import os
 import random
 import re
 import select
 import sys
 from html.parser import HTMLParser
-from http.client import _UNKNOWN, HTTPMessage, HTTPResponse, IncompleteRead
+from http.client import (
+    _UNKNOWN,
+    HTTPMessage,
+    HTTPResponse,
+    IncompleteRead,
+    parse_headers,
+)
 from http.server import BaseHTTPRequestHandler
 from urllib.parse import ParseResult, parse_qsl, urlparse, urlsplit, urlunparse
 
@@ -35,20 +42,31 @@ from stegoproxy.utils import to_bytes, to_unicode
 log = logging.getLogger(__name__)
 CRLF = b"\r\n"
 HTTP_VERSIONS = {10: "HTTP/1.0", 11: "HTTP/1.1"}
+# headers are serialized with "\n" line endings by the email package
+END_OF_HEADERS = re.compile(b"\r?\n\r?\n")
+# Requests that may be sent again if a reused connection turns out to be dead
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE")
 
 
 class StegoHTTPResponse(HTTPResponse):
-    def _readall_chunked(self):
+    def iter_chunks(self):
+        """Yields the message extracted from each chunk of a chunked
+        stego-response as soon as the chunk has been received.
+        """
         assert self.chunked != _UNKNOWN
+        while True:
+            chunk_left = self._get_chunk_left()
+            if chunk_left is None:
+                break
+            chunk = self._safe_read(chunk_left)
+            self.chunk_left = 0
+            yield stego.extract(io.BytesIO(chunk))
+
+    def _readall_chunked(self):
         value = []
         try:
-            while True:
-                chunk_left = self._get_chunk_left()
-                if chunk_left is None:
-                    break
-                chunk = self._safe_read(chunk_left)
-                value.append(stego.extract(io.BytesIO(chunk)))
-                self.chunk_left = 0
+            for message in self.iter_chunks():
+                value.append(message)
             return b"".join(value)
         except IncompleteRead:
             raise IncompleteRead(b"".join(value))
@@ -96,7 +114,11 @@ class BaseProxyHandler(BaseHTTPRequestHandler):
                 )
             )
 
-        self.server = Server(host=self.hostname, port=int(self.port))
+        self.server = Server(
+            host=self.hostname,
+            port=int(self.port),
+            timeout=cfg.UPSTREAM_READ_TIMEOUT,
+        )
         self.client = Client(self.connection)  # reusing the connection here
 
     def _get_waitable_lists(self):
@@ -200,17 +222,110 @@ class BaseProxyHandler(BaseHTTPRequestHandler):
                 break
 
     def _write_end_of_chunks(self):
-        self.client.send(b"0\r\n\r\n")
+        self.client.sendall(b"0\r\n\r\n")
 
     def _write_chunks(self, chunk):
         # no need to convert to "to_bytes" - chunk is already of type bytes
-        self.client.send(b"%X\r\n%s\r\n" % (len(chunk), chunk))
+        self.client.sendall(b"%X\r\n%s\r\n" % (len(chunk), chunk))
 
     def _split_into_chunks(self, seq, chunk_size):
         """Splits a sequence into evenly sized chunks."""
         for i in range(0, len(seq), chunk_size):
             yield seq[i : i + chunk_size]
 
+    def _is_chunked(self, headers):
+        """Checks if a message is sent with chunked transfer-encoding."""
+        encodings = headers.get("Transfer-Encoding", "").lower().split(",")
+        return encodings[-1].strip() == "chunked"
+
+    def _iter_chunked(self, fp, size=None):
+        """Reads a chunked body from a file-like object and yields the data
+        of each chunk, split into pieces of at most ``size`` bytes.
+        """
+        while True:
+            line = fp.readline(65537)
+            if not line:
+                raise IncompleteRead(b"")
+            chunk_left = int(line.split(b";", 1)[0], 16)
+            if chunk_left == 0:
+                break
+
+            while chunk_left > 0:
+                amt = chunk_left if size is None else min(chunk_left, size)
+                data = fp.read(amt)
+                if not data:
+                    raise IncompleteRead(b"", chunk_left)
+                chunk_left -= len(data)
+                yield data
+            # CRLF at the end of the chunk
+            fp.readline(65537)
+
+        # Skip the trailer
+        while fp.readline(65537) not in (b"\r\n", b"\n", b""):
+            pass
+
+    def _iter_request_body(self):
+        """Reads the body of the browser's request and yields it in pieces
+        of at most ``cfg.STREAM_BUFFER_SIZE`` bytes.
+        """
+        if self._is_chunked(self.headers):
+            yield from self._iter_chunked(self.rfile, cfg.STREAM_BUFFER_SIZE)
+            return
+
+        left = int(self.headers.get("Content-Length", 0))
+        while left > 0:
+            data = self.rfile.read(min(left, cfg.STREAM_BUFFER_SIZE))
+            if not data:
+                raise IncompleteRead(b"", left)
+            left -= len(data)
+            yield data
+
+    def _set_response_framing(self, headers, length):
+        """Prepares the headers of a response to the browser whose body is
+        ``length`` bytes long, or of unknown length if ``length`` is None.
+
+        Returns ``True`` if the body has to be sent in chunks.
+        """
+        if length is not None:
+            return False
+
+        del headers["Content-Length"]
+        if self.request_version == "HTTP/1.1":
+            headers["Transfer-Encoding"] = "chunked"
+            return True
+
+        # HTTP/1.0 doesn't know chunks, the end of the body is signaled
+        # by closing the connection
+        headers["Connection"] = "close"
+        self.close_connection = True
+        return False
+
+    def _relay_response(self, h):
+        """Relays a response from the website to the browser. The header is
+        sent right away and the body is relayed piece by piece through a
+        fixed-size buffer while it is still arriving.
+        """
+        chunked = self._set_response_framing(h.msg, h.length)
+        self.client.sendall(
+            self._build_response_header(
+                self.request_version, h.status, h.reason, h.msg
+            )
+        )
+
+        buffer = bytearray(cfg.STREAM_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            n = h.readinto(buffer)
+            if not n:
+                break
+            if chunked:
+                self._write_chunks(view[:n])
+            else:
+                self.client.sendall(view[:n])
+
+        if chunked:
+            self._write_end_of_chunks()
+
     def _get_cover_object(self):
         # i = cfg.COVER_OBJECTS[random.randint(0, len(cfg.COVER_OBJECTS) - 1)]
         if cfg.STEGO_ALGORITHM.get("formats") is not None:
@@ -235,6 +350,27 @@ class BaseProxyHandler(BaseHTTPRequestHandler):
                 return int(w * h * 3 / 8) - 1024
         return cfg.STEGO_ALGORITHM.get("size", sys.maxsize)
 
+    def _crop_cover(self, cover, size):
+        """Returns a copy of the cover object that is just big enough to
+        hide a message of ``size`` bytes. Smaller covers are faster to
+        embed messages in.
+        """
+        if not isinstance(cover, Image.Image):
+            return cover
+
+        w, h = cover.size
+        if cfg.STEGO_ALGORITHM.get("formats") == "png":
+            # the inverse of _calc_max_size
+            height = math.ceil((size + 1024) * 8 / (3 * w))
+        else:
+            # the capacity doesn't depend on the size of the cover
+            height = math.ceil(h * size / self._calc_max_size(cover))
+        height = max(16, height)
+
+        if height >= h:
+            return cover.copy()
+        return cover.crop((0, 0, w, height))
+
     def _encode(self, s):
         return base64.b64encode(s)
 
@@ -326,6 +462,47 @@ class BaseProxyHandler(BaseHTTPRequestHandler):
             self._build_response(request_version, status, reason, headers, body)
         )
 
+    def _parse_request(self, data):
+        """Parses a raw HTTP request.
+
+        Returns a tuple of the command, the path, the version, the headers
+        as a HTTPMessage object and the request body.
+        """
+        m = END_OF_HEADERS.search(data)
+        if m is None:
+            raise ValueError("Incomplete request header.")
+
+        request_line, _, raw_headers = data[: m.end()].partition(b"\n")
+        command, path, version = to_unicode(request_line).strip().split()
+        headers = parse_headers(io.BytesIO(raw_headers))
+        return command, path, version, headers, data[m.end() :]
+
+    def _parse_response(self, data):
+        """Parses a raw HTTP response.
+
+        Returns a tuple of the version, the status, the reason, the headers
+        as a HTTPMessage object and the response body.
+        """
+        m = END_OF_HEADERS.search(data)
+        if m is None:
+            raise ValueError("Incomplete response header.")
+
+        status_line, _, raw_headers = data[: m.end()].partition(b"\n")
+        version, status, reason = (
+            to_unicode(status_line).strip().split(None, 2) + [""]
+        )[:3]
+        headers = parse_headers(io.BytesIO(raw_headers))
+        return version, int(status), reason, headers, data[m.end() :]
+
+    def _get_hostaddr(self, path, headers):
+        """Returns the host and port to connect to for a request."""
+        u = urlparse(path)
+        host = u.netloc or headers.get("Host", "")
+        addr = host.rsplit(":", 1)
+        if len(addr) > 1 and addr[1].isdigit():
+            return addr[0].strip("[]"), int(addr[1])
+        return host.strip("[]"), 80
+
     def _get_hostaddr_from_headers(self, headers):
         # first line ([0]) is request line
         raw_headers = to_unicode(headers).split("\r\n")[1]
@@ -361,64 +538,72 @@ class BaseProxyHandler(BaseHTTPRequestHandler):
 
         # The request that got sent to the website: self
         # Browser <--> [Proxy <--> Website]
-        content_length = int(self.headers.get("Content-Length", 0))
-        request_body = self.rfile.read(content_length)
+        # The proxy already answered "Expect: 100-continue" itself
+        del self.headers["Expect"]
+        chunked = self._is_chunked(self.headers)
 
-        # Build request which will be sent to the client
+        # Send the request header down the pipe right away...
         # [Browser <--> Proxy] <--> Website
-        client_request = (
-            # Add "GET / HTTP/1.1..." to the request"
-            b" ".join(
-                [
-                    to_bytes(self.command),
-                    to_bytes(self.path),
-                    to_bytes(self.request_version),
-                ]
+        self.server.sendall(
+            # "GET / HTTP/1.1", Host, User-Agent, ...
+            self._build_request_header(
+                self.command, self.path, self.request_version, self.headers
             )
-            + CRLF
-            # Add Headers to the request (Host:..., User-Agent:...)
-            + self.headers.as_bytes()
-            + CRLF
-            + request_body
         )
 
-        # Send it down the pipe!
-        self.server.send(to_bytes(client_request))
+        # ...and the request body piece by piece while it is arriving. Only
+        # its beginning is kept to be logged.
+        request_body = bytearray()
+        body_size = 0
+        for data in self._iter_request_body():
+            body_size += len(data)
+            if len(request_body) < cfg.LOG_BODY_SIZE:
+                request_body += data[: cfg.LOG_BODY_SIZE - len(request_body)]
+            if chunked:
+                self.server.sendall(b"%X\r\n%s\r\n" % (len(data), data))
+            else:
+                self.server.sendall(data)
+        if chunked:
+            self.server.sendall(b"0\r\n\r\n")
+        if body_size:
+            log.debug(f"Relayed request body of {body_size} bytes")
+        request_body = bytes(request_body) if body_size else None
 
         # Parse response
-        h = HTTPResponse(self.server.conn)
+        h = HTTPResponse(self.server.conn, method=self.command)
         h.begin()
 
         # Get rid of hop-by-hop headers
         orig_response = h
         self.filter_headers(h.msg)
 
-        # Time to relay the message across
-        # read response body
-        response_body = h.read()
-        res = (
-            # HTTP/1.1  OK
-            b" ".join(
-                [
-                    to_bytes(self.request_version),
-                    to_bytes(h.status),
-                    to_bytes(h.reason),
-                ]
+        if cfg.STREAM_RESPONSES:
+            # Relay the message across while it is still arriving
+            self._relay_response(h)
+            response_body = None
+        else:
+            # Time to relay the message across
+            # read response body
+            response_body = h.read()
+            if h.status >= 200 and h.status not in (204, 304):
+                del h.msg["Content-Length"]
+                h.msg["Content-Length"] = str(len(response_body))
+            res = (
+                # HTTP/1.1 200 OK
+                # Content-Type, Content-Length, Server...
+                self._build_response_header(
+                    self.request_version, h.status, h.reason, h.msg
+                )
+                + response_body
             )
-            # Content-Type, Content-Length, Server...
-            + CRLF
-            + h.msg.as_bytes()
-            + CRLF
-            + response_body
-        )
+
+            # Relay the message
+            self.client.sendall(res)
 
         # Let's close off the remote end
         h.close()
         self.server.close()
 
-        # Relay the message
-        self.client.send(res)
-
         self.print_info(self, request_body, orig_response, response_body)
 
     def log_message(self, format, *args):
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.hpack
+    ~~~~~~~~~~~~~~~~
+
+    This module compresses the heads of the HTTP messages that are sent
+    over a tunnel, in the style of HPACK (RFC 7541).
+
+    Both ends of a tunnel keep a table of the header fields that have been
+    sent before. A field that is in the table is sent as its index, so
+    the User-Agent, Accept and Cookie headers which are the same for
+    almost every request only cost a byte or two after the first request.
+    The start line of a message is split into pseudo-header fields
+    (``:method``, ``:path``, ``:version`` for a request and ``:version``,
+    ``:status``, ``:reason`` for a response) so that its parts get indexed
+    as well.
+
+    The encoder and the decoder change their tables with every head, so
+    the heads must be decoded in the order they have been encoded in.
+    Strings are sent as they are, without Huffman coding.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import collections
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+# The size of the dynamic table both ends start with
+DEFAULT_TABLE_SIZE = 4096
+# A decoder doesn't accept a larger table than this
+MAX_TABLE_SIZE = 1024 * 1024
+# Every entry of the dynamic table is accounted with this overhead
+ENTRY_OVERHEAD = 32
+
+STATIC_TABLE = (
+    (":method", "GET"),
+    (":method", "POST"),
+    (":method", "HEAD"),
+    (":method", "CONNECT"),
+    (":path", "/"),
+    (":version", "HTTP/1.1"),
+    (":version", "HTTP/1.0"),
+    (":status", "200"),
+    (":status", "204"),
+    (":status", "206"),
+    (":status", "301"),
+    (":status", "302"),
+    (":status", "304"),
+    (":status", "400"),
+    (":status", "404"),
+    (":status", "500"),
+    (":reason", "OK"),
+    (":reason", "Not Modified"),
+    ("Accept-Charset", ""),
+    ("Accept-Encoding", "gzip, deflate"),
+    ("Accept-Language", ""),
+    ("Accept-Ranges", "bytes"),
+    ("Accept", "*/*"),
+    ("Access-Control-Allow-Origin", ""),
+    ("Age", ""),
+    ("Allow", ""),
+    ("Authorization", ""),
+    ("Cache-Control", ""),
+    ("Connection", "keep-alive"),
+    ("Connection", "close"),
+    ("Content-Disposition", ""),
+    ("Content-Encoding", ""),
+    ("Content-Language", ""),
+    ("Content-Length", ""),
+    ("Content-Location", ""),
+    ("Content-Range", ""),
+    ("Content-Type", ""),
+    ("Cookie", ""),
+    ("Date", ""),
+    ("ETag", ""),
+    ("Expect", ""),
+    ("Expires", ""),
+    ("Host", ""),
+    ("If-Match", ""),
+    ("If-Modified-Since", ""),
+    ("If-None-Match", ""),
+    ("If-Range", ""),
+    ("If-Unmodified-Since", ""),
+    ("Keep-Alive", ""),
+    ("Last-Modified", ""),
+    ("Link", ""),
+    ("Location", ""),
+    ("Proxy-Authorization", ""),
+    ("Proxy-Connection", "keep-alive"),
+    ("Range", ""),
+    ("Referer", ""),
+    ("Server", ""),
+    ("Set-Cookie", ""),
+    ("Strict-Transport-Security", ""),
+    ("Transfer-Encoding", "chunked"),
+    ("Upgrade-Insecure-Requests", "1"),
+    ("User-Agent", ""),
+    ("Vary", ""),
+    ("Via", ""),
+    ("WWW-Authenticate", ""),
+)
+
+# Fields whose values hardly ever repeat, they would only push the useful
+# entries out of the table
+_NOT_INDEXED = (
+    ":path",
+    "age",
+    "content-length",
+    "date",
+    "etag",
+    "expires",
+    "last-modified",
+    "x-stego-delta",
+    "x-stego-delta-base",
+)
+# Credentials are never put into the table
+_NEVER_INDEXED = ("authorization", "proxy-authorization")
+
+
+def encode_integer(value, prefix_bits, flags=0):
+    """Encodes an integer with an N-bit prefix (RFC 7541, section 5.1)."""
+    max_prefix = (1 << prefix_bits) - 1
+    if value < max_prefix:
+        return bytes([flags | value])
+    data = bytearray([flags | max_prefix])
+    value -= max_prefix
+    while value >= 128:
+        data.append(value % 128 + 128)
+        value //= 128
+    data.append(value)
+    return bytes(data)
+
+
+def decode_integer(data, offset, prefix_bits):
+    """Decodes an integer with an N-bit prefix. Returns the integer and
+    the offset of the next byte.
+    """
+    max_prefix = (1 << prefix_bits) - 1
+    try:
+        value = data[offset] & max_prefix
+        offset += 1
+        shift = 0
+        if value == max_prefix:
+            while True:
+                byte = data[offset]
+                offset += 1
+                value += (byte & 127) << shift
+                shift += 7
+                if not byte & 128:
+                    break
+    except IndexError:
+        raise ValueError("Truncated integer in header block.")
+    return value, offset
+
+
+def encode_string(value):
+    data = value.encode("latin-1")
+    return encode_integer(len(data), 7) + data
+
+
+def decode_string(data, offset):
+    if offset < len(data) and data[offset] & 0x80:
+        raise ValueError("Huffman coded strings aren't supported.")
+    length, offset = decode_integer(data, offset, 7)
+    if offset + length > len(data):
+        raise ValueError("Truncated string in header block.")
+    value = bytes(data[offset : offset + length]).decode("latin-1")
+    return value, offset + length
+
+
+def parse_head(head):
+    """Splits the head of an HTTP message into a list of fields. The start
+    line becomes pseudo-header fields.
+    """
+    lines = head.decode("latin-1").split("\n")
+    start = lines[0].strip("\r").split(None, 2)
+    if start and start[0].startswith("HTTP/"):
+        names = (":version", ":status", ":reason")
+    else:
+        names = (":method", ":path", ":version")
+    fields = list(zip(names, start + [""] * (3 - len(start))))
+
+    for line in lines[1:]:
+        line = line.rstrip("\r")
+        if not line:
+            continue
+        if line[0] in " \t" and len(fields) > 3:
+            # A folded line continues the previous field
+            name, value = fields[-1]
+            fields[-1] = (name, f"{value} {line.strip()}")
+            continue
+        name, _, value = line.partition(":")
+        fields.append((name.strip(), value.strip()))
+    return fields
+
+
+def build_head(fields):
+    """Builds the head of an HTTP message from its fields."""
+    pseudo = dict(f for f in fields[:3] if f[0].startswith(":"))
+    if ":method" in pseudo:
+        start = [pseudo.get(":method"), pseudo.get(":path")]
+        start.append(pseudo.get(":version"))
+    else:
+        start = [pseudo.get(":version"), pseudo.get(":status")]
+        start.append(pseudo.get(":reason"))
+    lines = [" ".join(part for part in start if part is not None)]
+    lines.extend(
+        f"{name}: {value}"
+        for name, value in fields
+        if not name.startswith(":")
+    )
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+class HeaderTable(object):
+    """The static table followed by the dynamic table. Index 1 is the
+    first entry of the static table, the newest entry of the dynamic
+    table follows its last entry.
+    """
+
+    def __init__(self, max_size=DEFAULT_TABLE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.deque()
+
+    def __len__(self):
+        return len(STATIC_TABLE) + len(self._entries)
+
+    def get(self, index):
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        index -= len(STATIC_TABLE) + 1
+        if not 0 <= index < len(self._entries):
+            raise ValueError(f"Invalid header table index {index}.")
+        return self._entries[index]
+
+    def find(self, name, value):
+        """Returns the index of a field and whether the value matches as
+        well, or ``(0, False)``.
+        """
+        name_index = 0
+        lower = name.lower()
+        entries = itertools.chain(STATIC_TABLE, self._entries)
+        for index, (entry_name, entry_value) in enumerate(entries, 1):
+            if entry_name.lower() == lower:
+                if entry_value == value:
+                    return index, True
+                if not name_index:
+                    name_index = index
+        return name_index, False
+
+    def add(self, name, value):
+        """Adds a field. Entries are evicted to make room for it, a field
+        that is larger than the whole table just empties it.
+        """
+        size = len(name) + len(value) + ENTRY_OVERHEAD
+        self._entries.appendleft((name, value))
+        self.size += size
+        self._evict()
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            name, value = self._entries.pop()
+            self.size -= len(name) + len(value) + ENTRY_OVERHEAD
+
+
+class HeaderEncoder(object):
+    """Compresses the heads of the messages sent to the peer.
+
+    :param table_size: The size of the dynamic table in bytes. The peer
+                       is told about it with the first head.
+    """
+
+    def __init__(self, table_size=DEFAULT_TABLE_SIZE):
+        self.table = HeaderTable(DEFAULT_TABLE_SIZE)
+        self._table_size = min(table_size, MAX_TABLE_SIZE)
+        #: The number of bytes of the heads and of their encoded form
+        self.raw_size = 0
+        self.encoded_size = 0
+
+    def encode(self, head):
+        """Returns the header block of the head of a message."""
+        data = bytearray()
+        if self._table_size != self.table.max_size:
+            data += encode_integer(self._table_size, 5, 0x20)
+            self.table.resize(self._table_size)
+
+        for name, value in parse_head(head):
+            index, exact = self.table.find(name, value)
+            lower = name.lower()
+            if exact and lower not in _NEVER_INDEXED:
+                data += encode_integer(index, 7, 0x80)
+                continue
+
+            if lower in _NEVER_INDEXED:
+                data += encode_integer(index, 4, 0x10)
+            elif lower in _NOT_INDEXED:
+                data += encode_integer(index, 4, 0x00)
+            else:
+                data += encode_integer(index, 6, 0x40)
+                self.table.add(name, value)
+            if not index:
+                data += encode_string(name)
+            data += encode_string(value)
+
+        self.raw_size += len(head)
+        self.encoded_size += len(data)
+        return bytes(data)
+
+
+class HeaderDecoder(object):
+    """Decompresses the heads of the messages from the peer."""
+
+    def __init__(self):
+        self.table = HeaderTable(DEFAULT_TABLE_SIZE)
+
+    def decode(self, block):
+        """Returns the head of a message from its header block."""
+        fields = []
+        offset = 0
+        while offset < len(block):
+            byte = block[offset]
+            if byte & 0x80:
+                index, offset = decode_integer(block, offset, 7)
+                fields.append(self.table.get(index))
+                continue
+            if byte & 0xE0 == 0x20:
+                size, offset = decode_integer(block, offset, 5)
+                if size > MAX_TABLE_SIZE:
+                    raise ValueError(f"Header table too large: {size}")
+                self.table.resize(size)
+                continue
+
+            indexed = byte & 0x40
+            index, offset = decode_integer(block, offset, 6 if indexed else 4)
+            if index:
+                name = self.table.get(index)[0]
+            else:
+                name, offset = decode_string(block, offset)
+            value, offset = decode_string(block, offset)
+            fields.append((name, value))
+            if indexed:
+                self.table.add(name, value)
+
+        if len(fields) < 3:
+            raise ValueError("Header block without a start line.")
+        return build_head(fields)
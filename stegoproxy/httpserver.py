@@ -11,11 +11,16 @@
 """
 import logging
 import os
+import queue
+import signal
 import socket
+import threading
+import time
 from http.server import HTTPServer
 from socketserver import ForkingMixIn, ThreadingMixIn
 
 LISTEN_QUEUE = 128
+POOL_SIZE = 16
 
 
 log = logging.getLogger(__name__)
@@ -48,14 +53,22 @@ class BaseHTTPServer(HTTPServer, object):
     multiprocess = False
     request_queue_size = LISTEN_QUEUE
 
-    def __init__(self, host, port, handler, passthrough_errors=False):
+    def __init__(
+        self, host, port, handler, passthrough_errors=False, reuse_port=False
+    ):
         self.address_family = select_address_family(host, port)
         self.passthrough_errors = passthrough_errors
+        self.reuse_port = reuse_port
         self.shutdown_signal = False
         server_address = get_sockaddr(host, int(port), self.address_family)
 
         HTTPServer.__init__(self, server_address, handler)
 
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
     def log(self, type, message, *args):
         log.info(type, message, *args)
 
@@ -81,6 +94,112 @@ class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer):
     daemon_threads = True
 
 
+class ThreadPoolMixIn(object):
+    """Mix-in class to handle requests in a fixed pool of worker threads.
+
+    Accepted connections are put into a bounded queue. If all workers are
+    busy and the queue is full, the accept loop blocks until a worker
+    frees up a slot, which pushes the backpressure down to the listen
+    backlog of the socket instead of spawning more and more threads.
+    """
+
+    pool_size = POOL_SIZE
+    pool_queue_size = LISTEN_QUEUE
+    daemon_threads = True
+
+    _requests = None
+    _workers = None
+    _active_workers = 0
+
+    def _start_workers(self):
+        self._requests = queue.Queue(self.pool_queue_size)
+        self._workers_lock = threading.Lock()
+        self._workers = []
+        for i in range(self.pool_size):
+            t = threading.Thread(
+                target=self._process_queue, name="stegoproxy-worker-%d" % i
+            )
+            t.daemon = self.daemon_threads
+            t.start()
+            self._workers.append(t)
+
+    def _process_queue(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            with self._workers_lock:
+                self._active_workers += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._workers_lock:
+                    self._active_workers -= 1
+
+    @property
+    def workers(self):
+        """The number of worker threads in the pool."""
+        return len(self._workers) if self._workers is not None else 0
+
+    @property
+    def active_workers(self):
+        """The number of workers that are currently handling a request."""
+        return self._active_workers
+
+    @property
+    def queued_requests(self):
+        """The number of accepted connections waiting for a worker."""
+        return self._requests.qsize() if self._requests is not None else 0
+
+    def process_request(self, request, client_address):
+        # The workers are started lazily so that they are created in the
+        # process that is actually serving requests (i.e. after a fork)
+        if self._workers is None:
+            self._start_workers()
+        self._requests.put((request, client_address))
+
+    def server_close(self):
+        super(ThreadPoolMixIn, self).server_close()
+        if self._workers is None:
+            return
+
+        for _ in self._workers:
+            self._requests.put(None)
+        if not self.daemon_threads:
+            for t in self._workers:
+                t.join()
+        self._workers = None
+
+
+class PooledHTTPServer(ThreadPoolMixIn, BaseHTTPServer):
+    """A HTTP server that handles requests in a fixed pool of threads."""
+
+    multithread = True
+
+    def __init__(
+        self,
+        host,
+        port,
+        handler=None,
+        passthrough_errors=False,
+        pool_size=POOL_SIZE,
+        pool_queue_size=LISTEN_QUEUE,
+        reuse_port=False,
+    ):
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1.")
+        BaseHTTPServer.__init__(
+            self, host, port, handler, passthrough_errors, reuse_port
+        )
+        self.pool_size = pool_size
+        self.pool_queue_size = pool_queue_size
+
+
 class ForkingHTTPServer(ForkingMixIn, BaseHTTPServer):
     """A WSGI server that does forking."""
 
@@ -95,6 +214,135 @@ class ForkingHTTPServer(ForkingMixIn, BaseHTTPServer):
         self.max_children = processes
 
 
+class PreforkServer(object):
+    """Runs a server in a number of long-lived worker processes.
+
+    By default the listening socket is created once in the master process
+    and inherited by the forked workers which all accept connections on
+    it. If ``reuse_port`` is set, every worker binds its own socket with
+    ``SO_REUSEPORT`` instead and the kernel balances the connections
+    between them. The master supervises the workers and restarts them
+    if they die.
+
+    :param server_factory: A callable that returns a new server instance.
+    :param workers: The number of worker processes.
+    :param reuse_port: Let every worker bind its own socket.
+    """
+
+    multiprocess = True
+    #: Minimum lifetime of a worker before it gets restarted right away.
+    restart_delay = 1
+
+    def __init__(self, server_factory, workers, reuse_port=False):
+        if not hasattr(os, "fork"):
+            raise ValueError("Your platform does not support forking.")
+        if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("Your platform does not support SO_REUSEPORT.")
+
+        self.server_factory = server_factory
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.shutdown_signal = False
+        self.children = {}
+        # In both modes the master binds the socket once so that errors
+        # like "address already in use" are raised before forking.
+        self.server = server_factory()
+        self.socket = self.server.socket
+
+    def _spawn_worker(self):
+        master_pid = os.getpid()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return
+
+        # worker process
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self._watch_master(master_pid)
+            if self.reuse_port:
+                self.server = self.server_factory()
+            self.server.serve_forever()
+        except Exception:
+            log.exception("Worker %d crashed", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _watch_master(self, master_pid):
+        # The workers must not outlive the master, i.e. when the master
+        # gets restarted by the reloader.
+        def watch():
+            while os.getppid() == master_pid:
+                time.sleep(1)
+            log.debug("Master died, stopping worker %d", os.getpid())
+            os._exit(0)
+
+        t = threading.Thread(target=watch)
+        t.daemon = True
+        t.start()
+
+    def _reap_workers(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                break
+            if pid == 0:
+                break
+
+            started = self.children.pop(pid, None)
+            if started is None or self.shutdown_signal:
+                continue
+
+            log.warning(
+                "Worker %d exited with status %d, restarting it", pid, status
+            )
+            # Don't end up in a fork loop if the workers die right away
+            if time.time() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+
+    def _stop(self, signum=None, frame=None):
+        self.shutdown_signal = True
+
+    def serve_forever(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._stop)
+
+        if self.reuse_port:
+            # The workers bind their own sockets; the master must not hold
+            # one or the kernel would route connections to it as well.
+            self.server.server_close()
+
+        try:
+            while not self.shutdown_signal:
+                while len(self.children) < self.workers:
+                    self._spawn_worker()
+                time.sleep(0.5)
+                self._reap_workers()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown_signal = True
+            self.server_close()
+
+    def server_close(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.children.clear()
+        self.server.server_close()
+
+
 def make_server(
     host=None,
     port=None,
@@ -102,24 +350,43 @@ def make_server(
     processes=1,
     request_handler=None,
     passthrough_errors=False,
+    pool_size=0,
+    pool_queue_size=LISTEN_QUEUE,
+    reuse_port=False,
 ):
     """Create a new server instance that is either threaded, or forks
     or just processes one request after another.
+
+    If ``threaded`` is set and ``pool_size`` is greater than 0, the requests
+    are handled in a fixed pool of threads instead of a new thread per
+    request.
     """
     if threaded and processes > 1:
         raise ValueError(
             "cannot have a multithreaded and " "multi process server."
         )
+    elif threaded and pool_size > 0:
+        return PooledHTTPServer(
+            host,
+            port,
+            request_handler,
+            passthrough_errors,
+            pool_size,
+            pool_queue_size,
+            reuse_port,
+        )
     elif threaded:
         return ThreadedHTTPServer(
-            host, port, request_handler, passthrough_errors
+            host, port, request_handler, passthrough_errors, reuse_port
         )
     elif processes > 1:
         return ForkingHTTPServer(
             host, port, processes, request_handler, passthrough_errors
         )
     else:
-        return BaseHTTPServer(host, port, request_handler, passthrough_errors)
+        return BaseHTTPServer(
+            host, port, request_handler, passthrough_errors, reuse_port
+        )
 
 
 def is_running_from_reloader():
@@ -139,6 +406,10 @@ def run_server(
     threaded=False,
     processes=1,
     passthrough_errors=False,
+    pool_size=0,
+    pool_queue_size=LISTEN_QUEUE,
+    workers=1,
+    reuse_port=False,
     what=None,
     algorithm=None
 ):
@@ -164,6 +435,17 @@ def run_server(
                                catching. This means that the server will die on
                                errors but it can be useful to hook debuggers
                                in (pdb etc.)
+    :param pool_size: if greater than 0 and ``threaded`` is set, handle the
+                      requests in a fixed pool of this many threads instead
+                      of starting a new thread for every request.
+    :param pool_queue_size: the maximum number of accepted connections that
+                            wait for a free worker of the pool.
+    :param workers: if greater than 1 then run this many long-lived worker
+                    processes that accept connections on the same port.
+                    Can be combined with ``threaded`` and ``pool_size``.
+    :param reuse_port: let every worker process bind its own socket with
+                       ``SO_REUSEPORT`` instead of inheriting the socket
+                       of the master process.
     """
     if not isinstance(port, int):
         raise TypeError("port must be an integer")
@@ -189,15 +471,33 @@ def run_server(
             )
 
     def inner():
-        srv = make_server(
-            hostname,
-            port,
-            threaded,
-            processes,
-            request_handler,
-            passthrough_errors,
-        )
-        log_startup(srv.socket)
+        def server_factory():
+            return make_server(
+                hostname,
+                port,
+                threaded,
+                processes,
+                request_handler,
+                passthrough_errors,
+                pool_size,
+                pool_queue_size,
+                reuse_port,
+            )
+
+        if workers > 1:
+            srv = PreforkServer(server_factory, workers, reuse_port)
+            log_startup(srv.socket)
+            log.info("Using %d worker processes" % srv.workers)
+            pool_server = srv.server
+        else:
+            srv = pool_server = server_factory()
+            log_startup(srv.socket)
+
+        if isinstance(pool_server, ThreadPoolMixIn):
+            log.info(
+                "Using a pool of %d threads with a queue of %d connections"
+                % (pool_server.pool_size, pool_server.pool_queue_size)
+            )
         srv.serve_forever()
 
     if use_reloader:
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.minify
+    ~~~~~~~~~~~~~~~~~
+
+    This module removes the whitespace and the comments from HTML, CSS,
+    JavaScript and JSON bodies before they are embedded. The minifiers
+    only do what can't change the meaning of a body, a body they aren't
+    sure about is sent as it is.
+
+    Further minifiers can be added with :func:`register`. A minifier gets
+    a whole body and returns the minified body or raises a ``ValueError``
+    if it can't minify it.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import json
+import logging
+import re
+import threading
+
+log = logging.getLogger(__name__)
+_MINIFIERS = {}  # media type -> minifier
+
+# Strings and license comments are kept, whitespace and other comments
+# form gaps that are removed or replaced by a single space
+_CSS_TOKENS = re.compile(
+    rb"(?P<keep>\"(?:[^\"\\\n]|\\.)*\"|'(?:[^'\\\n]|\\.)*'|/\*!.*?\*/)"
+    rb"|(?P<gap>(?:\s|/\*(?!!).*?\*/)+)",
+    re.S,
+)
+# A gap next to one of these characters isn't needed
+_CSS_DELIMITERS = b"{};,>"
+_HTML_TOKENS = re.compile(
+    # Elements whose whitespace matters are kept as they are
+    rb"(?P<raw><(pre|textarea|script)\b.*?</\2\s*>)"
+    rb"|(?P<style><style\b[^>]*>)(?P<css>.*?)(?P<end></style\s*>)"
+    # Conditional comments are kept
+    rb"|(?P<comment><!--(?!\[if\b).*?-->)"
+    rb"|(?P<tag><[!/?a-z](?:\"[^\"]*\"|'[^']*'|[^'\">])*>)"
+    rb"|(?P<space>\s+)",
+    re.I | re.S,
+)
+_JSON_TOKENS = re.compile(rb"(\"(?:[^\"\\]|\\.)*\")|[ \t\n\r]+", re.S)
+
+
+def register(*media_types):
+    """Registers a minifier for the given media types."""
+
+    def decorator(minifier):
+        for media_type in media_types:
+            _MINIFIERS[media_type] = minifier
+        return minifier
+
+    return decorator
+
+
+def get_minifier(media_type):
+    """Returns the minifier of a media type, or ``None``."""
+    media_type = media_type.lower()
+    minifier = _MINIFIERS.get(media_type)
+    if minifier is None and media_type.endswith("+json"):
+        minifier = _MINIFIERS.get("application/json")
+    return minifier
+
+
+def minify(body, content_type):
+    """Returns the minified body, or ``None`` if there is no minifier for
+    its media type or the minified body isn't smaller.
+
+    :param body: The body as bytes.
+    :param content_type: The Content-Type header of the body.
+    """
+    media_type, _, params = (content_type or "").partition(";")
+    minifier = get_minifier(media_type.strip())
+    if minifier is None:
+        return None
+    # The minifiers only work with charsets that are compatible to ASCII
+    charset = re.search(r"charset=\"?([\w-]+)", params, re.I)
+    if body.startswith((b"\xfe\xff", b"\xff\xfe")) or (
+        charset and charset.group(1).lower().startswith(("utf-16", "utf-32"))
+    ):
+        return None
+
+    try:
+        minified = minifier(body)
+    except ValueError as e:
+        log.debug(f"Couldn't minify {media_type} body: {e}")
+        return None
+    if len(minified) >= len(body):
+        return None
+    return minified
+
+
+@register("text/css")
+def minify_css(body):
+    def replace(match):
+        if match.group("keep") is not None:
+            return match.group("keep")
+        start, end = match.span()
+        if (
+            start == 0
+            or end == len(body)
+            or body[start - 1] in _CSS_DELIMITERS
+            or body[end] in _CSS_DELIMITERS
+        ):
+            return b""
+        return b" "
+
+    return _CSS_TOKENS.sub(replace, body)
+
+
+@register(
+    "application/ecmascript",
+    "application/javascript",
+    "application/x-javascript",
+    "text/javascript",
+)
+def minify_js(body):
+    # Strips the indentation and drops empty lines and line comments. The
+    # line breaks are kept as automatic semicolon insertion relies on them.
+    if b"`" in body or re.search(rb"\\\r?\n", body):
+        raise ValueError("Strings spanning several lines")
+    lines = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line or (line.startswith(b"//") and b"*/" not in line):
+            continue
+        lines.append(line)
+    return b"\n".join(lines)
+
+
+@register("text/html")
+def minify_html(body):
+    def replace(match):
+        if match.group("raw") is not None:
+            return match.group("raw")
+        if match.group("style") is not None:
+            return b"".join(
+                (
+                    match.group("style"),
+                    minify_css(match.group("css")),
+                    match.group("end"),
+                )
+            )
+        if match.group("comment") is not None:
+            return b""
+        if match.group("tag") is not None:
+            return match.group("tag")
+        return b"\n" if b"\n" in match.group("space") else b" "
+
+    return _HTML_TOKENS.sub(replace, body)
+
+
+@register("application/json")
+def minify_json(body):
+    # Only the whitespace between the tokens is removed, re-serializing the
+    # parsed body could change numbers and duplicate keys
+    json.loads(body.decode("utf-8"))
+    return _JSON_TOKENS.sub(lambda m: m.group(1) or b"", body)
+
+
+class MinificationStats(object):
+    """Counts the minified bodies of each media type along with the
+    number of bytes that have been saved.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+
+    def record(self, media_type, size, minified_size):
+        with self._lock:
+            counts = self._types.setdefault(
+                media_type, dict(responses=0, size=0, bytes_saved=0)
+            )
+            counts["responses"] += 1
+            counts["size"] += size
+            counts["bytes_saved"] += size - minified_size
+
+    def stats(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._types.items()}
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.pool
+    ~~~~~~~~~~~~~~~
+
+    This module contains a pool of persistent connections which
+    can be shared between the request handlers.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+import os
+import select
+import threading
+import time
+
+from stegoproxy.connection import Server
+from stegoproxy.exceptions import PoolExhausted
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of keep-alive connections.
+
+    Connections are kept per ``(host, port)`` and are handed out again
+    after they have been released. Idle connections are health checked
+    before they are reused and get evicted after ``idle_timeout`` seconds
+    or after the timeout they have been released with, whichever is
+    shorter.
+
+    :param maxsize: The maximum number of connections (idle and in use)
+                    per host.
+    :param idle_timeout: The number of seconds an idle connection is kept.
+    :param block_timeout: The number of seconds to wait for a connection if
+                          ``maxsize`` connections are in use. ``None``
+                          waits forever.
+    :param read_timeout: The number of seconds to wait for data from a
+                         host. ``None`` waits forever.
+    """
+
+    def __init__(
+        self,
+        maxsize=10,
+        idle_timeout=10,
+        block_timeout=None,
+        read_timeout=None,
+    ):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.block_timeout = block_timeout
+        self.read_timeout = read_timeout
+        self._reset()
+
+    def _reset(self):
+        # The pool must not be shared with a forked child process
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = {}  # (host, port) -> [(connection, expires), ...]
+        self._open = {}  # (host, port) -> number of open connections
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _is_usable(self, conn, expires, now):
+        if conn.closed or now > expires:
+            return False
+        # An idle connection must not be readable; if it is, the peer
+        # has either closed it or sent something we didn't ask for.
+        try:
+            r, _, _ = select.select([conn.conn], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not r
+
+    def _discard(self, key, conn):
+        # must be called with the lock held
+        conn.close()
+        self._open[key] -= 1
+        self._cond.notify()
+
+    def _evict_idle(self, now):
+        # must be called with the lock held
+        for key, idle in self._idle.items():
+            for entry in [e for e in idle if now > e[1]]:
+                idle.remove(entry)
+                log.debug("Evicting idle connection to %s:%s", *key)
+                self._discard(key, entry[0])
+
+    def _connect(self, key):
+        try:
+            conn = Server(host=key[0], port=key[1], timeout=self.read_timeout)
+        except Exception:
+            with self._cond:
+                self._open[key] -= 1
+                self._cond.notify()
+            raise
+        conn.pool_key = key
+        conn.reused = False
+        return conn
+
+    def acquire(self, host, port):
+        """Returns a connection to the given host. If there is a healthy
+        idle connection it is reused, otherwise a new one is opened.
+        """
+        key = (host, int(port))
+        deadline = None
+        if self.block_timeout is not None:
+            deadline = time.time() + self.block_timeout
+
+        with self._cond:
+            self._check_pid()
+            idle = self._idle.setdefault(key, [])
+            while True:
+                now = time.time()
+                self._evict_idle(now)
+                while idle:
+                    # most recently used first - it's the least likely
+                    # to be closed by the peer
+                    conn, expires = idle.pop()
+                    if self._is_usable(conn, expires, now):
+                        conn.reused = True
+                        log.debug("Reusing connection to %s:%s", *key)
+                        return conn
+                    log.debug("Discarding stale connection to %s:%s", *key)
+                    self._discard(key, conn)
+
+                if self._open.get(key, 0) < self.maxsize:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhausted(
+                        "No connection to %s:%s available." % key
+                    )
+                self._cond.wait(remaining)
+
+        log.debug("Opening new connection to %s:%s", *key)
+        return self._connect(key)
+
+    def release(self, conn, reusable=True, timeout=None):
+        """Puts a connection back into the pool. If ``reusable`` is
+        ``False`` the connection is closed instead.
+
+        :param timeout: The number of seconds the peer keeps this
+                        connection open, e.g. from a ``Keep-Alive`` header.
+        """
+        key = conn.pool_key
+        if timeout is None or timeout > self.idle_timeout:
+            timeout = self.idle_timeout
+        with self._cond:
+            if self._pid != os.getpid():
+                conn.close()
+                return
+            if not reusable or conn.closed or timeout <= 0:
+                self._discard(key, conn)
+                return
+            expires = time.time() + timeout
+            self._idle.setdefault(key, []).append((conn, expires))
+            self._cond.notify()
+
+    def prewarm(self, host, port, count):
+        """Opens up to ``count`` connections to the given host in the
+        background so that the first requests don't have to wait for the
+        connection setup.
+        """
+
+        def warm():
+            conns = []
+            for _ in range(count):
+                with self._cond:
+                    self._check_pid()
+                    if self._open.get(key, 0) >= self.maxsize:
+                        break
+                    self._open[key] = self._open.get(key, 0) + 1
+                try:
+                    conns.append(self._connect(key))
+                except Exception as e:
+                    log.warning("Couldn't prewarm connection: %s", e)
+                    break
+            for conn in conns:
+                self.release(conn)
+            log.debug("Prewarmed %d connections to %s:%s", len(conns), *key)
+
+        key = (host, int(port))
+        t = threading.Thread(target=warm)
+        t.daemon = True
+        t.start()
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._cond:
+            for key, idle in self._idle.items():
+                while idle:
+                    conn, _ = idle.pop()
+                    self._discard(key, conn)
+
+    def stats(self):
+        """Returns the number of open and idle connections per host."""
+        with self._cond:
+            return {
+                "%s:%s" % key: {
+                    "open": count,
+                    "idle": len(self._idle.get(key, [])),
+                }
+                for key, count in self._open.items()
+            }
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.prefetch
+    ~~~~~~~~~~~~~~~~~~~
+
+    This module contains the parts of the subresource prefetching. The
+    stegoserver finds the stylesheets, scripts and images of an HTML page,
+    fetches them and sends them right after the page as a bundle. The
+    stegoclient puts them into its cache, where the requests of the
+    browser find them.
+
+    A bundle is a sequence of length-prefixed messages. The first one is
+    the list of the bundled URLs, each further one is the request that
+    has been sent for a URL followed by its response, in the same order.
+    An empty message means that the URL couldn't be bundled.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+import struct
+import threading
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+log = logging.getLogger(__name__)
+# Sent by the stegoclient with a request if it accepts a bundle
+PREFETCH_HEADER = "X-Stego-Prefetch"
+# Marks a response that is followed by a bundle. The response must have
+# a Content-Length so that the bundle can be told apart from the body.
+BUNDLE_HEADER = "X-Stego-Bundle"
+_LENGTH = struct.Struct("!I")
+
+
+class SubresourceParser(HTMLParser):
+    """Collects the URLs of the subresources an HTML page loads right
+    away, in the order they appear in.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        url = None
+        if tag == "link":
+            rel = (attrs.get("rel") or "").lower().split()
+            if "stylesheet" in rel or "icon" in rel or "preload" in rel:
+                url = attrs.get("href")
+        elif tag in ("script", "img", "input"):
+            if tag != "input" or (attrs.get("type") or "").lower() == "image":
+                url = attrs.get("src")
+        if url and url.strip():
+            self.urls.append(url.strip())
+
+
+def find_subresources(html, base_url, max_resources):
+    """Returns the URLs of the subresources of an HTML page that are on
+    the same origin as the page.
+
+    :param html: The HTML page as bytes.
+    :param base_url: The absolute URL of the page.
+    :param max_resources: The maximum number of URLs to return.
+    """
+    parser = SubresourceParser()
+    try:
+        parser.feed(html.decode("utf-8", "replace"))
+        parser.close()
+    except Exception as e:
+        log.debug(f"Couldn't parse {base_url}: {e}")
+
+    origin = urlsplit(base_url)
+    urls = []
+    for url in parser.urls:
+        u = urlsplit(urljoin(base_url, url))
+        if u.scheme != origin.scheme or u.netloc != origin.netloc:
+            continue
+        url = urlunsplit((u.scheme, u.netloc, u.path or "/", u.query, ""))
+        if url != base_url and url not in urls:
+            urls.append(url)
+        if len(urls) >= max_resources:
+            break
+    return urls
+
+
+def pack_message(message):
+    """Returns a message of a bundle with its length prefix."""
+    return _LENGTH.pack(len(message)) + message
+
+
+class BundleParser(object):
+    """Parses the messages of a bundle while it is arriving."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Adds data and returns the list of messages that are complete."""
+        self._buffer += data
+        messages = []
+        offset = 0
+        while len(self._buffer) - offset >= _LENGTH.size:
+            (length,) = _LENGTH.unpack_from(self._buffer, offset)
+            end = offset + _LENGTH.size + length
+            if end > len(self._buffer):
+                break
+            messages.append(bytes(self._buffer[offset + _LENGTH.size : end]))
+            offset = end
+        del self._buffer[:offset]
+        return messages
+
+
+class PieceReader(object):
+    """A file-like object that reads from an iterable of byte strings."""
+
+    def __init__(self, pieces):
+        self._pieces = iter(pieces)
+        self._buffer = bytearray()
+
+    def read(self, amt=None):
+        """Reads up to ``amt`` bytes. Like a socket, it returns what is
+        there as soon as there is something, an empty string means EOF.
+        """
+        if amt is None:
+            data = bytes(self._buffer) + b"".join(self._pieces)
+            del self._buffer[:]
+            return data
+        while not self._buffer:
+            try:
+                self._buffer += next(self._pieces)
+            except StopIteration:
+                break
+        data = bytes(self._buffer[:amt])
+        del self._buffer[:amt]
+        return data
+
+    # Reads never wait for more than the next piece
+    read1 = read
+
+
+class PendingPushes(object):
+    """The URLs of a bundle whose responses are still arriving. Requests
+    for them wait for the bundle instead of being sent themselves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, urls):
+        with self._lock:
+            for url in urls:
+                self._pending.setdefault(url, threading.Event())
+
+    def done(self, url):
+        with self._lock:
+            event = self._pending.pop(url, None)
+        if event is not None:
+            event.set()
+
+    def wait(self, url, timeout):
+        """Waits until the response for a URL has arrived if it is part of
+        a bundle. Returns ``True`` if there was something to wait for.
+        """
+        with self._lock:
+            event = self._pending.get(url)
+        if event is None:
+            return False
+        event.wait(timeout)
+        return True
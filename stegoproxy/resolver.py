@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.resolver
+    ~~~~~~~~~~~~~~~~~~~
+
+    This module contains a caching DNS resolver and a ``create_connection``
+    that races the connection attempts to the resolved addresses
+    ("Happy Eyeballs", RFC 8305).
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import errno
+import logging
+import select
+import socket
+import threading
+import time
+
+from stegoproxy.config import cfg
+
+log = logging.getLogger(__name__)
+
+
+class Resolver(object):
+    """Resolves host names and caches the results.
+
+    :param ttl: The number of seconds a resolved address is cached.
+    :param negative_ttl: The number of seconds a failed lookup is cached.
+    :param maxsize: The maximum number of cached host names.
+    """
+
+    def __init__(self, ttl=60, negative_ttl=5, maxsize=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._cache = {}  # (host, port) -> (expires, addrinfos or error)
+
+    def resolve(self, host, port):
+        """Returns the ``getaddrinfo`` results for a TCP connection to the
+        given host and port.
+        """
+        key = (host, port)
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None and entry[0] > now:
+            if isinstance(entry[1], Exception):
+                raise entry[1]
+            return entry[1]
+
+        try:
+            result = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            expires = now + self.ttl
+        except socket.gaierror as e:
+            result = e
+            expires = now + self.negative_ttl
+
+        with self._lock:
+            self._cache.pop(key, None)
+            while len(self._cache) >= self.maxsize:
+                # dicts are ordered - the first entry is the oldest one
+                del self._cache[next(iter(self._cache))]
+            self._cache[key] = (expires, result)
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def invalidate(self, host, port):
+        """Removes a host from the cache."""
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+    def clear(self):
+        """Removes all hosts from the cache."""
+        with self._lock:
+            self._cache.clear()
+
+
+def interleave_addrinfos(addrinfos):
+    """Reorders the addresses so that the address families alternate,
+    starting with the family of the first address.
+    """
+    if not addrinfos:
+        return []
+
+    first_family = addrinfos[0][0]
+    first = [a for a in addrinfos if a[0] == first_family]
+    other = [a for a in addrinfos if a[0] != first_family]
+    result = []
+    for i in range(max(len(first), len(other))):
+        result.extend(a[i] for a in (first, other) if i < len(a))
+    return result
+
+
+def _connect_error(err, sockaddr):
+    return OSError(err, "%s: %s" % (sockaddr, errno.errorcode.get(err, err)))
+
+
+def create_connection(address, timeout=None, delay=None, resolver=None):
+    """Connects to a TCP service and returns the socket.
+
+    Unlike :func:`socket.create_connection` the next address is tried
+    after ``delay`` seconds already, while the previous attempts are still
+    pending. The first attempt that succeeds wins.
+
+    :param address: A ``(host, port)`` tuple.
+    :param timeout: The number of seconds to wait for a connection. Like
+                    with :func:`socket.create_connection` it stays the
+                    timeout of the socket.
+    :param delay: The number of seconds to wait before the next address is
+                  tried. Defaults to ``cfg.HAPPY_EYEBALLS_DELAY``.
+    :param resolver: The resolver to use. Defaults to the shared resolver.
+    """
+    host, port = address
+    if delay is None:
+        delay = cfg.HAPPY_EYEBALLS_DELAY
+    if resolver is None:
+        resolver = shared_resolver
+
+    addrinfos = interleave_addrinfos(resolver.resolve(host, port))
+    deadline = time.time() + timeout if timeout is not None else None
+    pending = {}
+    errors = []
+    next_attempt = 0
+
+    try:
+        while addrinfos or pending:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                errors.append(socket.timeout("timed out"))
+                break
+
+            if addrinfos and (not pending or now >= next_attempt):
+                family, type_, proto, _, sockaddr = addrinfos.pop(0)
+                sock = socket.socket(family, type_, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(sockaddr)
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    pending[sock] = sockaddr
+                    next_attempt = now + delay
+                else:
+                    errors.append(_connect_error(err, sockaddr))
+                    sock.close()
+                continue
+
+            waits = [next_attempt - now] if addrinfos else []
+            if deadline is not None:
+                waits.append(deadline - now)
+            wait = max(min(waits), 0) if waits else None
+            socks = list(pending)
+            _, writable, _ = select.select([], socks, socks, wait)
+
+            for sock in writable:
+                sockaddr = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    sock.settimeout(timeout)
+                    log.debug("Connected to %s via %s", host, sockaddr)
+                    return sock
+
+                errors.append(_connect_error(err, sockaddr))
+                sock.close()
+                # don't wait for the delay if an attempt failed
+                next_attempt = 0
+    finally:
+        for sock in pending:
+            sock.close()
+
+    # The cached addresses might be outdated
+    resolver.invalidate(host, port)
+    if errors:
+        raise errors[-1]
+    raise OSError("getaddrinfo returns an empty list")
+
+
+shared_resolver = Resolver(ttl=cfg.DNS_CACHE_TTL)
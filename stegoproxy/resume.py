@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.resume
+    ~~~~~~~~~~~~~~~~~
+
+    This module contains the transfers that make chunked stego-responses
+    resumable. The chunks of a transfer are numbered in the order they
+    are embedded, starting with 0. The stegoserver keeps the last chunks
+    it has embedded for a while, along with the rest of the response from
+    the website, and announces the transfer at the beginning of the first
+    chunk.
+
+    If the connection to the stegoserver breaks, the stegoclient sends a
+    resume request with the transfer and the number of the first chunk it
+    is missing over another connection. The stegoserver sends the chunks
+    it has embedded already again and embeds the rest of the response as
+    usual, so nothing is embedded twice.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+# Marks a stego-message as a resume request. A plain request always starts
+# with the request line so it can't be mistaken for one.
+RESUME_MAGIC = b"\x00STEGORESUME\x00"
+# Announces a resumable transfer at the beginning of its first chunk
+TRANSFER_MAGIC = b"\x00STEGOTRANSFER\x00"
+_ID_SIZE = 16
+_RESUME = struct.Struct(f"!{_ID_SIZE}sI")
+
+
+def is_resume(data):
+    """Checks if an extracted stego-message is a resume request."""
+    return data.startswith(RESUME_MAGIC)
+
+
+def pack_resume(transfer_id, seq):
+    """Packs a request to resume a transfer from the chunk ``seq`` on."""
+    return RESUME_MAGIC + _RESUME.pack(bytes.fromhex(transfer_id), seq)
+
+
+def unpack_resume(data):
+    """Returns the transfer and the number of the first chunk from a
+    resume request.
+    """
+    if not is_resume(data) or len(data) != len(RESUME_MAGIC) + _RESUME.size:
+        raise ValueError("Not a resume request.")
+    transfer_id, seq = _RESUME.unpack_from(data, len(RESUME_MAGIC))
+    return transfer_id.hex(), seq
+
+
+def announce_transfer(transfer_id):
+    """Returns the announcement of a transfer."""
+    return TRANSFER_MAGIC + bytes.fromhex(transfer_id)
+
+
+def parse_announcement(message):
+    """Returns the transfer announced at the beginning of the message
+    extracted from the first chunk, or ``None``, and the rest of the
+    message.
+    """
+    if not message.startswith(TRANSFER_MAGIC):
+        return None, message
+    end = len(TRANSFER_MAGIC) + _ID_SIZE
+    if len(message) < end:
+        raise ValueError("Truncated transfer announcement.")
+    return message[len(TRANSFER_MAGIC) : end].hex(), message[end:]
+
+
+class Transfer(object):
+    """A chunked stego-response. A resumable transfer keeps the last
+    chunks that have been embedded, up to ``window`` bytes, so that they
+    can be sent again.
+
+    The handler that sends the transfer holds its ``lock``.
+
+    :param window: The number of bytes of chunks that are kept. A
+                   transfer without a window can't be resumed.
+    """
+
+    def __init__(self, window=0):
+        self.id = os.urandom(_ID_SIZE).hex()
+        self.window = window
+        self.lock = threading.Lock()
+        #: The slices of the response that haven't been embedded yet
+        self.source = None
+        self.cover = None
+        #: Whether the last chunk has been embedded
+        self.complete = False
+        self.next_seq = 0
+        self.size = 0
+        self.last_used = time.time()
+        self._chunks = OrderedDict()  # seq -> stego medium
+        self._close = None
+
+    @property
+    def resumable(self):
+        return self.window > 0
+
+    def start(self, source, cover, close):
+        """Sets the response the chunks are embedded from.
+
+        :param source: An iterator of the slices of the response.
+        :param cover: The cover object the slices are embedded in.
+        :param close: Called with whether the whole response has been
+                      read once the transfer is complete or closed.
+        """
+        self.source = source
+        self.cover = cover
+        self._close = close
+
+    def add(self, chunk):
+        """Adds an embedded chunk and returns its sequence number."""
+        seq = self.next_seq
+        self.next_seq += 1
+        if self.resumable:
+            self._chunks[seq] = chunk
+            self.size += len(chunk)
+            while self.size > self.window and len(self._chunks) > 1:
+                _, dropped = self._chunks.popitem(last=False)
+                self.size -= len(dropped)
+        return seq
+
+    def can_resume(self, seq):
+        """Checks if the transfer can be sent from the chunk ``seq`` on."""
+        first = next(iter(self._chunks), self.next_seq)
+        return first <= seq <= self.next_seq
+
+    def get(self, seq):
+        return self._chunks[seq]
+
+    def finish(self):
+        """Marks the transfer as complete once the last chunk has been
+        embedded. The chunks are kept.
+        """
+        self.complete = True
+        self._release()
+
+    def close(self):
+        self._release()
+        self._chunks.clear()
+        self.size = 0
+
+    def _release(self):
+        close, self._close = self._close, None
+        if close is not None:
+            close(self.complete)
+
+
+class TransferCache(object):
+    """Keeps the resumable transfers for ``ttl`` seconds after they have
+    been sent or their connection broke. At most ``max_transfers`` are
+    kept, the least recently used ones are closed first. Transfers that
+    are being sent are never closed.
+    """
+
+    def __init__(self, max_transfers, ttl):
+        self.max_transfers = max_transfers
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._transfers = OrderedDict()  # id -> transfer
+        self._stats = dict(transfers=0, resumed=0, chunks_resent=0)
+
+    def add(self, transfer):
+        """Adds a transfer that is locked by the handler sending it."""
+        with self._lock:
+            self._transfers[transfer.id] = transfer
+            self._stats["transfers"] += 1
+            dropped = self._evict(time.time())
+        self._close(dropped)
+
+    def acquire(self, transfer_id, timeout):
+        """Returns a transfer once it isn't sent by another handler any
+        more, or ``None`` if there is no such transfer.
+        """
+        with self._lock:
+            dropped = self._evict(time.time())
+            transfer = self._transfers.get(transfer_id)
+        self._close(dropped)
+        if transfer is None or not transfer.lock.acquire(timeout=timeout):
+            return None
+        with self._lock:
+            if self._transfers.get(transfer_id) is not transfer:
+                # Closed while it was waiting
+                transfer.lock.release()
+                return None
+            self._transfers.move_to_end(transfer_id)
+        return transfer
+
+    def release(self, transfer, keep=True):
+        """Releases a transfer after it has been sent. It is closed unless
+        it is kept to be resumed.
+        """
+        transfer.last_used = time.time()
+        if not keep:
+            with self._lock:
+                self._transfers.pop(transfer.id, None)
+            transfer.close()
+        transfer.lock.release()
+        if keep:
+            # Transfers that aren't used again are closed in time
+            timer = threading.Timer(self.ttl + 1, self._expire)
+            timer.daemon = True
+            timer.start()
+
+    def record_resume(self, chunks):
+        """Counts a resumed transfer that has sent ``chunks`` chunks
+        again.
+        """
+        with self._lock:
+            self._stats["resumed"] += 1
+            self._stats["chunks_resent"] += chunks
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["kept"] = len(self._transfers)
+            stats["size"] = sum(t.size for t in self._transfers.values())
+        return stats
+
+    def _evict(self, now):
+        """Removes the expired transfers and the least recently used ones
+        beyond ``max_transfers``. Returns them locked.
+        """
+        dropped = []
+        excess = len(self._transfers) - self.max_transfers
+        for transfer_id, transfer in list(self._transfers.items()):
+            expired = now > transfer.last_used + self.ttl
+            if not expired and excess <= 0:
+                continue
+            if not transfer.lock.acquire(blocking=False):
+                continue
+            del self._transfers[transfer_id]
+            dropped.append(transfer)
+            excess -= 1
+        return dropped
+
+    def _close(self, transfers):
+        for transfer in transfers:
+            log.debug(f"Closing transfer {transfer.id}")
+            transfer.close()
+            transfer.lock.release()
+
+    def _expire(self):
+        with self._lock:
+            dropped = self._evict(time.time())
+        self._close(dropped)
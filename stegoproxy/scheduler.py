@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.scheduler
+    ~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the scheduler that decides how big the chunks
+    of a chunked stego-response are.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import itertools
+
+RAMP_POLICIES = ("none", "linear", "exponential")
+
+
+class ChunkScheduler(object):
+    """Yields the sizes of the chunks of a stego-response.
+
+    The first chunk carries the header of the response the browser is
+    waiting for. Keeping it small makes it cheap to embed, and the
+    following chunks grow until they use the whole capacity of a cover.
+
+    :param max_size: The maximum size of a chunk.
+    :param policy: ``"none"`` sends every chunk with ``max_size``,
+                   ``"linear"`` grows the chunks by ``start * factor`` and
+                   ``"exponential"`` multiplies them by ``factor``.
+    :param start: The size of the first chunk.
+    :param factor: How fast the chunks grow.
+    """
+
+    def __init__(self, max_size, policy="exponential", start=8192, factor=2):
+        if policy not in RAMP_POLICIES:
+            raise ValueError("Unknown ramp policy %r" % policy)
+        if policy == "exponential" and factor <= 1:
+            raise ValueError("An exponential ramp needs a factor above 1")
+        if policy == "linear" and factor <= 0:
+            raise ValueError("A linear ramp needs a factor above 0")
+        self.max_size = max_size
+        self.policy = policy
+        self.start = max(1, min(start, max_size))
+        self.factor = factor
+
+    def __iter__(self):
+        if self.policy == "none":
+            return itertools.repeat(self.max_size)
+        return self._ramp()
+
+    def _ramp(self):
+        size = self.start
+        while size < self.max_size:
+            yield size
+            if self.policy == "linear":
+                size += int(self.start * self.factor)
+            else:
+                size = int(size * self.factor)
+        while True:
+            yield self.max_size
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.singleflight
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module collapses identical requests that are in flight at the
+    same time into one. The first request does the work, the others wait
+    for it and get its result.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+# Headers that describe the connection rather than the request
+_HOP_BY_HOP = (
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+)
+
+
+def request_key(method, url, headers):
+    """Returns the key of a request, which is the same for identical
+    requests, or ``None`` if the request must not be coalesced. Only
+    requests of safe methods without a body are coalesced.
+    """
+    if method not in ("GET", "HEAD"):
+        return None
+    if "Transfer-Encoding" in headers or int(
+        headers.get("Content-Length") or 0
+    ):
+        return None
+
+    ignored = set(_HOP_BY_HOP)
+    for name in headers.get("Connection", "").split(","):
+        ignored.add(name.strip().lower())
+    fields = sorted(
+        (name.lower(), " ".join(value.split()))
+        for name, value in headers.items()
+        if name.lower() not in ignored
+    )
+    return method, url, tuple(fields)
+
+
+class _Call(object):
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        self.done = threading.Event()
+
+
+class Group(object):
+    """A group of calls that are coalesced by their key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._coalesced = 0
+
+    def do(self, key, fn):
+        """Calls ``fn`` and returns its result, unless a call with the same
+        key is already in flight. In that case the result (or exception)
+        of that call is waited for instead.
+
+        Returns the result and whether it is shared with another call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self._coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.waiters:
+                log.debug(f"Shared the result with {call.waiters} waiters")
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        """Returns the number of calls in flight and the number of calls
+        that got the result of another one.
+        """
+        with self._lock:
+            return dict(in_flight=len(self._calls), coalesced=self._coalesced)
@@ -10,50 +10,447 @@
     :license: GPLv3, see LICENSE for more details.
 """
 import io
+import itertools
+import json
 import logging
+import threading
 import time
 from email.message import Message
+from http.client import HTTPException, parse_headers
+from urllib.parse import urlsplit
 
 from stegoproxy import stego
+from stegoproxy.batch import (
+    RequestBatcher,
+    is_unbatched,
+    pack_batch,
+    unpack_batch,
+)
+from stegoproxy.cache import HTTPCache
+from stegoproxy.compression import (
+    DECODABLE_CODINGS,
+    STEGO_ENCODING_HEADER,
+    CompressionStats,
+    accepts_encoding,
+    decode,
+    iter_decoded,
+    parse_stego_encoding,
+    widen_accept_encoding,
+)
 from stegoproxy.config import cfg
 from stegoproxy.connection import Client, Server
-from stegoproxy.exceptions import MessageToLong
-from stegoproxy.handler import BaseProxyHandler, StegoHTTPResponse
+from stegoproxy.delta import (
+    DELTA_BASE_HEADER,
+    DELTA_HEADER,
+    DeltaStore,
+    apply_delta,
+)
+from stegoproxy.exceptions import TunnelClosed
+from stegoproxy.handler import (
+    END_OF_HEADERS,
+    IDEMPOTENT_METHODS,
+    BaseProxyHandler,
+    StegoHTTPResponse,
+)
+from stegoproxy.pool import ConnectionPool
+from stegoproxy.prefetch import (
+    BUNDLE_HEADER,
+    PREFETCH_HEADER,
+    BundleParser,
+    PendingPushes,
+)
+from stegoproxy.resume import pack_resume, parse_announcement
+from stegoproxy.scheduler import ChunkScheduler
+from stegoproxy.singleflight import Group, request_key
+from stegoproxy.tunnel import TUNNEL_MAGIC, Session, splice
 
 log = logging.getLogger(__name__)
+_pool_lock = threading.Lock()
+# Guards the tunnels and is notified once a tunnel has been opened
+_tunnel_lock = threading.Condition()
 
 
 class ClientProxyHandler(BaseProxyHandler):
+    # The browser sends further requests over the same connection. Close it
+    # after a while if it is idle so that it doesn't tie up a handler.
+    timeout = cfg.KEEP_ALIVE_TIMEOUT
+
+    #: Keep-alive connections to the stegoserver shared by all handlers
+    pool = None
+    #: Collects the small requests of all handlers into batches
+    batcher = None
+    #: Multiplexed tunnels to the stegoserver shared by all handlers
+    tunnels = []
+    #: The number of tunnels that are being opened
+    opening_tunnels = 0
+    #: Responses that are answered without going through the stego channel
+    cache = None
+    #: Identical requests of all handlers that are in flight
+    flights = Group()
+    #: Subresources that are on their way in a bundle
+    pushes = PendingPushes()
+    #: The last version of the responses, later ones may come as deltas
+    delta_store = None
+    #: The responses that have been decompressed
+    compression_stats = CompressionStats()
+
     def __init__(self, request, client_address, server):
+        # The cached response of the current request
+        self.cached = None
+        self.revalidating = False
+        self.request_time = None
+        # The response that is shared with identical requests
+        self.sharing = False
+        self.shared_response = None
+        # The version of the response the stegoserver may send a delta to
+        self.delta_base = None
+        # The Accept-Encoding header of the browser
+        self.accept_encoding = None
+        # The stego-response that is being received, it changes when the
+        # transfer is resumed over another connection
+        self.stego_response = None
         BaseProxyHandler.__init__(self, request, client_address, server)
 
+    @classmethod
+    def _get_pool(cls):
+        with _pool_lock:
+            if cls.pool is None:
+                cls.pool = ConnectionPool(
+                    maxsize=cfg.POOL_MAXSIZE,
+                    idle_timeout=cfg.POOL_IDLE_TIMEOUT,
+                    block_timeout=cfg.POOL_BLOCK_TIMEOUT,
+                    read_timeout=cfg.READ_TIMEOUT,
+                )
+                if cfg.POOL_PREWARM:
+                    cls.pool.prewarm(*cfg.REMOTE_ADDR, cfg.POOL_PREWARM)
+        return cls.pool
+
+    @classmethod
+    def _get_cache(cls):
+        with _pool_lock:
+            if cls.cache is None and cfg.CACHE_ENABLED:
+                cls.cache = HTTPCache(
+                    max_size=cfg.CACHE_MAX_SIZE,
+                    max_entry_size=cfg.CACHE_MAX_ENTRY_SIZE,
+                    directory=cfg.CACHE_DIR,
+                    disk_max_size=cfg.CACHE_DISK_MAX_SIZE,
+                    heuristic_max=cfg.CACHE_HEURISTIC_MAX,
+                )
+        return cls.cache
+
+    @classmethod
+    def _get_delta_store(cls):
+        with _pool_lock:
+            if cls.delta_store is None and cfg.DELTA:
+                cls.delta_store = DeltaStore(cfg.DELTA_STORE_MAX_SIZE)
+        return cls.delta_store
+
+    @classmethod
+    def _get_batcher(cls, max_size):
+        with _pool_lock:
+            if cls.batcher is None:
+                cls.batcher = RequestBatcher(
+                    window=cfg.BATCH_WINDOW,
+                    max_size=max_size,
+                    max_requests=cfg.BATCH_MAX_REQUESTS,
+                )
+        return cls.batcher
+
     def _connect_to_host(self):
         self.hostname = cfg.REMOTE_ADDR[0]
         self.port = cfg.REMOTE_ADDR[1]
         self.remote_path = f"http://{self.hostname}:{self.port}/"
-        # establish connection to the stegoserver
-        log.info(f"Connecting to stegoserver on {self.hostname}:{self.port}")
-        self.server = Server(host=self.hostname, port=int(self.port))
         self.client = Client(self.connection)  # reusing the connection here
 
+    def _send_to_stegoserver(
+        self, req_to_server, stego_chunks=None, idempotent=None
+    ):
+        """Sends the stego-request to the stegoserver and returns the
+        response. A reused connection might have been closed by the
+        stegoserver while it was idle, in which case the request is sent
+        again over another connection. A request that has been written
+        completely is only sent again if it is idempotent, the stegoserver
+        might have relayed it already.
+
+        :param req_to_server: The stego-request or, if the stego-request
+                              is chunked, its header.
+        :param stego_chunks: An iterable of the stego media that are sent
+                             as the chunks of a chunked stego-request.
+        :param idempotent: Whether the request may be sent again. Defaults
+                           to whether the method of the request is
+                           idempotent.
+        """
+        if idempotent is None:
+            idempotent = self.command in IDEMPOTENT_METHODS
+        # get a (possibly already established) connection to the stegoserver
+        log.debug(f"Connecting to stegoserver on {self.hostname}:{self.port}")
+        self.server = self._get_pool().acquire(self.hostname, self.port)
+        while True:
+            sent_chunks = written = False
+            try:
+                self.server.conn.sendall(req_to_server)
+                if stego_chunks is not None:
+                    start = time.time()
+                    for chunk_count, chunk in enumerate(stego_chunks, 1):
+                        sent_chunks = True
+                        log.debug(
+                            f"Sending chunk with size: {len(chunk)} bytes"
+                        )
+                        self.server.conn.sendall(
+                            b"%X\r\n%s\r\n" % (len(chunk), chunk)
+                        )
+                    self.server.conn.sendall(b"0\r\n\r\n")
+                    log.debug(
+                        f"{chunk_count} chunks sent in "
+                        f"{time.time() - start:.2f}s."
+                    )
+                written = True
+                h = StegoHTTPResponse(self.server.conn)
+                h.begin()
+                return h
+            except ConnectionError:
+                reused = self.server.reused
+                self.pool.release(self.server, reusable=False)
+                # The body of a chunked stego-request has already been read
+                # from the browser, it can't be sent again. A request that
+                # has been written completely might have been relayed.
+                if not reused or sent_chunks or (written and not idempotent):
+                    raise
+                log.debug("Stale connection to stegoserver, retrying")
+                self.server = self.pool.acquire(self.hostname, self.port)
+
+    def _open_tunnel(self):
+        """Opens a tunnel to the stegoserver. The stego-request that
+        carries the tunnel is sent chunk by chunk while the tunnel is open,
+        and so is the stego-response.
+        """
+        log.debug(f"Opening tunnel to stegoserver on {self.remote_path}")
+        # The socket doesn't time out, the session closes a tunnel that is
+        # idle for too long itself
+        conn = Server(host=self.hostname, port=self.port)
+        header = Message()
+        header.add_header("Host", f"{cfg.REMOTE_ADDR[0]}:{cfg.REMOTE_ADDR[1]}")
+        header.add_header("Connection", "keep-alive")
+        header.add_header("Transfer-Encoding", "chunked")
+        conn.sendall(
+            self._build_request_header(
+                cfg.STEGO_HTTP_COMMAND,
+                cfg.STEGO_HTTP_PATH,
+                cfg.STEGO_HTTP_VERSION,
+                header,
+            )
+        )
+
+        cover = self._get_cover_object()
+        # The first stego medium tells the stegoserver that this is a tunnel
+        prefix = [TUNNEL_MAGIC]
+        max_payload = self._calc_max_size(cover) // 4 * 3 - len(TUNNEL_MAGIC)
+
+        def send_payload(payload):
+            if prefix:
+                payload = prefix.pop() + payload
+            message = self._encode(payload)
+            medium = stego.embed(
+                cover=self._crop_cover(cover, len(message)), message=message
+            )
+            conn.sendall(b"%X\r\n%s\r\n" % (len(medium), medium))
+
+        def on_close():
+            conn.sendall(b"0\r\n\r\n")
+
+        session = Session(
+            send_payload,
+            max_payload,
+            client=True,
+            window=cfg.TUNNEL_WINDOW,
+            max_frame=cfg.TUNNEL_MAX_FRAME,
+            idle_timeout=cfg.TUNNEL_IDLE_TIMEOUT,
+            flush_delay=cfg.TUNNEL_FLUSH_DELAY,
+            on_close=on_close,
+            header_table_size=cfg.TUNNEL_HEADER_TABLE_SIZE,
+        )
+
+        def read_loop():
+            try:
+                h = StegoHTTPResponse(conn.conn)
+                h.begin()
+                if h.status != 200:
+                    raise TunnelClosed(
+                        f"The stegoserver refused the tunnel: "
+                        f"{h.status} {h.reason}"
+                    )
+                for message in h.iter_chunks():
+                    session.feed(message)
+                session.terminate(
+                    TunnelClosed("The stegoserver closed the tunnel.")
+                )
+            except Exception as e:
+                session.terminate(e)
+            finally:
+                conn.close()
+                log.debug("Tunnel to stegoserver closed")
+
+        reader = threading.Thread(target=read_loop)
+        reader.daemon = True
+        reader.start()
+        session.start()
+        return session
+
+    def _open_stream(self):
+        """Opens a stream on the tunnel with the fewest streams. Another
+        tunnel is opened if all of them are busy, up to
+        ``cfg.TUNNEL_CONNECTIONS`` tunnels. The tunnels are opened without
+        holding the lock, so the other handlers can use the open ones in
+        the meantime.
+        """
+        cls = type(self)
+        while True:
+            with _tunnel_lock:
+                self.tunnels[:] = [t for t in self.tunnels if not t.closed]
+                session = min(
+                    self.tunnels, key=lambda t: t.active_streams, default=None
+                )
+                room = len(self.tunnels) + cls.opening_tunnels < max(
+                    cfg.TUNNEL_CONNECTIONS, 1
+                )
+                opening = room and (
+                    session is None or session.active_streams > 0
+                )
+                if opening:
+                    cls.opening_tunnels += 1
+                elif session is None:
+                    # Wait for the tunnels that are being opened
+                    _tunnel_lock.wait()
+                    continue
+
+            if opening:
+                session = None
+                try:
+                    session = self._open_tunnel()
+                finally:
+                    with _tunnel_lock:
+                        cls.opening_tunnels -= 1
+                        if session is not None:
+                            self.tunnels.append(session)
+                        _tunnel_lock.notify_all()
+            try:
+                return session.open_stream()
+            except TunnelClosed:
+                # The tunnel has been closed in the meantime
+                continue
+
+    def _send_tunneled(self, request_header, body):
+        """Sends the request over a stream of a tunnel and relays the
+        response.
+        """
+        try:
+            stream = self._open_stream()
+            stream.write_head(request_header)
+            for data in body:
+                stream.write(data)
+            stream.close()
+        except Exception as e:
+            log.error(f"Couldn't reach stegoserver: {e}")
+            self.send_error(502, str(e))
+            return
+
+        try:
+            self._relay_stego_response(stream)
+        except Exception:
+            stream.reset()
+            raise
+
+    def _frame_chunks(self, pieces):
+        """Yields the pieces of a body in chunked transfer-encoding."""
+        for data in pieces:
+            if data:
+                yield b"%X\r\n%s\r\n" % (len(data), data)
+        yield b"0\r\n\r\n"
+
+    def _iter_stego_chunks(self, cover, request_header, body, slice_size):
+        """Splits the request into slices that fit into a cover and yields
+        the stego medium for each of them. The body is read from the
+        browser while the slices are embedded.
+        """
+        sizes = iter(
+            ChunkScheduler(
+                slice_size,
+                policy=cfg.CHUNK_RAMP,
+                start=max(cfg.CHUNK_RAMP_START, len(request_header)),
+                factor=cfg.CHUNK_RAMP_FACTOR,
+            )
+        )
+        buffer = bytearray(request_header)
+        size = next(sizes)
+        for data in itertools.chain(body, [None]):
+            if data is not None:
+                buffer += data
+                if len(buffer) < size:
+                    continue
+
+            # the final slice is whatever is left in the buffer
+            while buffer and (data is None or len(buffer) >= size):
+                message = self._encode(bytes(buffer[:size]))
+                del buffer[:size]
+                size = next(sizes)
+                yield stego.embed(
+                    cover=self._crop_cover(cover, len(message)),
+                    message=message,
+                )
+
     def do_CONNECT(self):
         self.is_connect = True
+        log.info(f"{self.command} {self.path}")
+        # HTTPS tunnels are relayed through a stream of a stego tunnel,
+        # the stegoserver connects to the destination
         try:
-            # Connect to destination first
-            super()._connect_to_host()
+            self._connect_to_host()
+            stream = self._open_stream()
+            header = Message()
+            header.add_header("Host", self.path)
+            stream.write_head(
+                self._build_request_header(
+                    self.command, self.path, self.request_version, header
+                )
+            )
 
-            # If successful, let's do this!
-            self.send_response(200, "Connection Established")
-            self.end_headers()
+            data = b""
+            while END_OF_HEADERS.search(data) is None:
+                piece = stream.read()
+                if not piece:
+                    raise TunnelClosed("Incomplete response from stegoserver.")
+                data += piece
+            version, status, reason, headers, rest = self._parse_response(data)
         except Exception as e:
-            self.send_error(500, str(e))
+            log.error(f"Couldn't open tunnel to {self.path}: {e}")
+            self.send_error(502, str(e))
             return
 
-        log.info(f"{self.command} {self.path}")
+        self.close_connection = True
+        if status != 200:
+            # Relay the error from the stegoserver
+            self.client.sendall(data)
+            for piece in stream:
+                self.client.sendall(piece)
+            return
 
-        self._process_connect()
+        self.send_response(200, "Connection Established")
+        self.end_headers()
+        # A tunnel may be idle for much longer than a keep-alive connection
+        self.connection.settimeout(None)
+        if rest:
+            self.client.sendall(rest)
+        splice(self.connection, stream, cfg.STREAM_BUFFER_SIZE)
 
     def do_COMMAND(self):
+        # Requests to the stegoclient itself instead of a website
+        if not urlsplit(self.path).scheme:
+            if self.path == "/stats":
+                self._send_stats()
+            else:
+                self.send_error(404)
+            return
+
         try:
             # Connect to destination
             self._connect_to_host()
@@ -61,37 +458,376 @@ class ClientProxyHandler(BaseProxyHandler):
             self.send_error(500, str(e))
             return
 
+        # Ask for compressed responses. They are decompressed again if the
+        # browser doesn't accept them.
+        self.accept_encoding = self.headers.get("Accept-Encoding")
+        if cfg.COMPRESSION and "Range" not in self.headers:
+            del self.headers["Accept-Encoding"]
+            self.headers["Accept-Encoding"] = widen_accept_encoding(
+                self.accept_encoding
+            )
+
+        # Identical requests are told apart before the cache adds its
+        # conditional headers
+        key = None
+        if cfg.SINGLEFLIGHT:
+            key = request_key(self.command, self.path, self.headers)
+
+        # Answer from the cache without going through the stego channel
+        self.cached = None
+        self.revalidating = False
+        self.request_time = time.time()
+        has_body = self._is_chunked(self.headers) or int(
+            self.headers.get("Content-Length", 0)
+        )
+        if not has_body and self.pushes.wait(self.path, cfg.PREFETCH_TIMEOUT):
+            log.debug(f"Waited for {self.path} from a bundle")
+        if not has_body and self._lookup_cache():
+            return
+
+        if key is None:
+            self._forward()
+        else:
+            self._forward_coalesced(key)
+
+    def _forward_coalesced(self, key):
+        """Forwards the request unless an identical one is in flight, in
+        which case the response to that one is sent to the browser. If it
+        can't be shared, the request is forwarded after all.
+        """
+        leader = False
+
+        def forward():
+            nonlocal leader
+            leader = True
+            self.sharing = True
+            self.shared_response = None
+            try:
+                self._forward()
+            finally:
+                self.sharing = False
+            return self.shared_response
+
+        try:
+            response, shared = self.flights.do(key, forward)
+        except Exception:
+            if leader:
+                raise
+            response, shared = None, True
+        if not shared:
+            return
+
+        if response is None:
+            log.debug(f"Couldn't share the response for {self.path}")
+            self._forward()
+            return
+        log.debug("Sharing the response of an identical request")
+        self._send_shared(response)
+
+    def _send_shared(self, response):
+        """Sends the response of an identical request to the browser."""
+        status, reason, headers, body = response
+        headers = parse_headers(io.BytesIO(headers.as_bytes()))
+        if status != 304:
+            body = b"".join(self._decode_for_browser(headers, [body]))
+        if self.command == "HEAD" or status < 200 or status in (204, 304):
+            body = b""
+        else:
+            del headers["Content-Length"]
+            headers["Content-Length"] = str(len(body))
+        self.client.sendall(
+            self._build_response(
+                self.request_version, status, reason, headers, body
+            )
+        )
+
+    def _forward(self):
+        """Sends the request through the stego channel and relays the
+        response to the browser.
+        """
+        cover = self._get_cover_object()
+        max_size = self._calc_max_size(cover)
+        # The number of bytes of the request that fit into one stego
+        # medium once they are base64 encoded
+        slice_size = max_size // 4 * 3
+
+        # The stegoclient already answered "Expect: 100-continue" itself
+        del self.headers["Expect"]
+        # Ask for the subresources of a page, they end up in the cache
+        del self.headers[PREFETCH_HEADER]
+        if (
+            cfg.PREFETCH
+            and self.command == "GET"
+            and self._get_cache() is not None
+        ):
+            self.headers[PREFETCH_HEADER] = "1"
+        # Tell the stegoserver which version of the response we have got
+        del self.headers[DELTA_BASE_HEADER]
+        self.delta_base = None
+        store = self._get_delta_store()
+        if (
+            store is not None
+            and self.command == "GET"
+            and "Range" not in self.headers
+        ):
+            self.delta_base = store.get(self.path)
+            if self.delta_base is not None:
+                self.headers[DELTA_BASE_HEADER] = self.delta_base[0]
+        chunked = self._is_chunked(self.headers)
+        body = self._iter_request_body()
+        request_body = bytearray()
+        if chunked:
+            # The length of a chunked body is unknown - buffer it as long
+            # as it might still fit into a single cover
+            for data in body:
+                request_body += data
+                if len(request_body) > slice_size:
+                    break
+            else:
+                # The whole body is sent at once
+                del self.headers["Transfer-Encoding"]
+                self.headers["Content-Length"] = str(len(request_body))
+                chunked = False
+
         # Build request for destination
         # [Browser] <--> StegoClient <--> StegoServer <--> [Website]
-        stego_req = self._build_stego_request(
-            self.command,
-            self.path,
-            self.request_version,
-            self.headers,
-            self.rfile.read(int(self.headers.get("Content-Length", 0))),
+        request_header = self._build_request_header(
+            self.command, self.path, self.request_version, self.headers
+        )
+        length = len(request_header) + int(
+            self.headers.get("Content-Length", 0)
         )
 
+        if cfg.TUNNEL:
+            body = itertools.chain([bytes(request_body)], body)
+            if chunked:
+                body = self._frame_chunks(body)
+            self._send_tunneled(request_header, body)
+            return
+
+        # Small requests are sent together with other small requests
+        if (
+            cfg.BATCH_WINDOW > 0
+            and self.command in ("GET", "HEAD")
+            and not chunked
+            and length <= min(cfg.BATCH_MAX_SIZE, slice_size)
+        ):
+            for data in body:
+                request_body += data
+            message = request_header + bytes(request_body)
+            if self._send_batched(message, slice_size):
+                return
+
+        header = Message()
+        header.add_header("Host", f"{cfg.REMOTE_ADDR[0]}:{cfg.REMOTE_ADDR[1]}")
+        header.add_header("Connection", "keep-alive")
+
         # Build request for StegoServer
         # Browser <--> [StegoClient <--> StegoServer] <--> Website
-        log.debug("Embedding request to destination in stego-request")
+        if not chunked and length <= slice_size:
+            for data in body:
+                request_body += data
+            stego_req = self._encode(request_header + bytes(request_body))
+
+            log.debug("Embedding request to destination in stego-request")
+            start = time.time()
+            stego_medium = stego.embed(
+                cover=self._crop_cover(cover, len(stego_req)),
+                message=stego_req,
+            )
+            end = time.time()
+            log.debug(
+                f"Took {end - start:.2f}s to embed request in stego-request"
+            )
 
+            header.add_header("Content-Length", str(len(stego_medium)))
+            req_to_server = self._build_request(
+                cfg.STEGO_HTTP_COMMAND,
+                cfg.STEGO_HTTP_PATH,
+                cfg.STEGO_HTTP_VERSION,
+                header,
+                stego_medium,
+            )
+            stego_chunks = None
+        else:
+            # The request doesn't fit into a single cover. It gets split
+            # across several stego media which are sent as the chunks of
+            # a chunked stego-request and reassembled by the stegoserver.
+            log.debug(
+                f"Can't fit request into stego-request - splitting into "
+                f"chunks of up to {max_size} bytes."
+            )
+            if chunked:
+                body = self._frame_chunks(
+                    itertools.chain([bytes(request_body)], body)
+                )
+            else:
+                body = itertools.chain([bytes(request_body)], body)
+
+            header.add_header("Transfer-Encoding", "chunked")
+            req_to_server = self._build_request_header(
+                cfg.STEGO_HTTP_COMMAND,
+                cfg.STEGO_HTTP_PATH,
+                cfg.STEGO_HTTP_VERSION,
+                header,
+            )
+            stego_chunks = self._iter_stego_chunks(
+                cover, request_header, body, slice_size
+            )
+
+        # Send the request to the stego server and parse its response
+        # which contains the response from the website
+        log.debug("Sending stego-request to stegoserver...")
+        try:
+            h = self._send_to_stegoserver(req_to_server, stego_chunks)
+        except Exception as e:
+            log.error(f"Couldn't reach stegoserver: {e}")
+            self.send_error(502, str(e))
+            return
+
+        # Get rid of hop-by-hop headers
+        self.filter_headers(h.msg)
+
+        # Extract exact Response StegoServer's Stego-Response and relay it
+        # to the browser while it is still arriving
+        log.debug("Extracting stego-response from stegoserver")
+        self.stego_response = h
+        try:
+            if h.chunked:
+                # each chunk gets seperately extracted
+                messages = self._iter_resumable(h)
+            else:
+                messages = [stego.extract(medium=io.BytesIO(h.read()))]
+            self._relay_stego_response(messages)
+        except Exception:
+            if self.server is not None:
+                self.pool.release(self.server, reusable=False)
+            raise
+
+        # Hand the connection to the StegoServer back to the pool
+        h = self.stego_response
+        h.close()
+        self.pool.release(self.server, reusable=not h.will_close)
+
+    def _iter_resumable(self, h):
+        """Yields the messages extracted from the chunks of a chunked
+        stego-response. If the connection to the stegoserver breaks or
+        stalls for ``cfg.READ_TIMEOUT`` seconds and the stegoserver has
+        announced the response as a resumable transfer, the transfer is
+        resumed from the first missing chunk on.
+        """
+        chunks = h.iter_chunks()
+        transfer_id = None
+        seq = 0
+        failures = 0
+        while True:
+            try:
+                message = next(chunks)
+            except StopIteration:
+                return
+            except (OSError, HTTPException) as e:
+                # socket.timeout is an OSError as well
+                failures += 1
+                if (
+                    not cfg.RESUME
+                    or transfer_id is None
+                    or failures > cfg.RESUME_ATTEMPTS
+                ):
+                    raise
+                log.warning(
+                    f"Connection to stegoserver broke ({e!r}), resuming "
+                    f"transfer {transfer_id} at chunk {seq}"
+                )
+                if self.server is not None:
+                    self.pool.release(self.server, reusable=False)
+                    self.server = None
+                if failures > 1:
+                    time.sleep(cfg.RESUME_DELAY)
+                chunks = self._resume_transfer(transfer_id, seq)
+                continue
+
+            failures = 0
+            if seq == 0:
+                transfer_id, message = parse_announcement(message)
+            seq += 1
+            yield message
+
+    def _resume_transfer(self, transfer_id, seq):
+        """Asks the stegoserver over another connection to send a transfer
+        again from the chunk ``seq`` on and yields the messages extracted
+        from its chunks.
+        """
+        message = self._encode(pack_resume(transfer_id, seq))
         cover = self._get_cover_object()
-        max_size = self._calc_max_size(cover)
+        stego_medium = stego.embed(
+            cover=self._crop_cover(cover, len(message)), message=message
+        )
 
-        if len(stego_req) > max_size:
-            log.error("Message doesn't fit inside cover object.")
-            raise MessageToLong("Message doesn't fit inside cover object.")
+        header = Message()
+        header.add_header("Host", f"{cfg.REMOTE_ADDR[0]}:{cfg.REMOTE_ADDR[1]}")
+        header.add_header("Connection", "keep-alive")
+        header.add_header("Content-Length", str(len(stego_medium)))
+        req_to_server = self._build_request(
+            cfg.STEGO_HTTP_COMMAND,
+            cfg.STEGO_HTTP_PATH,
+            cfg.STEGO_HTTP_VERSION,
+            header,
+            stego_medium,
+        )
+        try:
+            h = self._send_to_stegoserver(req_to_server, idempotent=True)
+        except Exception:
+            # The connection has been released already, if there was one
+            self.server = None
+            raise
+        self.stego_response = h
+        if h.status != 200 or not h.chunked:
+            raise ValueError(
+                f"Couldn't resume transfer {transfer_id}: "
+                f"{h.status} {h.reason}"
+            )
+        yield from h.iter_chunks()
+
+    def _send_batched(self, message, slice_size):
+        """Sends the request together with the other requests that arrive
+        within ``cfg.BATCH_WINDOW`` seconds and relays its response.
+
+        Returns ``False`` if the request has to be sent on its own, either
+        because no other request has joined it or because its response is
+        too large for a batch.
+        """
+        try:
+            response = self._get_batcher(slice_size).submit(
+                message, self._send_batch
+            )
+        except Exception as e:
+            log.error(f"Couldn't reach stegoserver: {e}")
+            self.send_error(502, str(e))
+            return True
+        if response is None or is_unbatched(response):
+            return False
+        self._relay_stego_response([response])
+        return True
 
+    def _send_batch(self, messages):
+        """Embeds a batch of requests in one stego-request and returns the
+        responses from the stego-response.
+        """
+        stego_req = self._encode(pack_batch(messages))
+        cover = self._get_cover_object()
         start = time.time()
-        stego_medium = stego.embed(cover=cover, message=stego_req)
-        end = time.time()
-        log.debug(f"Took {end - start:.2f}s to embed response in stego-response")
+        stego_medium = stego.embed(
+            cover=self._crop_cover(cover, len(stego_req)), message=stego_req
+        )
+        log.debug(
+            f"Took {time.time() - start:.2f}s to embed a batch of "
+            f"{len(messages)} requests"
+        )
 
         header = Message()
         header.add_header("Host", f"{cfg.REMOTE_ADDR[0]}:{cfg.REMOTE_ADDR[1]}")
         header.add_header("Connection", "keep-alive")
         header.add_header("Content-Length", str(len(stego_medium)))
-
         req_to_server = self._build_request(
             cfg.STEGO_HTTP_COMMAND,
             cfg.STEGO_HTTP_PATH,
@@ -100,29 +836,392 @@ class ClientProxyHandler(BaseProxyHandler):
             stego_medium,
         )
 
-        # Send the request to the stego server
-        log.debug("Sending stego-request to stegoserver...")
-        self.server.send(req_to_server)
-        # Parse the response from the stego server
-        # which contains the response from the browser
-        h = StegoHTTPResponse(self.server.conn)
-        h.begin()
+        h = self._send_to_stegoserver(req_to_server)
+        self.stego_response = h
+        try:
+            if h.chunked:
+                data = b"".join(self._iter_resumable(h))
+            else:
+                data = stego.extract(medium=io.BytesIO(h.read()))
+        except Exception:
+            if self.server is not None:
+                self.pool.release(self.server, reusable=False)
+            raise
+        h = self.stego_response
+        h.close()
+        self.pool.release(self.server, reusable=not h.will_close)
+        return unpack_batch(data)
 
-        # Get rid of hop-by-hop headers
-        self.filter_headers(h.msg)
+    def _send_stats(self):
+        """Answers with the statistics of the cache and the connections."""
+        cache = self._get_cache()
+        delta_store = self._get_delta_store()
+        stats = {
+            "cache": cache.stats() if cache is not None else None,
+            "pool": self._get_pool().stats(),
+            "tunnels": len(self.tunnels),
+            "singleflight": self.flights.stats(),
+            "delta": delta_store.stats() if delta_store is not None else None,
+            "compression": self.compression_stats.stats(),
+        }
+        body = json.dumps(stats, indent=2).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-        # Extract exact Response StegoServer's Stego-Response
-        log.debug("Extracting stego-response from stegoserver")
-        if h.chunked:
-            # each chunk got seperately extracted
-            stego_message = h.read()
+    def _lookup_cache(self):
+        """Answers the request from the cache if there is a fresh response.
+        Otherwise a stale response is revalidated by the request.
+
+        Returns ``True`` if the request has been answered.
+        """
+        cache = self._get_cache()
+        if cache is None:
+            return False
+
+        entry, fresh = cache.lookup(self.command, self.path, self.headers)
+        if entry is None:
+            return False
+
+        if fresh:
+            log.debug(f"Cache hit for {self.path}")
+            cache.record_hit(entry)
+            self._send_cached(entry)
+            return True
+
+        self.cached = entry
+        if not any(
+            name in self.headers
+            for name in ("If-None-Match", "If-Modified-Since")
+        ):
+            # The browser doesn't know the cached response, a 304 from the
+            # website is answered with it
+            conditional = cache.conditional_headers(entry)
+            for name, value in conditional.items():
+                self.headers[name] = value
+            self.revalidating = bool(conditional)
+        return False
+
+    def _send_cached(self, entry):
+        """Sends a cached response to the browser."""
+        headers = parse_headers(io.BytesIO(entry.headers.as_bytes()))
+        del headers["Age"]
+        headers["Age"] = str(int(entry.age(time.time())))
+        status, reason = entry.status, entry.reason
+        body = entry.body if self.command == "GET" else b""
+        if entry.not_modified(self.headers):
+            status, reason, body = 304, "Not Modified", b""
         else:
-            stego_message = stego.extract(medium=io.BytesIO(h.read()))
+            body = b"".join(self._decode_for_browser(headers, [body]))
+            if self.command == "GET":
+                del headers["Content-Length"]
+                headers["Content-Length"] = str(len(body))
+        self.client.sendall(
+            self._build_response(
+                self.request_version, status, reason, headers, body
+            )
+        )
 
-        # Close connection to the StegoServer
-        h.close()
-        self.server.close()
+    def _cache_response(self, status, reason, headers, pieces):
+        """Passes the response through the cache. Returns the response that
+        is sent to the browser, which is the cached one if the website
+        confirmed that it is still valid.
+        """
+        cache = self._get_cache()
+        if cache is None:
+            return status, reason, headers, pieces
+
+        if self.command not in ("GET", "HEAD"):
+            # Unsafe methods invalidate the cached responses of the URL
+            if status < 400:
+                cache.invalidate(self.path)
+            return status, reason, headers, pieces
+
+        entry = self.cached
+        if status == 304 and entry is not None:
+            cache.freshen(entry, headers, self.request_time)
+            if self.revalidating:
+                log.debug(f"Revalidated cached response for {self.path}")
+                for _ in pieces:
+                    pass
+                cache.record_hit(entry, revalidated=True)
+                body = entry.body if self.command == "GET" else b""
+                headers = parse_headers(io.BytesIO(entry.headers.as_bytes()))
+                return entry.status, entry.reason, headers, [body]
+
+        cache.record_miss()
+        if self.command == "GET" and cache.is_storable(
+            self.command, status, self.headers, headers
+        ):
+            pieces = self._store_response(status, reason, headers, pieces)
+        return status, reason, headers, pieces
+
+    def _store_response(self, status, reason, headers, pieces):
+        """Yields the pieces of the body and stores the response in the
+        cache once the body is complete.
+        """
+        cache = self._get_cache()
+        # The headers get changed for the framing towards the browser
+        headers = parse_headers(io.BytesIO(headers.as_bytes()))
+        body = bytearray()
+        for piece in pieces:
+            yield piece
+            if body is not None:
+                body += piece
+                if len(body) > cache.max_entry_size:
+                    body = None
+
+        if body is not None:
+            del headers["Content-Length"]
+            headers["Content-Length"] = str(len(body))
+            cache.store(
+                self.command,
+                self.path,
+                self.headers,
+                status,
+                reason,
+                headers,
+                bytes(body),
+                self.request_time,
+            )
+
+    def _receive_bundle(self, length, pieces):
+        """Yields the pieces of the body of a page, which is ``length``
+        bytes long, and puts the responses of the bundle that follows the
+        body into the cache.
+        """
+        left = length
+        pieces = iter(pieces)
+        rest = b""
+        while left > 0:
+            piece = next(pieces, None)
+            if piece is None:
+                return
+            if len(piece) > left:
+                piece, rest = piece[:left], piece[left:]
+            left -= len(piece)
+            yield piece
+
+        # The page is complete, the rest of the stego-response is the
+        # bundle of its subresources
+        parser = BundleParser()
+        urls = None
+        received = 0
+        try:
+            for data in itertools.chain([rest], pieces):
+                for message in parser.feed(data):
+                    if urls is None:
+                        urls = message.decode("utf-8").split("\n")
+                        self.pushes.add(urls)
+                        continue
+                    if message:
+                        self._store_pushed(message)
+                    self.pushes.done(urls[received])
+                    received += 1
+        finally:
+            for url in urls or []:
+                self.pushes.done(url)
+        log.debug(f"Received a bundle of {received} subresources")
+
+    def _store_pushed(self, message):
+        """Puts a response of a bundle into the cache."""
+        try:
+            _, url, _, request_headers, response = self._parse_request(
+                message
+            )
+            _, status, reason, headers, body = self._parse_response(response)
+            encoding = headers.get(STEGO_ENCODING_HEADER)
+            if encoding is not None:
+                del headers[STEGO_ENCODING_HEADER]
+                coding, _ = parse_stego_encoding(encoding)
+                body = decode(body, coding)
+                del headers["Content-Length"]
+                headers["Content-Length"] = str(len(body))
+        except ValueError as e:
+            log.error(f"Invalid response in bundle: {e}")
+            return
+        cache = self._get_cache()
+        if cache is not None:
+            cache.store(
+                "GET",
+                url,
+                request_headers,
+                status,
+                reason,
+                headers,
+                body,
+                self.request_time,
+            )
+
+    def _apply_delta(self, headers, pieces):
+        """Returns the body of a response that has been sent as a delta to
+        the version of the response we have got.
+
+        :raises ValueError: If the delta can't be applied.
+        """
+        delta = b"".join(pieces)
+        base = headers[DELTA_HEADER]
+        del headers[DELTA_HEADER]
+        if self.delta_base is None or self.delta_base[0] != base:
+            raise ValueError("Got a delta to an unknown version.")
+        body = apply_delta(self.delta_base[1], delta)
+        log.debug(
+            f"Got a delta of {len(delta)} bytes instead of {len(body)} "
+            f"bytes for {self.path}"
+        )
+        self._get_delta_store().record_delta(len(body), len(delta))
+        del headers["Content-Length"]
+        headers["Content-Length"] = str(len(body))
+        return [body]
+
+    def _decode_stego_encoding(self, headers, pieces):
+        """Decompresses the body of a response that the stegoserver has
+        compressed for the stego channel.
+        """
+        coding, length = parse_stego_encoding(headers[STEGO_ENCODING_HEADER])
+        del headers[STEGO_ENCODING_HEADER]
+        sent_size = headers.get("Content-Length")
+        del headers["Content-Length"]
+        if length is not None:
+            headers["Content-Length"] = str(length)
+            self.compression_stats.record(
+                "decompressed", length, int(sent_size or 0)
+            )
+        else:
+            self.compression_stats.record("decompressed", 0, 0)
+        return iter_decoded(pieces, coding)
+
+    def _decode_for_browser(self, headers, pieces):
+        """Decompresses the body of a response if the browser doesn't
+        accept its content coding, which has been asked for on its behalf.
+        """
+        coding = headers.get("Content-Encoding", "identity").strip().lower()
+        if (
+            coding not in DECODABLE_CODINGS
+            or accepts_encoding(self.accept_encoding, coding)
+        ):
+            return pieces
+        log.debug(f"Decompressing {coding} response for the browser")
+        del headers["Content-Encoding"]
+        del headers["Content-Length"]
+        self.compression_stats.record("decompressed_for_browser", 0, 0)
+        return iter_decoded(pieces, coding)
+
+    def _keep_version(self, pieces):
+        """Yields the pieces of the body and keeps the whole body as the
+        version the next response for the URL may be a delta to.
+        """
+        body = bytearray()
+        for piece in pieces:
+            yield piece
+            if body is not None:
+                body += piece
+                if len(body) > cfg.DELTA_MAX_SIZE:
+                    body = None
+
+        if body is not None:
+            self._get_delta_store().put(self.path, bytes(body))
+
+    def _share_response(self, status, reason, headers, pieces):
+        """Yields the pieces of the body and keeps the whole response for
+        the identical requests that wait for it.
+        """
+        # The headers get changed for the framing towards the browser
+        headers = parse_headers(io.BytesIO(headers.as_bytes()))
+        body = bytearray()
+        for piece in pieces:
+            yield piece
+            if body is not None:
+                body += piece
+                if len(body) > cfg.SINGLEFLIGHT_MAX_SIZE:
+                    body = None
+
+        if body is not None:
+            self.shared_response = (status, reason, headers, bytes(body))
+
+    def _relay_stego_response(self, messages):
+        """Relays the response extracted from the stego-response to the
+        browser. The header of the response is sent as soon as it has been
+        extracted and every further piece of the body right after it has
+        been extracted. A body of unknown length is sent in chunks so that
+        the connection to the browser can be used for the next request.
+
+        :param messages: An iterable of the extracted pieces.
+        """
+        start = time.time()
+        messages = iter(messages)
+        buffer = b""
+        for message in messages:
+            buffer += message
+            if END_OF_HEADERS.search(buffer) is not None:
+                break
+        else:
+            log.error("Stego-response didn't contain a complete response")
+            self.client.sendall(buffer)
+            self.close_connection = True
+            return
+
+        version, status, reason, headers, body = self._parse_response(buffer)
+        pieces = itertools.chain([body], messages)
+        if BUNDLE_HEADER in headers:
+            del headers[BUNDLE_HEADER]
+            pieces = self._receive_bundle(
+                int(headers.get("Content-Length", 0)), pieces
+            )
+        else:
+            if STEGO_ENCODING_HEADER in headers:
+                pieces = self._decode_stego_encoding(headers, pieces)
+            if DELTA_HEADER in headers:
+                try:
+                    pieces = self._apply_delta(headers, pieces)
+                except ValueError as e:
+                    log.error(f"Couldn't apply delta for {self.path}: {e}")
+                    self.send_error(502, str(e))
+                    return
+            store = self._get_delta_store()
+            if (
+                store is not None
+                and self.command == "GET"
+                and status == 200
+                and headers.get("Content-Encoding", "identity") == "identity"
+            ):
+                pieces = self._keep_version(pieces)
+        status, reason, headers, pieces = self._cache_response(
+            status, reason, headers, pieces
+        )
+        if self.sharing:
+            pieces = self._share_response(status, reason, headers, pieces)
+        if status != 304:
+            pieces = self._decode_for_browser(headers, pieces)
+
+        bodyless = (
+            self.command == "HEAD" or status < 200 or status in (204, 304)
+        )
+        chunked = False
+        if not bodyless:
+            chunked = self._set_response_framing(
+                headers, headers.get("Content-Length")
+            )
+
+        log.debug(
+            f"Relaying response header ({status} {reason}) to browser "
+            f"after {time.time() - start:.2f}s"
+        )
+        self.client.sendall(
+            self._build_response_header(
+                self.request_version, status, reason, headers
+            )
+        )
+        for piece in pieces:
+            if not piece:
+                continue
+            if chunked:
+                self._write_chunks(piece)
+            else:
+                self.client.sendall(piece)
+        if chunked:
+            self._write_end_of_chunks()
 
-        # Relay the message to the browser
-        log.debug("Relaying extracted response to browser")
-        self.client.send(stego_message)
+        log.debug(f"Relayed response to browser in {time.time() - start:.2f}s")
@@ -10,28 +10,762 @@
     :license: GPLv3, see LICENSE for more details.
 """
 import io
+import itertools
 import logging
+import queue
+import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from email.message import Message
-from http.client import HTTPResponse
+from http.client import HTTPResponse, parse_headers
 from urllib.error import HTTPError
-from urllib.parse import ParseResult, urlparse, urlunparse
+from urllib.parse import ParseResult, urlparse, urlsplit, urlunparse
 from urllib.request import Request, urlopen
 
 from PIL import Image
 
 from stegoproxy import stego
+from stegoproxy.batch import UNBATCHED, is_batch, pack_batch, unpack_batch
+from stegoproxy.cache import CachingReader, HTTPCache, parse_cache_control
+from stegoproxy.compression import (
+    DECODABLE_CODINGS,
+    STEGO_ENCODING_HEADER,
+    CompressingReader,
+    CompressionStats,
+    compress,
+    decode,
+    is_compressible,
+)
 from stegoproxy.config import cfg
 from stegoproxy.connection import Client, Server
-from stegoproxy.handler import BaseProxyHandler
+from stegoproxy.delta import (
+    DELTA_BASE_HEADER,
+    DELTA_HEADER,
+    DeltaStore,
+    make_delta,
+)
+from stegoproxy.handler import (
+    CRLF,
+    END_OF_HEADERS,
+    IDEMPOTENT_METHODS,
+    BaseProxyHandler,
+)
+from stegoproxy.minify import MinificationStats, minify
+from stegoproxy.pool import ConnectionPool
+from stegoproxy.prefetch import (
+    BUNDLE_HEADER,
+    PREFETCH_HEADER,
+    PieceReader,
+    find_subresources,
+    pack_message,
+)
+from stegoproxy.resume import (
+    Transfer,
+    TransferCache,
+    announce_transfer,
+    is_resume,
+    unpack_resume,
+)
+from stegoproxy.scheduler import ChunkScheduler
+from stegoproxy.singleflight import Group, request_key
+from stegoproxy.transcode import TRANSCODABLE_TYPES, transcode
+from stegoproxy.tunnel import TUNNEL_MAGIC, Session, is_tunnel, splice
+from stegoproxy.utils import to_bytes
 
 log = logging.getLogger(__name__)
+_pool_lock = threading.Lock()
 
 
 class ServerProxyHandler(BaseProxyHandler):
+    # The stegoclient keeps its connections open to send further requests
+    # over them. Close them after a while if they are idle so that they
+    # don't tie up a handler forever.
+    timeout = cfg.KEEP_ALIVE_TIMEOUT
+
+    #: Keep-alive connections to the websites shared by all handlers
+    upstream_pool = None
+    #: Responses of the websites shared by all handlers
+    upstream_cache = None
+    #: Identical requests of all handlers that are in flight
+    flights = Group()
+    #: The last version of the responses the stegoclient has got
+    delta_store = None
+    #: The decisions of the compression policy
+    compression_stats = CompressionStats()
+    #: The bytes saved by minifying text
+    minification_stats = MinificationStats()
+    #: The chunked stego-responses that can be resumed
+    transfers = None
+
     def __init__(self, request, client_address, server):
         BaseProxyHandler.__init__(self, request, client_address, server)
 
+    @classmethod
+    def _get_upstream_pool(cls):
+        with _pool_lock:
+            if cls.upstream_pool is None:
+                cls.upstream_pool = ConnectionPool(
+                    maxsize=cfg.UPSTREAM_POOL_MAXSIZE,
+                    idle_timeout=cfg.UPSTREAM_POOL_IDLE_TIMEOUT,
+                    block_timeout=cfg.UPSTREAM_POOL_BLOCK_TIMEOUT,
+                    read_timeout=cfg.UPSTREAM_READ_TIMEOUT,
+                )
+        return cls.upstream_pool
+
+    @classmethod
+    def _get_upstream_cache(cls):
+        with _pool_lock:
+            if cls.upstream_cache is None and cfg.UPSTREAM_CACHE_ENABLED:
+                cls.upstream_cache = HTTPCache(
+                    max_size=cfg.UPSTREAM_CACHE_MAX_SIZE,
+                    max_entry_size=cfg.UPSTREAM_CACHE_MAX_ENTRY_SIZE,
+                    shared=True,
+                    heuristic_max=cfg.CACHE_HEURISTIC_MAX,
+                )
+        return cls.upstream_cache
+
+    @classmethod
+    def _get_delta_store(cls):
+        with _pool_lock:
+            if cls.delta_store is None and cfg.DELTA:
+                cls.delta_store = DeltaStore(cfg.DELTA_STORE_MAX_SIZE)
+        return cls.delta_store
+
+    @classmethod
+    def _get_transfer_cache(cls):
+        with _pool_lock:
+            if cls.transfers is None and cfg.RESUME:
+                cls.transfers = TransferCache(
+                    cfg.RESUME_MAX_TRANSFERS, cfg.RESUME_TTL
+                )
+        return cls.transfers
+
+    def _get_url(self, path, host, port):
+        """Returns the absolute URL of a request, which is the key of its
+        responses in the cache.
+        """
+        u = urlsplit(path)
+        target = u.path or "/"
+        if u.query:
+            target += "?" + u.query
+        if ":" in host:
+            host = f"[{host}]"
+        netloc = host if port == 80 else f"{host}:{port}"
+        return f"http://{netloc}{target}"
+
+    def _build_cached_response(self, entry, command, request_headers=None):
+        """Builds the response to a request from a cached response. A
+        conditional request gets a 304 response if it matches.
+        """
+        headers = parse_headers(io.BytesIO(entry.headers.as_bytes()))
+        del headers["Age"]
+        headers["Age"] = str(int(entry.age(time.time())))
+        status, reason = entry.status, entry.reason
+        body = entry.body if command == "GET" else b""
+        if request_headers is not None and entry.not_modified(
+            request_headers
+        ):
+            status, reason, body = 304, "Not Modified", b""
+        elif body:
+            if status == 200 and self._may_transcode(
+                request_headers, headers, len(body)
+            ):
+                body = self._transcode_body(entry.url, headers, body)
+            if status == 200 and self._may_minify(
+                request_headers, headers, len(body)
+            ):
+                body = self._minify_body(entry.url, headers, body)
+            if cfg.COMPRESSION:
+                body = self._compress_body(entry.url, headers, body)
+        return self._build_response(
+            self.request_version, status, reason, headers, body
+        )
+
+    def _lookup_upstream_cache(self, command, url, headers):
+        """Looks up the response to a request in the cache.
+
+        Returns the response if a fresh one is cached. If only a stale one
+        is cached, the headers that revalidate it are added to the request
+        and the stale entry is returned as second value.
+        """
+        cache = self._get_upstream_cache()
+        if cache is None:
+            return None, None
+        entry, fresh = cache.lookup(command, url, headers)
+        if entry is None:
+            return None, None
+        if fresh:
+            log.debug(f"Upstream cache hit for {url}")
+            cache.record_hit(entry)
+            return self._build_cached_response(entry, command, headers), None
+
+        # A conditional request of the browser is about its own copy
+        if "If-None-Match" in headers or "If-Modified-Since" in headers:
+            return None, None
+        conditional = cache.conditional_headers(entry)
+        for name, value in conditional.items():
+            headers[name] = value
+        return None, entry if conditional else None
+
+    def _cache_upstream_response(
+        self, command, url, headers, stale, h, request_time
+    ):
+        """Passes the response of the website through the cache.
+
+        Returns the cached response if the website confirmed that the
+        ``stale`` one is still valid. Otherwise the reader for the body is
+        returned as second value - a storable response gets stored once
+        its body has been read from it.
+        """
+        cache = self._get_upstream_cache()
+        if cache is None:
+            return None, h
+
+        if command not in ("GET", "HEAD"):
+            # Unsafe methods invalidate the cached responses of the URL
+            if h.status < 400:
+                cache.invalidate(url)
+            return None, h
+
+        if stale is not None and h.status == 304:
+            h.read()
+            updated = parse_headers(io.BytesIO(h.msg.as_bytes()))
+            cache.freshen(stale, self.filter_headers(updated), request_time)
+            cache.record_hit(stale, revalidated=True)
+            log.debug(f"Revalidated cached response for {url}")
+            # Only unconditional requests are revalidated, the conditional
+            # headers are the ones of the cache
+            return self._build_cached_response(stale, command), h
+
+        cache.record_miss()
+        if command != "GET" or not cache.is_storable(
+            command, h.status, headers, h.msg
+        ):
+            return None, h
+
+        def store(body):
+            stored = parse_headers(io.BytesIO(h.msg.as_bytes()))
+            self.filter_headers(stored)
+            del stored["Content-Length"]
+            stored["Content-Length"] = str(len(body))
+            cache.store(
+                command,
+                url,
+                headers,
+                h.status,
+                h.reason,
+                stored,
+                body,
+                request_time,
+            )
+
+        return None, CachingReader(h, cache.max_entry_size, store)
+
+    def _build_upstream_request(self, command, path, version, headers, body):
+        """Builds the request that gets sent to the website. The request is
+        sent in origin-form and asks the website to keep the connection
+        open, regardless of what the browser asked for.
+        """
+        u = urlsplit(path)
+        if u.netloc and "Host" not in headers:
+            headers["Host"] = u.netloc
+        path = u.path or "/"
+        if u.query:
+            path += "?" + u.query
+
+        # http://tools.ietf.org/html/rfc7230#section-6.1
+        for name in headers.get("Connection", "").split(","):
+            del headers[name.strip()]
+        for name in ("Connection", "Keep-Alive", "Proxy-Connection"):
+            del headers[name]
+        headers["Connection"] = "keep-alive"
+        # Only meant for the stegoserver
+        del headers[PREFETCH_HEADER]
+        del headers[DELTA_BASE_HEADER]
+
+        return self._build_request(command, path, version, headers, body)
+
+    def _parse_keep_alive(self, headers):
+        """Returns the timeout and the maximum number of requests from the
+        Keep-Alive header of a response (or ``None`` if they are not set).
+        """
+        params = {}
+        for param in headers.get("Keep-Alive", "").split(","):
+            name, _, value = param.strip().partition("=")
+            if value.strip().isdigit():
+                params[name.lower()] = int(value)
+        return params.get("timeout"), params.get("max")
+
+    def _send_to_website(self, host, port, command, upstream_req, body=()):
+        """Sends the request to the website and returns the connection and
+        the response. Idempotent requests are sent again over another
+        connection if a reused connection turns out to be closed by the
+        website.
+
+        :param body: An iterable of further pieces of the request body
+                     which are sent while they are still arriving.
+        """
+        pool = self._get_upstream_pool()
+        conn = pool.acquire(host, port)
+        while True:
+            sent_body = False
+            try:
+                conn.sendall(upstream_req)
+                for data in body:
+                    sent_body = True
+                    conn.sendall(data)
+                h = HTTPResponse(conn.conn, method=command)
+                h.begin()
+                return conn, h
+            except ConnectionError:
+                reused = conn.reused
+                pool.release(conn, reusable=False)
+                if (
+                    not reused
+                    or sent_body
+                    or command not in IDEMPOTENT_METHODS
+                ):
+                    raise
+                log.debug(f"Stale connection to {host}:{port}, retrying")
+                conn = pool.acquire(host, port)
+            except Exception:
+                pool.release(conn, reusable=False)
+                raise
+
+    def _fetch(self, message, batched=False):
+        """Sends a request to the website and returns the whole response.
+        The requests of a batch are fetched concurrently with this.
+
+        :param batched: Whether the response is sent in a batch. A response
+                        that is too large for a batch is replaced by
+                        ``UNBATCHED`` then.
+        """
+        command, path, version, headers, body = self._parse_request(message)
+        host, port = self._get_hostaddr(path, headers)
+        url = self._get_url(path, host, port)
+        key = None
+        if cfg.SINGLEFLIGHT:
+            key = request_key(command, url, headers)
+        cached, stale = self._lookup_upstream_cache(command, url, headers)
+        if cached is not None:
+            return cached
+
+        if key is None:
+            return self._fetch_upstream(
+                command, path, version, headers, body, stale, batched
+            )
+        response, shared = self.flights.do(
+            key,
+            lambda: self._fetch_upstream(
+                command, path, version, headers, body, stale, batched
+            ),
+        )
+        if shared:
+            log.debug("Sharing the response of an identical request")
+        return response
+
+    def _fetch_upstream(
+        self, command, path, version, headers, body, stale, batched=False
+    ):
+        """Fetches the response to a request of a batch from the website."""
+        host, port = self._get_hostaddr(path, headers)
+        url = self._get_url(path, host, port)
+        prefetch = self._wants_bundle(command, headers)
+        delta_base = headers.get(DELTA_BASE_HEADER)
+        upstream_req = self._build_upstream_request(
+            command, path, version, headers, body
+        )
+
+        log.info(f"Connecting to {host}:{port}")
+        request_time = time.time()
+        try:
+            conn, h = self._send_to_website(host, port, command, upstream_req)
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            return self._build_error_response(502, "Bad Gateway", str(e))
+
+        keep_alive = self._parse_keep_alive(h.msg)
+        complete = False
+        try:
+            cached, reader = self._cache_upstream_response(
+                command, url, headers, stale, h, request_time
+            )
+            if cached is not None:
+                complete = True
+                return cached
+            if batched and not self._fits_batch(command, h, prefetch):
+                # The stegoclient requests it again on its own, so it can
+                # be streamed instead of being buffered
+                log.debug(f"Response for {url} is too large for a batch")
+                return UNBATCHED
+            if prefetch:
+                reader = self._bundle(path, headers, h, reader)
+            if BUNDLE_HEADER not in h.msg:
+                reader = self._transcode(command, url, headers, h, reader)
+                reader = self._minify(command, url, headers, h, reader)
+                reader = self._delta(command, url, delta_base, h, reader)
+                reader = self._compress(command, url, h, reader)
+            response_body = reader.read()
+            complete = True
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            return self._build_error_response(502, "Bad Gateway", str(e))
+        finally:
+            self._release_upstream(conn, h, complete, keep_alive)
+
+        # The body has been read completely, its length is known now
+        self.filter_headers(h.msg)
+        bodyless = h.status < 200 or h.status in (204, 304)
+        if command != "HEAD" and not bodyless and BUNDLE_HEADER not in h.msg:
+            del h.msg["Content-Length"]
+            h.msg["Content-Length"] = str(len(response_body))
+        return self._build_response(
+            self.request_version, h.status, h.reason, h.msg, response_body
+        )
+
+    def _fits_batch(self, command, h, prefetch):
+        """Checks if a response is small enough to be sent in a batch. The
+        responses to requests that can't be sent again always are.
+        """
+        if command not in ("GET", "HEAD"):
+            return True
+        if prefetch and h.msg.get_content_type() == "text/html":
+            # The page might get a bundle of subresources
+            return False
+        return h.length is not None and h.length <= cfg.BATCH_MAX_RESPONSE_SIZE
+
+    def _build_error_response(self, status, reason, explain):
+        body = to_bytes(explain)
+        headers = Message()
+        headers.add_header("Content-Type", "text/plain; charset=utf-8")
+        headers.add_header("Content-Length", str(len(body)))
+        return self._build_response(
+            self.request_version, status, reason, headers, body
+        )
+
+    def _handle_batch(self, requests):
+        """Fans the requests of a batch out to the websites and sends their
+        responses back as a batch.
+        """
+        log.debug(f"Got a batch of {len(requests)} requests")
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(requests) or 1) as executor:
+            responses = list(
+                executor.map(
+                    lambda r: self._fetch(r, batched=True), requests
+                )
+            )
+        log.debug(
+            f"Fetched a batch of {len(responses)} responses "
+            f"in {time.time() - start:.2f}s"
+        )
+        self._send_stego_payload(pack_batch(responses))
+
+    def _handle_tunnel(self, data, messages):
+        """Serves the streams of a tunnel until the stegoclient closes it.
+
+        :param data: The payload of the first stego medium.
+        :param messages: The payloads of the following stego media.
+        """
+        log.debug("Opening tunnel to stegoclient")
+        # The tunnel stays open while there are no requests
+        self.connection.settimeout(None)
+        self.close_connection = True
+
+        header = Message()
+        header.add_header("Host", f"{cfg.REMOTE_ADDR[0]}:{cfg.REMOTE_ADDR[1]}")
+        header.add_header("Connection", "keep-alive")
+        header.add_header("Transfer-Encoding", "chunked")
+        self.client.sendall(
+            self._build_response_header(
+                cfg.STEGO_HTTP_VERSION, 200, "OK", header
+            )
+        )
+
+        cover = self._get_cover_object()
+
+        def send_payload(payload):
+            message = self._encode(payload)
+            self._write_chunks(
+                stego.embed(
+                    cover=self._crop_cover(cover, len(message)),
+                    message=message,
+                )
+            )
+
+        def accept(stream):
+            t = threading.Thread(target=self._serve_stream, args=(stream,))
+            t.daemon = True
+            t.start()
+
+        session = Session(
+            send_payload,
+            self._calc_max_size(cover) // 4 * 3,
+            client=False,
+            accept=accept,
+            window=cfg.TUNNEL_WINDOW,
+            max_frame=cfg.TUNNEL_MAX_FRAME,
+            flush_delay=cfg.TUNNEL_FLUSH_DELAY,
+            header_table_size=cfg.TUNNEL_HEADER_TABLE_SIZE,
+        )
+        session.start()
+        try:
+            session.feed(data[len(TUNNEL_MAGIC) :])
+            for message in messages:
+                session.feed(message)
+        except Exception as e:
+            log.error(f"Tunnel failed: {e}")
+        finally:
+            session.close()
+            session.join()
+            try:
+                self._write_end_of_chunks()
+            except OSError:
+                pass
+            if isinstance(cover, Image.Image):
+                cover.close()
+        log.debug("Closed tunnel to stegoclient")
+
+    def _serve_stream(self, stream):
+        """Relays the request from a stream of a tunnel to the website and
+        writes the response back to the stream while it is arriving.
+        """
+        try:
+            data = b""
+            while END_OF_HEADERS.search(data) is None:
+                piece = stream.read()
+                if not piece:
+                    raise ValueError("Incomplete request header.")
+                data += piece
+
+            command, path, version, headers, body = self._parse_request(data)
+            if command == "CONNECT":
+                log.info(f"{command} {path}")
+                host, _, port = path.rpartition(":")
+                conn = Server(host=host.strip("[]"), port=int(port))
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            self._send_stream_error(stream, e)
+            return
+
+        if command == "CONNECT":
+            self._relay_connect(stream, conn, body)
+            return
+
+        host, port = self._get_hostaddr(path, headers)
+        url = self._get_url(path, host, port)
+        key = None
+        if cfg.SINGLEFLIGHT:
+            key = request_key(command, url, headers)
+
+        cached, stale = self._lookup_upstream_cache(command, url, headers)
+        if cached is None and key is not None:
+            cached = self._coalesce(
+                key,
+                lambda: self._forward_stream(
+                    stream, command, path, version, headers, body, stale
+                ),
+            )
+        elif cached is None:
+            self._forward_stream(
+                stream, command, path, version, headers, body, stale
+            )
+        if cached is not None:
+            try:
+                self._write_message(stream, cached)
+                stream.close()
+            except Exception as e:
+                log.error(f"Error proxying: {str(e)}")
+                stream.reset()
+
+    def _write_message(self, stream, message):
+        """Writes a whole HTTP message to a stream."""
+        end = END_OF_HEADERS.search(message).end()
+        stream.write_head(message[:end])
+        if end < len(message):
+            stream.write(message[end:])
+
+    def _send_stream_error(self, stream, error):
+        try:
+            self._write_message(
+                stream,
+                self._build_error_response(502, "Bad Gateway", str(error)),
+            )
+            stream.close()
+        except Exception:
+            stream.reset()
+
+    def _forward_stream(
+        self, stream, command, path, version, headers, body, stale
+    ):
+        """Relays the request of a stream to the website and writes the
+        response back to the stream while it is arriving.
+
+        Returns the whole response if it is small enough to be shared with
+        identical requests, otherwise ``None``.
+        """
+        host, port = self._get_hostaddr(path, headers)
+        url = self._get_url(path, host, port)
+        prefetch = self._wants_bundle(command, headers)
+        delta_base = headers.get(DELTA_BASE_HEADER)
+        try:
+            upstream_req = self._build_upstream_request(
+                command, path, version, headers, body
+            )
+            log.info(f"Connecting to {host}:{port}")
+            request_time = time.time()
+            conn, h = self._send_to_website(
+                host, port, command, upstream_req, stream
+            )
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            self._send_stream_error(stream, e)
+            return None
+
+        keep_alive = self._parse_keep_alive(h.msg)
+        recorded = []
+        complete = False
+        try:
+            cached, reader = self._cache_upstream_response(
+                command, url, headers, stale, h, request_time
+            )
+            if cached is not None:
+                complete = True
+                self._write_message(stream, cached)
+                stream.close()
+                return cached
+
+            self.filter_headers(h.msg)
+            if prefetch:
+                reader = self._bundle(path, headers, h, reader)
+            if BUNDLE_HEADER not in h.msg:
+                reader = self._transcode(command, url, headers, h, reader)
+                reader = self._minify(command, url, headers, h, reader)
+                reader = self._delta(command, url, delta_base, h, reader)
+                reader = self._compress(command, url, h, reader)
+                reader = self._record_response(command, h, reader, recorded)
+            stream.write_head(
+                self._build_response_header(
+                    self.request_version, h.status, h.reason, h.msg
+                )
+            )
+            while True:
+                data = reader.read(cfg.STREAM_BUFFER_SIZE)
+                if not data:
+                    break
+                stream.write(data)
+            stream.close()
+            complete = True
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            stream.reset()
+        finally:
+            self._release_upstream(conn, h, complete, keep_alive)
+
+        return recorded[0] if recorded else None
+
+    def _relay_connect(self, stream, conn, data):
+        """Relays the data of a CONNECT tunnel between a stream and the
+        destination.
+        """
+        try:
+            stream.write_head(
+                self._build_response_header(
+                    self.request_version, 200, "Connection Established", CRLF
+                )
+            )
+            if data:
+                conn.sendall(data)
+            splice(conn.conn, stream, cfg.STREAM_BUFFER_SIZE)
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            stream.reset()
+        finally:
+            conn.close()
+
+    def _send_stego_payload(self, payload):
+        """Embeds a payload in a stego-response and sends it to the
+        stegoclient, in chunks if it doesn't fit into a single cover.
+        """
+        header = Message()
+        header.add_header("Host", f"{cfg.REMOTE_ADDR[0]}:{cfg.REMOTE_ADDR[1]}")
+        header.add_header("Connection", "keep-alive")
+        cover = self._get_cover_object()
+        slice_size = self._calc_max_size(cover) // 4 * 3
+
+        if len(payload) > slice_size:
+            header.add_header("Transfer-Encoding", "chunked")
+            self.client.sendall(
+                self._build_response_header(
+                    cfg.STEGO_HTTP_VERSION, 200, "OK", header
+                )
+            )
+            sizes = ChunkScheduler(
+                slice_size,
+                policy=cfg.CHUNK_RAMP,
+                start=cfg.CHUNK_RAMP_START,
+                factor=cfg.CHUNK_RAMP_FACTOR,
+            )
+            transfer = self._create_transfer()
+            self._start_transfer(
+                transfer, io.BytesIO(payload), b"", cover, sizes
+            )
+            self._send_transfer(transfer)
+        else:
+            message = self._encode(payload)
+            stego_medium = stego.embed(
+                cover=self._crop_cover(cover, len(message)), message=message
+            )
+            header.add_header("Content-Length", str(len(stego_medium)))
+            self.client.sendall(
+                self._build_response(
+                    cfg.STEGO_HTTP_VERSION, 200, "OK", header, stego_medium
+                )
+            )
+            if isinstance(cover, Image.Image):
+                cover.close()
+
+    def _resume_transfer(self, message):
+        """Sends a transfer again from the chunk the stegoclient is missing
+        on, if it is still kept.
+        """
+        transfers = self._get_transfer_cache()
+        try:
+            transfer_id, seq = unpack_resume(message)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        transfer = None
+        if transfers is not None:
+            transfer = transfers.acquire(transfer_id, cfg.RESUME_TTL)
+        if transfer is None or not transfer.can_resume(seq):
+            if transfer is not None:
+                transfers.release(transfer)
+            log.debug(f"Can't resume transfer {transfer_id} at chunk {seq}")
+            self.send_error(410, "Transfer not available")
+            return
+
+        log.info(f"Resuming transfer {transfer_id} at chunk {seq}")
+        transfers.record_resume(transfer.next_seq - seq)
+        header = Message()
+        header.add_header("Host", f"{cfg.REMOTE_ADDR[0]}:{cfg.REMOTE_ADDR[1]}")
+        header.add_header("Connection", "keep-alive")
+        header.add_header("Transfer-Encoding", "chunked")
+        try:
+            self.client.sendall(
+                self._build_response_header(
+                    cfg.STEGO_HTTP_VERSION, 200, "OK", header
+                )
+            )
+        except OSError as e:
+            log.info(f"Connection to stegoclient broke ({e})")
+            self.close_connection = True
+            transfers.release(transfer)
+            return
+        self._send_transfer(transfer, seq)
+
     def _connect_to_host(self):
         # Get hostname and port to connect to
         if self.is_connect:
@@ -87,86 +821,232 @@ class ServerProxyHandler(BaseProxyHandler):
             return
 
         # The request that contains the request to the website is located
-        # inside the POST request body from the stegoclient
+        # inside the POST request body from the stegoclient. Requests that
+        # don't fit into a single cover arrive as a chunked stego-request,
+        # with each chunk being a stego medium (i.e. image) of its own.
         log.debug("Got stego-request from stegoclient")
-        # io stream that represents the stego medium (i.e. image)
-        req_body = io.BytesIO(
-            self.rfile.read(int(self.headers.get("Content-Length", 0)))
-        )
-        stego_message = stego.extract(medium=req_body)
+        if self._is_chunked(self.headers):
+            media = self._iter_chunked(self.rfile)
+        else:
+            media = [
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            ]
+        messages = (stego.extract(medium=io.BytesIO(m)) for m in media)
+
+        # Extract the stego media until the whole request header is known
+        stego_message = b""
+        for message in messages:
+            stego_message += message
+            if is_tunnel(stego_message):
+                break
+            if END_OF_HEADERS.search(stego_message) is not None:
+                break
+
+        # The connection to the website
+        self.server = None
+
+        if is_tunnel(stego_message):
+            self._handle_tunnel(stego_message, messages)
+            return
+
+        if is_resume(stego_message):
+            self._resume_transfer(stego_message)
+            return
+
+        # Batches are always embedded in a single stego medium
+        if is_batch(stego_message):
+            stego_message += b"".join(messages)
+            self._handle_batch(unpack_batch(stego_message))
+            return
 
         # Get Host and Port from the original request
-        host, port = self._get_hostaddr_from_headers(stego_message)
+        command, path, version, headers, body = self._parse_request(
+            stego_message
+        )
+        host, port = self._get_hostaddr(path, headers)
+        url = self._get_url(path, host, port)
+        key = None
+        if cfg.SINGLEFLIGHT:
+            key = request_key(command, url, headers)
 
-        # establish connection to the website
-        log.info(f"Connecting to {host}:{port}")
-        self.server = Server(host=host, port=port)
+        # A fresh response of the cache is embedded right away
+        cached, stale = self._lookup_upstream_cache(command, url, headers)
+        if cached is None and key is not None:
+            # So is the response of an identical request in flight
+            cached = self._coalesce(
+                key,
+                lambda: self._forward_request(
+                    command, path, version, headers, body, messages, stale
+                ),
+            )
+        elif cached is None:
+            self._forward_request(
+                command, path, version, headers, body, messages, stale
+            )
+        if cached is not None:
+            # The end of a chunked stego-request might still be unread
+            for _ in messages:
+                pass
+            self._send_stego_payload(cached)
 
-        # Just relay the original request to the website
-        log.debug("Relaying extracted request to website")
-        self.server.send(stego_message)
+    def _forward_request(
+        self, command, path, version, headers, body, messages, stale
+    ):
+        """Relays the request to the website and embeds its response in
+        the stego-response.
 
-        # Parse response from website
-        h = HTTPResponse(self.server.conn)
-        h.begin()
+        Returns the whole response if it is small enough to be shared with
+        identical requests, otherwise ``None``.
+        """
+        host, port = self._get_hostaddr(path, headers)
+        url = self._get_url(path, host, port)
+        prefetch = self._wants_bundle(command, headers)
+        delta_base = headers.get(DELTA_BASE_HEADER)
+        upstream_req = self._build_upstream_request(
+            command, path, version, headers, body
+        )
 
-        # Get rid of hop-by-hop headers
+        # Relay the original request to the website over a (possibly
+        # already established) connection. The rest of a chunked
+        # stego-request is relayed while it is still being extracted.
+        log.info(f"Connecting to {host}:{port}")
+        log.debug("Relaying extracted request to website")
+        request_time = time.time()
+        try:
+            self.server, h = self._send_to_website(
+                host, port, command, upstream_req, messages
+            )
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            # The rest of the stego-request might still be unread
+            self.close_connection = True
+            self.send_error(502, str(e))
+            return None
+
+        # Remember whether the connection can be reused before the
+        # hop-by-hop headers get removed
+        keep_alive = self._parse_keep_alive(h.msg)
+        try:
+            cached, reader = self._cache_upstream_response(
+                command, url, headers, stale, h, request_time
+            )
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            self._release_upstream(self.server, h, False, keep_alive)
+            self.send_error(502, str(e))
+            return None
+        if cached is not None:
+            self._release_upstream(self.server, h, True, keep_alive)
+            self._send_stego_payload(cached)
+            return cached
         self.filter_headers(h.msg)
+        recorded = []
+        try:
+            if prefetch:
+                reader = self._bundle(path, headers, h, reader)
+            bundled = BUNDLE_HEADER in h.msg
+            if not bundled:
+                reader = self._transcode(command, url, headers, h, reader)
+                reader = self._minify(command, url, headers, h, reader)
+                reader = self._delta(command, url, delta_base, h, reader)
+                reader = self._compress(command, url, h, reader)
+        except Exception as e:
+            log.error(f"Error proxying: {str(e)}")
+            self._release_upstream(self.server, h, False, keep_alive)
+            self.send_error(502, str(e))
+            return None
+        length = self._get_body_length(h, reader)
+        if not bundled:
+            reader = self._record_response(command, h, reader, recorded)
 
-        # Build response from website
+        # Build response header from website
         log.debug("Building response from website")
-        stego_resp = self._build_stego_response(
-            self.request_version, h.status, h.reason, h.msg, h.read()
+        response_header = self._build_response_header(
+            self.request_version, h.status, h.reason, h.msg
         )
 
+        # The stego-response always carries a body, which must not be sent
+        # with a status that forbids one as it would break the framing of
+        # the connection to the stegoclient.
+        status, reason = h.status, h.reason
+        if status < 200 or status in (204, 304):
+            status, reason = 200, "OK"
+
         # Build header to stegoclient
         header = Message()
         header.add_header("Host", f"{cfg.REMOTE_ADDR[0]}:{cfg.REMOTE_ADDR[1]}")
         header.add_header("Connection", "keep-alive")
         cover = self._get_cover_object()
         max_size = self._calc_max_size(cover)
-        resp_len = len(stego_resp)
+        # The number of bytes of the response that fit into one stego
+        # medium once they are base64 encoded. Every chunk gets decoded on
+        # its own so it must not split a 4 character block of base64.
+        slice_size = max_size // 4 * 3
 
-        if(max_size is not None and resp_len > max_size):
+        if (
+            bundled
+            or length is None
+            or len(response_header) + length > slice_size
+        ):
             log.debug(
-                f"Can't fit response ({resp_len} bytes) into stego-response - "
-                f"splitting into chunks of {max_size} bytes."
+                f"Can't fit response into stego-response - splitting into "
+                f"chunks of up to {max_size} bytes."
             )
 
             header.add_header("Transfer-Encoding", "chunked")
             resp_to_client = self._build_response_header(
-                cfg.STEGO_HTTP_VERSION, h.status, h.reason, header
+                cfg.STEGO_HTTP_VERSION, status, reason, header
             )
+            transfer = self._create_transfer()
 
             # Send headers to client
             log.debug("Sending chunked stego-response header to stegoclient")
-            self.client.send(resp_to_client)
+            try:
+                self.client.sendall(resp_to_client)
+            except OSError:
+                self._release_upstream(self.server, h, False, keep_alive)
+                self._release_transfer(transfer, keep=False)
+                raise
 
-            start = time.time()
-            chunk_count = 0
-            for chunk in self._split_into_chunks(
-                stego_resp, max_size
-            ):
-                if isinstance(cover, Image.Image):
-                    tmp_cover = cover.copy()
-                else:
-                    tmp_cover = cover
-
-                # Send chunks
-                log.debug(f"Sending chunk with size: {len(chunk)} bytes")
-                self._write_chunks(stego.embed(cover=tmp_cover, message=chunk))
-                chunk_count += 1
+            # The first chunk should at least carry the whole header
+            sizes = ChunkScheduler(
+                slice_size,
+                policy=cfg.CHUNK_RAMP,
+                start=max(cfg.CHUNK_RAMP_START, len(response_header)),
+                factor=cfg.CHUNK_RAMP_FACTOR,
+            )
 
-            end = time.time()
-            # send "end of chunks" trailer
-            self._write_end_of_chunks()
-            log.debug(f"{chunk_count} chunks sent in {end - start:.2f}s.")
+            conn = self.server
+            self._start_transfer(
+                transfer,
+                reader,
+                response_header,
+                cover,
+                sizes,
+                lambda complete: self._release_upstream(
+                    conn, h, complete, keep_alive
+                ),
+            )
+            self._send_transfer(transfer)
         else:
+            try:
+                response_body = reader.read()
+            except Exception as e:
+                log.error(f"Error proxying: {str(e)}")
+                self._release_upstream(self.server, h, False, keep_alive)
+                self.send_error(502, str(e))
+                return None
+            self._release_upstream(self.server, h, True, keep_alive)
+
             # Encapsulate response inside response to stego client
             log.debug("Embedding response from website in stego-response")
 
+            stego_resp = self._encode(response_header + response_body)
             start = time.time()
-            stego_medium = stego.embed(cover=cover, message=stego_resp)
+            stego_medium = stego.embed(
+                cover=self._crop_cover(cover, len(stego_resp)),
+                message=stego_resp,
+            )
             end = time.time()
             log.debug(
                 f"Took {end - start:.2f}s to embed response in stego-response"
@@ -175,19 +1055,646 @@ class ServerProxyHandler(BaseProxyHandler):
             header.add_header("Content-Length", str(len(stego_medium)))
 
             resp_to_client = self._build_response(
-                cfg.STEGO_HTTP_VERSION, h.status, h.reason, header, stego_medium
+                cfg.STEGO_HTTP_VERSION, status, reason, header, stego_medium
             )
 
             # Relay the message
             log.debug("Relaying stego-response to stegoclient")
-            self.client.send(resp_to_client)
+            self.client.sendall(resp_to_client)
+            if isinstance(cover, Image.Image):
+                cover.close()
+
+        return recorded[0] if recorded else None
+
+    def _wants_bundle(self, command, headers):
+        """Checks if the subresources of the requested page should be sent
+        along with it.
+        """
+        return cfg.PREFETCH and command == "GET" and PREFETCH_HEADER in headers
+
+    def _bundle(self, path, headers, h, reader):
+        """Prefetches the subresources of an HTML page.
+
+        Returns a reader of the page followed by the bundle of its
+        subresources. The page is read completely to find them, responses
+        that aren't HTML pages or larger than
+        ``cfg.PREFETCH_MAX_HTML_SIZE`` bytes are left alone.
+        """
+        length = self._get_body_length(h, reader)
+        if (
+            h.status != 200
+            or h.msg.get_content_type() != "text/html"
+            or h.msg.get("Content-Encoding", "identity") != "identity"
+            or (length is not None and length > cfg.PREFETCH_MAX_HTML_SIZE)
+        ):
+            return reader
+
+        page, rest = self._read_limited(reader, cfg.PREFETCH_MAX_HTML_SIZE)
+        if page is None:
+            return rest
+        del h.msg["Content-Length"]
+        h.msg["Content-Length"] = str(len(page))
+        urls = find_subresources(page, path, cfg.PREFETCH_MAX_RESOURCES)
+        if not urls:
+            return PieceReader([page])
+
+        log.debug(f"Prefetching {len(urls)} subresources of {path}")
+        h.msg[BUNDLE_HEADER] = str(len(urls))
+        return PieceReader(
+            itertools.chain([page], self._iter_bundle(path, headers, urls))
+        )
+
+    def _iter_bundle(self, path, headers, urls):
+        """Fetches the subresources of a page concurrently and yields the
+        messages of their bundle.
+        """
+        requests = []
+        for url in urls:
+            request_headers = Message()
+            request_headers["Host"] = urlsplit(url).netloc
+            for name in (
+                "User-Agent",
+                "Accept-Encoding",
+                "Accept-Language",
+                "Cookie",
+            ):
+                if name in headers:
+                    request_headers[name] = headers[name]
+            request_headers["Accept"] = "*/*"
+            request_headers["Referer"] = path
+            requests.append(
+                self._build_request_header(
+                    "GET", url, "HTTP/1.1", request_headers
+                )
+            )
+
+        yield pack_message("\n".join(urls).encode("utf-8"))
+        executor = ThreadPoolExecutor(max_workers=cfg.PREFETCH_CONCURRENCY)
+        try:
+            futures = [executor.submit(self._fetch, r) for r in requests]
+            deadline = time.time() + cfg.PREFETCH_TIMEOUT
+            for url, request, future in zip(urls, requests, futures):
+                response = status = None
+                try:
+                    response = future.result(max(0, deadline - time.time()))
+                    status = self._parse_response(response)[1]
+                except Exception as e:
+                    log.debug(f"Couldn't prefetch {url}: {e}")
+                if (
+                    response is None
+                    or status != 200
+                    or len(response) > cfg.PREFETCH_MAX_RESOURCE_SIZE
+                ):
+                    yield pack_message(b"")
+                else:
+                    yield pack_message(request + response)
+        finally:
+            executor.shutdown(wait=False)
+
+    def _read_limited(self, reader, max_size):
+        """Reads a whole body if it isn't larger than ``max_size`` bytes.
+
+        Returns the body, or ``None`` and a reader of the body if it is
+        larger. The rest of it is read while it is arriving then.
+        """
+        body = bytearray()
+        while len(body) <= max_size:
+            data = reader.read(max_size + 1 - len(body))
+            if not data:
+                return bytes(body), None
+            body += data
+        rest = iter(lambda: reader.read(cfg.STREAM_BUFFER_SIZE), b"")
+        return None, PieceReader(itertools.chain([bytes(body)], rest))
+
+    def _no_transform(self, request_headers, headers):
+        """Checks if the request or the response forbids to transform the
+        body of the response.
+        """
+        # http://tools.ietf.org/html/rfc7230#section-5.7.2
+        return any(
+            h is not None
+            and "no-transform" in parse_cache_control(h.get("Cache-Control"))
+            for h in (request_headers, headers)
+        )
+
+    def _may_transcode(self, request_headers, headers, length):
+        """Checks if an image may be transcoded. ``length`` is the size of
+        the image or ``None`` if it is unknown.
+        """
+        if (
+            not cfg.TRANSCODE
+            or headers.get_content_type() not in TRANSCODABLE_TYPES
+            or headers.get("Content-Encoding", "identity").lower()
+            != "identity"
+            or self._no_transform(request_headers, headers)
+        ):
+            return False
+        return length is None or (
+            cfg.TRANSCODE_MIN_SIZE <= length <= cfg.TRANSCODE_MAX_SIZE
+        )
+
+    def _transcode(self, command, url, headers, h, reader):
+        """Re-encodes an image to a smaller variant.
+
+        Returns a reader of the variant (or of the image if there isn't a
+        smaller one) once the image has been read.
+        """
+        length = self._get_body_length(h, reader)
+        if (
+            command != "GET"
+            or h.status != 200
+            or not self._may_transcode(headers, h.msg, length)
+        ):
+            return reader
+
+        body, rest = self._read_limited(reader, cfg.TRANSCODE_MAX_SIZE)
+        if body is None:
+            return rest
+        if len(body) >= cfg.TRANSCODE_MIN_SIZE:
+            body = self._transcode_body(url, h.msg, body)
+        del h.msg["Content-Length"]
+        h.msg["Content-Length"] = str(len(body))
+        return PieceReader([body])
+
+    def _transcode_body(self, url, headers, body):
+        """Returns the smaller variant of an image, or the image if there
+        isn't one.
+        """
+        start = time.time()
+        variant = transcode(
+            body,
+            cfg.TRANSCODE_QUALITY,
+            cfg.TRANSCODE_MAX_WIDTH,
+            cfg.TRANSCODE_MAX_HEIGHT,
+        )
+        if variant is None:
+            return body
+
+        data, content_type = variant
+        log.debug(
+            f"Transcoded {url} from {len(body)} to {len(data)} bytes "
+            f"in {time.time() - start:.2f}s"
+        )
+        del headers["Content-Type"]
+        headers["Content-Type"] = content_type
+        del headers["Content-Length"]
+        headers["Content-Length"] = str(len(data))
+        # http://tools.ietf.org/html/rfc7234#section-5.5.7
+        headers["Warning"] = '214 - "Transformation Applied"'
+        return data
+
+    def _may_minify(self, request_headers, headers, length):
+        """Checks if a body may be minified. ``length`` is the size of the
+        body or ``None`` if it is unknown. Text that the website has
+        compressed is decompressed to minify it, the compression policy
+        compresses it again.
+        """
+        coding = headers.get("Content-Encoding", "identity").lower()
+        if (
+            not cfg.MINIFY
+            or headers.get_content_type() not in cfg.MINIFY_TYPES
+            or (
+                coding != "identity"
+                and not (cfg.COMPRESSION and coding in DECODABLE_CODINGS)
+            )
+            or self._no_transform(request_headers, headers)
+        ):
+            return False
+        return length is None or length <= cfg.MINIFY_MAX_SIZE
+
+    def _minify(self, command, url, headers, h, reader):
+        """Removes the whitespace and the comments from a text body.
+
+        Returns a reader of the minified body once the body has been read,
+        which is only done for bodies up to ``cfg.MINIFY_MAX_SIZE`` bytes.
+        Larger ones are relayed while they are arriving.
+        """
+        if (
+            command != "GET"
+            or h.status != 200
+            or not self._may_minify(
+                headers, h.msg, self._get_body_length(h, reader)
+            )
+        ):
+            return reader
+
+        body, rest = self._read_limited(reader, cfg.MINIFY_MAX_SIZE)
+        if body is None:
+            return rest
+        body = self._minify_body(url, h.msg, body)
+        del h.msg["Content-Length"]
+        h.msg["Content-Length"] = str(len(body))
+        return PieceReader([body])
+
+    def _minify_body(self, url, headers, body):
+        """Returns the minified body, or the body if it can't be minified."""
+        coding = headers.get("Content-Encoding", "identity").lower()
+        text = body
+        if coding != "identity":
+            try:
+                text = decode(body, coding, cfg.MINIFY_MAX_SIZE)
+            except ValueError as e:
+                log.debug(f"Couldn't decompress the response for {url}: {e}")
+                return body
+
+        minified = minify(text, headers.get("Content-Type"))
+        if minified is None:
+            return body
+        self.minification_stats.record(
+            headers.get_content_type(), len(text), len(minified)
+        )
+        log.debug(f"Minified {url} from {len(text)} to {len(minified)} bytes")
+        del headers["Content-Encoding"]
+        del headers["Content-Length"]
+        headers["Content-Length"] = str(len(minified))
+        # http://tools.ietf.org/html/rfc7234#section-5.5.7
+        headers["Warning"] = '214 - "Transformation Applied"'
+        return minified
+
+    def _delta(self, command, url, base, h, reader):
+        """Replaces the body of a response with a delta to the version the
+        stegoclient has got, which is identified by the digest ``base``,
+        if the delta is smaller. The body becomes the version the next
+        response for the URL is compared to.
+
+        Returns a reader of the new body if the body has been read, which
+        is only done for text responses of a known length up to
+        ``cfg.DELTA_MAX_SIZE`` bytes. Text that the website has compressed
+        is decompressed to compare it, the compression policy compresses
+        it again if there is no delta.
+        """
+        store = self._get_delta_store()
+        coding = h.msg.get("Content-Encoding", "identity").lower()
+        length = self._get_body_length(h, reader)
+        if (
+            store is None
+            or command != "GET"
+            or h.status != 200
+            or not is_compressible(h.msg.get("Content-Type"))
+            or (
+                coding != "identity"
+                and not (cfg.COMPRESSION and coding in DECODABLE_CODINGS)
+            )
+            or length is None
+            or length > cfg.DELTA_MAX_SIZE
+        ):
+            return reader
+
+        body, rest = self._read_limited(reader, cfg.DELTA_MAX_SIZE)
+        if body is None:
+            return rest
+
+        if coding != "identity":
+            try:
+                body = decode(body, coding, cfg.DELTA_MAX_SIZE)
+            except ValueError as e:
+                log.debug(f"Couldn't decompress the response for {url}: {e}")
+                del h.msg["Content-Length"]
+                h.msg["Content-Length"] = str(len(body))
+                return PieceReader([body])
+            del h.msg["Content-Encoding"]
+
+        last = store.get(url)
+        store.put(url, body)
+        if base is not None and last is not None and last[0] == base:
+            delta = make_delta(
+                last[1], body, int(len(body) * cfg.DELTA_MAX_RATIO)
+            )
+            if delta is not None:
+                log.debug(
+                    f"Sending a delta of {len(delta)} bytes instead of "
+                    f"{len(body)} bytes for {url}"
+                )
+                store.record_delta(len(body), len(delta))
+                h.msg[DELTA_HEADER] = base
+                body = delta
+        del h.msg["Content-Length"]
+        h.msg["Content-Length"] = str(len(body))
+        return PieceReader([body])
+
+    def _compress(self, command, url, h, reader):
+        """Applies the compression policy to the body of a response. A
+        body of a known length is compressed at once, others while they
+        are read.
+        """
+        if (
+            not cfg.COMPRESSION
+            or command == "HEAD"
+            or h.status < 200
+            or h.status in (204, 304)
+        ):
+            return reader
+
+        length = self._get_body_length(h, reader)
+        decision = self._skip_compression(h.msg, length)
+        if decision is not None:
+            self._record_compression(url, decision, length, length)
+            return reader
+        if length is not None and length <= cfg.COMPRESSION_BUFFER_SIZE:
+            body = self._compress_body(url, h.msg, reader.read())
+            return PieceReader([body])
 
-        if isinstance(cover, Image.Image):
-            cover.close()
+        del h.msg["Content-Length"]
+        h.msg[STEGO_ENCODING_HEADER] = "deflate"
+        return CompressingReader(
+            reader,
+            cfg.COMPRESSION_LEVEL,
+            lambda size, sent_size: self._record_compression(
+                url, "compressed", size, sent_size
+            ),
+        )
+
+    def _compress_body(self, url, headers, body):
+        """Applies the compression policy to a whole body and returns the
+        body that gets embedded.
+        """
+        decision = self._skip_compression(headers, len(body))
+        sent = body
+        if decision is None:
+            compressed = compress(body, cfg.COMPRESSION_LEVEL)
+            if len(compressed) < len(body):
+                decision, sent = "compressed", compressed
+                headers[STEGO_ENCODING_HEADER] = f"deflate; length={len(body)}"
+            else:
+                decision = "incompressible"
+        del headers["Content-Length"]
+        headers["Content-Length"] = str(len(sent))
+        self._record_compression(url, decision, len(body), len(sent))
+        return sent
+
+    def _skip_compression(self, headers, length):
+        """Returns why a body isn't compressed, or ``None`` if it is."""
+        if DELTA_HEADER in headers:
+            return "delta"
+        if headers.get("Content-Encoding", "identity").lower() != "identity":
+            return "encoded"
+        if not is_compressible(headers.get("Content-Type")):
+            return "media"
+        if length is not None and length < cfg.COMPRESSION_MIN_SIZE:
+            return "small"
+        return None
+
+    def _record_compression(self, url, decision, size, sent_size):
+        """Records the decision of the compression policy for a response.
+        The sizes are ``None`` for a body of unknown length.
+        """
+        self.compression_stats.record(decision, size or 0, sent_size or 0)
+        log.debug(
+            f"Compression of {url}: {decision} "
+            f"({size if size is not None else '?'} -> "
+            f"{sent_size if sent_size is not None else '?'} bytes)"
+        )
+
+    def _get_body_length(self, h, reader):
+        """Returns the number of bytes of the body that are left to read,
+        or ``None`` if it is unknown. A body that has been read or wrapped
+        to replace it has got a new Content-Length, if it is known.
+        """
+        if isinstance(reader, (HTTPResponse, CachingReader)):
+            return h.length
+        if BUNDLE_HEADER in h.msg or "Content-Length" not in h.msg:
+            return None
+        return int(h.msg["Content-Length"])
+
+    def _record_response(self, command, h, reader, recorded):
+        """Wraps the reader of the response body so that the whole response
+        is appended to ``recorded`` once it has been read, unless it is
+        too large to be shared with identical requests.
+        """
+
+        def record(body):
+            headers = parse_headers(io.BytesIO(h.msg.as_bytes()))
+            bodyless = h.status < 200 or h.status in (204, 304)
+            if command != "HEAD" and not bodyless:
+                del headers["Content-Length"]
+                headers["Content-Length"] = str(len(body))
+            recorded.append(
+                self._build_response(
+                    self.request_version, h.status, h.reason, headers, body
+                )
+            )
+
+        return CachingReader(reader, cfg.SINGLEFLIGHT_MAX_SIZE, record)
+
+    def _coalesce(self, key, forward):
+        """Calls ``forward`` unless an identical request is in flight.
+
+        Returns the response of the identical request, or ``None`` if the
+        request has been forwarded. ``forward`` relays the request and
+        returns the response if it can be shared.
+        """
+        leader = False
+
+        def run():
+            nonlocal leader
+            leader = True
+            return forward()
+
+        try:
+            response, shared = self.flights.do(key, run)
+        except Exception:
+            if leader:
+                raise
+            response = None
+        if leader:
+            return None
 
-        # Let's close off the remote end
+        if response is None:
+            log.debug("Couldn't share the response, forwarding the request")
+            forward()
+        else:
+            log.debug("Sharing the response of an identical request")
+        return response
+
+    def _release_upstream(self, conn, h, complete, keep_alive):
+        """Hands the connection to the website back to the pool. It can be
+        used for the next request if the whole response has been read and
+        the website doesn't want to close it.
+        """
+        timeout, max_requests = keep_alive
+        reusable = complete and not h.will_close
+        if max_requests is not None and max_requests <= 1:
+            reusable = False
         h.close()
-        self.server.close()
+        self.upstream_pool.release(conn, reusable, timeout)
+
+    def _read_pieces(self, h, response_header, max_size, pieces, stop):
+        """Reads the response from the website and puts it into the
+        ``pieces`` queue as it arrives, in pieces of up to ``max_size``
+        bytes. The response header is the first piece. The end of the
+        response is signaled with ``None``.
+        """
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pieces.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            if response_header and not put(response_header):
+                return
+            while True:
+                # Don't wait for more than what the website has sent
+                data = h.read1(max_size)
+                if not data:
+                    break
+                if not put(data):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def _create_transfer(self):
+        """Creates a transfer for a chunked stego-response. It is
+        resumable unless resuming is disabled.
+        """
+        transfer = Transfer(cfg.RESUME_WINDOW if cfg.RESUME else 0)
+        transfer.lock.acquire()
+        if transfer.resumable:
+            self._get_transfer_cache().add(transfer)
+        return transfer
+
+    def _start_transfer(
+        self, transfer, h, response_header, cover, sizes, release=None
+    ):
+        """Starts to read the response from the website for a transfer.
+        The response is read in a separate thread so the next slice can
+        arrive while the current one is being embedded.
+
+        :param sizes: The :class:`ChunkScheduler` of the slices.
+        :param release: Called with whether the whole response has been
+                        read once it isn't needed any more.
+        """
+        if transfer.resumable:
+            # Tell the stegoclient how to resume the transfer if its
+            # connection breaks
+            response_header = announce_transfer(transfer.id) + response_header
+        pieces = queue.Queue(cfg.PIPELINE_DEPTH)
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=self._read_pieces,
+            args=(h, response_header, sizes.max_size, pieces, stop),
+        )
+        reader.daemon = True
+        reader.start()
+        conn = self.server
+
+        def iter_slices():
+            # A slice is embedded as soon as there is something to embed.
+            # It gets whatever has arrived in the meantime, up to the next
+            # size of the ramp, so a slow website doesn't hold back the
+            # part of the response that is already there.
+            buffer = bytearray()
+            end = False
+            for size in sizes:
+                while not end and len(buffer) < size:
+                    try:
+                        data = pieces.get(block=not buffer)
+                    except queue.Empty:
+                        break
+                    if data is None:
+                        end = True
+                    elif isinstance(data, Exception):
+                        raise data
+                    else:
+                        buffer += data
+                if not buffer:
+                    return
+                yield bytes(buffer[:size])
+                del buffer[:size]
+
+        def close(complete):
+            stop.set()
+            if not complete and release is not None and conn is not None:
+                # Unblock the reader if it is waiting for the website
+                try:
+                    conn.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            reader.join()
+            if release is not None:
+                release(complete)
+            if isinstance(cover, Image.Image):
+                cover.close()
+
+        transfer.start(iter_slices(), cover, close)
+
+    def _send_transfer(self, transfer, seq=0):
+        """Sends the chunks of a transfer from the chunk ``seq`` on. The
+        chunks that have been embedded already are sent again as they are,
+        the others are embedded while the response from the website is
+        arriving.
+
+        A transfer is closed once it has been sent. If the connection to
+        the stegoclient breaks, a resumable transfer is kept to be resumed
+        and the connection is closed.
+        """
+        start = time.time()
+        chunk_count = 0
+        sending = keep = False
+        try:
+            for seq in range(seq, transfer.next_seq):
+                sending = True
+                self._write_chunks(transfer.get(seq))
+                sending = False
+                chunk_count += 1
+
+            for data in transfer.source:
+                # Small chunks get a cropped cover, they are faster to embed
+                message = self._encode(data)
+                medium = stego.embed(
+                    cover=self._crop_cover(transfer.cover, len(message)),
+                    message=message,
+                )
+                seq = transfer.add(medium)
+
+                # Send chunks
+                log.debug(
+                    f"Sending chunk {seq} with size: {len(message)} bytes"
+                )
+                sending = True
+                self._write_chunks(medium)
+                sending = False
+                if chunk_count == 0:
+                    log.debug(
+                        f"First chunk sent after {time.time() - start:.2f}s."
+                    )
+                chunk_count += 1
+            transfer.finish()
+
+            # send "end of chunks" trailer
+            sending = True
+            self._write_end_of_chunks()
+            sending = False
+            log.debug(
+                f"{chunk_count} chunks sent in {time.time() - start:.2f}s."
+            )
+        except OSError as e:
+            self.close_connection = True
+            if not sending:
+                raise
+            # The stegoclient went away, which happens all the time
+            keep = transfer.resumable
+            if keep:
+                log.info(
+                    f"Connection to stegoclient broke ({e}), keeping "
+                    f"transfer {transfer.id} with {transfer.next_seq} chunks"
+                )
+            else:
+                log.info(f"Connection to stegoclient broke ({e})")
+        finally:
+            self._release_transfer(transfer, keep)
+
+    def _release_transfer(self, transfer, keep):
+        if transfer.resumable:
+            self._get_transfer_cache().release(transfer, keep)
+        else:
+            transfer.close()
+            transfer.lock.release()
 
     def __getattr__(self, item):
         if item.startswith("do_POST"):
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.transcode
+    ~~~~~~~~~~~~~~~~~~~~
+
+    This module re-encodes the images of the websites to smaller variants
+    before they are embedded. Images are scaled down to a maximum size,
+    photos are re-encoded as JPEG with a lower quality and images with
+    transparency are reduced to a palette of 256 colors. Animated images
+    are left alone.
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import io
+import logging
+
+from PIL import Image, ImageOps
+
+log = logging.getLogger(__name__)
+# The media types of the images that are transcoded
+TRANSCODABLE_TYPES = ("image/gif", "image/jpeg", "image/png")
+
+
+def _has_alpha(image):
+    return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+
+def transcode(body, quality, max_width, max_height):
+    """Returns a smaller variant of an image and its media type, or
+    ``None`` if there isn't one.
+
+    :param body: The image as bytes.
+    :param quality: The JPEG quality (1-95) of the variant.
+    :param max_width: The maximum width of the variant.
+    :param max_height: The maximum height of the variant.
+    """
+    try:
+        with Image.open(io.BytesIO(body)) as original:
+            if getattr(original, "is_animated", False):
+                return None
+            # The orientation is lost along with the metadata
+            image = ImageOps.exif_transpose(original)
+            image.thumbnail((max_width, max_height))
+
+            output = io.BytesIO()
+            if _has_alpha(image):
+                if image.mode != "P":
+                    image = image.convert("RGBA").quantize(
+                        colors=256, method=Image.FASTOCTREE
+                    )
+                image.save(output, format="PNG", optimize=True)
+                content_type = "image/png"
+            else:
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image.save(
+                    output,
+                    format="JPEG",
+                    quality=quality,
+                    optimize=True,
+                    progressive=True,
+                    icc_profile=original.info.get("icc_profile"),
+                )
+                content_type = "image/jpeg"
+    except Exception as e:
+        log.debug(f"Couldn't transcode image: {e}")
+        return None
+
+    data = output.getvalue()
+    if len(data) >= len(body):
+        return None
+    return data, content_type
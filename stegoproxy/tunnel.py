@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+"""
+    stegoproxy.tunnel
+    ~~~~~~~~~~~~~~~~~
+
+    This module contains the sessions that multiplex many streams over
+    one persistent connection between the stegoclient and the stegoserver.
+
+    The stegoclient opens a tunnel with a chunked stego-request that
+    doesn't end until the tunnel is closed and the stegoserver answers
+    with a chunked stego-response. Every chunk in either direction is a
+    stego medium that carries the frames (see :mod:`stegoproxy.framing`)
+    of as many streams as fit into it. The heads of the HTTP messages are
+    sent compressed (see :mod:`stegoproxy.hpack`).
+
+    :copyright: (c) 2018 by Peter Justin, see AUTHORS for more details.
+    :license: GPLv3, see LICENSE for more details.
+"""
+import collections
+import logging
+import socket
+import threading
+import time
+
+from stegoproxy.exceptions import StreamReset, TunnelClosed
+from stegoproxy.framing import (
+    DATA,
+    END_HEADERS,
+    END_STREAM,
+    FRAME_HEADER,
+    HEADERS,
+    RST_STREAM,
+    WINDOW_UPDATE,
+    FrameParser,
+    data_frame,
+    headers_frame,
+    parse_increment,
+    rst_stream_frame,
+    window_update_frame,
+)
+from stegoproxy.hpack import DEFAULT_TABLE_SIZE, HeaderDecoder, HeaderEncoder
+
+log = logging.getLogger(__name__)
+# The first stego medium of a tunnel starts with this. A plain request
+# always starts with the request line so it can't be mistaken for a tunnel.
+TUNNEL_MAGIC = b"\x00STEGOTUNNEL\x00"
+
+
+def is_tunnel(data):
+    """Checks if an extracted stego-message opens a tunnel."""
+    return data.startswith(TUNNEL_MAGIC)
+
+
+class Stream(object):
+    """A bidirectional stream of bytes inside a session.
+
+    Writing blocks while the peer hasn't received the data that has been
+    written before, reading blocks until the peer sends something.
+    """
+
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.id = stream_id
+        #: The number of bytes the peer is willing to receive
+        self.send_window = session.window
+        #: The number of bytes the peer may still send
+        self.recv_window = session.window
+        self.error = None
+        self._cond = session._cond
+        self._outgoing = bytearray()
+        # The number of heads that are queued but not completely sent, the
+        # data of the stream has to wait for them
+        self._heads_pending = 0
+        self._reset_pending = False
+        self._end_pending = False
+        self._end_sent = False
+        self._scheduled = False
+        self._incoming = collections.deque()
+        self._end_received = False
+        self._consumed = 0
+
+    @property
+    def finished(self):
+        return self._end_sent and self._end_received
+
+    def write(self, data):
+        """Sends data to the peer."""
+        view = memoryview(data)
+        with self._cond:
+            while view:
+                while (
+                    len(self._outgoing) >= self.session.window
+                    and self.error is None
+                ):
+                    self._cond.wait()
+                if self.error is not None:
+                    raise self.error
+                if self._end_pending:
+                    raise ValueError("Write to a closed stream.")
+
+                n = self.session.window - len(self._outgoing)
+                self._outgoing += view[:n]
+                view = view[n:]
+                self.session._schedule(self)
+
+    def write_head(self, head):
+        """Sends the head of an HTTP message, which gets compressed. The
+        peer reads it like any other data.
+        """
+        with self._cond:
+            if self.error is not None:
+                raise self.error
+            if self._end_pending:
+                raise ValueError("Write to a closed stream.")
+            self.session._queue_head(self, head)
+
+    def close(self):
+        """Tells the peer that no more data will be sent."""
+        with self._cond:
+            if self.error is None and not self._end_pending:
+                self._end_pending = True
+                self.session._schedule(self)
+
+    def reset(self):
+        """Aborts the stream in both directions."""
+        with self._cond:
+            if self.error is not None or self.finished:
+                return
+            self.error = StreamReset(f"Stream {self.id} has been reset.")
+            if self._heads_pending:
+                # The peer must still decode the heads, the stream is reset
+                # once they have been sent
+                self._reset_pending = True
+            else:
+                self.session._control.append(rst_stream_frame(self.id))
+            self.session._remove(self)
+
+    def read(self):
+        """Returns the next piece of data from the peer or ``b""`` if the
+        peer won't send anything else.
+        """
+        with self._cond:
+            while (
+                not self._incoming
+                and not self._end_received
+                and self.error is None
+            ):
+                self._cond.wait()
+
+            if self._incoming:
+                data = self._incoming.popleft()
+                self._consumed += len(data)
+                # Let the peer send more once half of the window is used up
+                if (
+                    self._consumed >= self.session.window // 2
+                    and not self._end_received
+                ):
+                    self.session._control.append(
+                        window_update_frame(self.id, self._consumed)
+                    )
+                    self.recv_window += self._consumed
+                    self._consumed = 0
+                    self._cond.notify_all()
+                return data
+
+            if self.error is not None:
+                raise self.error
+            return b""
+
+    def __iter__(self):
+        while True:
+            data = self.read()
+            if not data:
+                return
+            yield data
+
+
+class Session(object):
+    """Multiplexes streams over a connection that carries stego media.
+
+    The frames of all streams are written by one thread. It takes one
+    frame from every stream in turn until the payload of a stego medium is
+    full, so a large response can't hold up the others.
+
+    :param send_payload: A callable that embeds a payload in a stego
+                         medium and sends it to the peer.
+    :param max_payload: The maximum size of a payload in bytes.
+    :param client: ``True`` for the side that opens the streams.
+    :param accept: A callable that is called with every stream the peer
+                   opens.
+    :param window: The number of bytes that may be in flight per stream.
+    :param max_frame: The maximum size of the data in a frame.
+    :param idle_timeout: The number of seconds after which the session is
+                         closed if there are no streams. ``None`` keeps it
+                         open.
+    :param flush_delay: The number of seconds to wait for further frames
+                        before a payload that isn't full is sent (like
+                        Nagle's algorithm), so that many small writes such
+                        as TLS records end up in one stego medium.
+    :param on_close: A callable that is called when the session has been
+                     closed and all frames have been sent.
+    :param header_table_size: The size of the table that compresses the
+                              heads sent to the peer.
+    """
+
+    def __init__(
+        self,
+        send_payload,
+        max_payload,
+        client=True,
+        accept=None,
+        window=262144,
+        max_frame=16384,
+        idle_timeout=None,
+        flush_delay=0,
+        on_close=None,
+        header_table_size=DEFAULT_TABLE_SIZE,
+    ):
+        self.send_payload = send_payload
+        self.max_payload = max_payload
+        self.accept = accept
+        self.window = window
+        self.max_frame = max_frame
+        self.idle_timeout = idle_timeout
+        self.flush_delay = flush_delay
+        self.on_close = on_close
+        #: No new streams are accepted once the session is closed
+        self.closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._streams = {}
+        self._ready = collections.deque()  # streams with frames to send
+        self._control = []  # frames that are sent before any data
+        self._heads = collections.deque()  # [stream, header block] to send
+        self._encoder = HeaderEncoder(header_table_size)
+        self._decoder = HeaderDecoder()
+        self._header_block = bytearray()  # the pieces of an incoming head
+        self._next_id = 1 if client else 2
+        self._last_peer_id = 0
+        self._last_active = time.time()
+        self._pending_since = None  # when the oldest unsent frame was queued
+        self._parser = FrameParser()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+
+    @property
+    def active_streams(self):
+        return len(self._streams)
+
+    def start(self):
+        self._writer.start()
+
+    def join(self, timeout=None):
+        self._writer.join(timeout)
+
+    def open_stream(self):
+        """Opens a new stream."""
+        with self._cond:
+            if self.closed:
+                raise TunnelClosed("The tunnel has been closed.")
+            stream = Stream(self, self._next_id)
+            self._next_id += 2
+            self._streams[stream.id] = stream
+            self._last_active = time.time()
+            return stream
+
+    def close(self):
+        """Closes the session once the pending frames have been sent.
+        Streams that haven't finished yet are reset.
+        """
+        self._shutdown(TunnelClosed("The tunnel has been closed."))
+
+    def terminate(self, error):
+        """Closes the session right away."""
+        with self._cond:
+            self._error = error
+        self._shutdown(error)
+
+    def _shutdown(self, error):
+        with self._cond:
+            self.closed = True
+            for stream in list(self._streams.values()):
+                if stream.error is None:
+                    stream.error = error
+                self._remove(stream)
+            self._cond.notify_all()
+
+    def _schedule(self, stream):
+        # must be called with the lock held
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if not stream._scheduled:
+            stream._scheduled = True
+            self._ready.append(stream)
+        self._cond.notify_all()
+
+    def _queue_head(self, stream, head):
+        # must be called with the lock held. The heads are encoded and sent
+        # in the same order, the peer decodes them in that order.
+        self._heads.append([stream, self._encoder.encode(head)])
+        stream._heads_pending += 1
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        self._cond.notify_all()
+
+    def _remove(self, stream):
+        # must be called with the lock held
+        if self._streams.pop(stream.id, None) is not None:
+            self._last_active = time.time()
+        self._cond.notify_all()
+
+    def _is_new(self, stream_id):
+        # The peer opens streams with the other parity
+        return (
+            stream_id % 2 != self._next_id % 2
+            and stream_id > self._last_peer_id
+        )
+
+    def feed(self, data):
+        """Processes the payload of a stego medium from the peer."""
+        for frame in self._parser.feed(data):
+            self._handle_frame(frame)
+
+    def _accept(self, stream_id):
+        """Returns the new stream the peer has opened or ``None``."""
+        # must be called with the lock held
+        if self.closed or not self._is_new(stream_id):
+            # A stream that has been reset already
+            return None
+        stream = Stream(self, stream_id)
+        self._streams[stream.id] = stream
+        self._last_peer_id = stream.id
+        return stream
+
+    def _handle_frame(self, frame):
+        accepted = None
+        with self._cond:
+            stream = self._streams.get(frame.stream_id)
+            if frame.type == HEADERS:
+                self._header_block += frame.payload
+                if not frame.flags & END_HEADERS:
+                    return
+                # The head is decoded even if the stream is gone, so that
+                # the table stays the same as the one of the peer
+                head = self._decoder.decode(bytes(self._header_block))
+                self._header_block = bytearray()
+                if stream is None:
+                    stream = accepted = self._accept(frame.stream_id)
+                    if stream is None:
+                        return
+                stream._incoming.append(head)
+                # Heads don't count against the window of the stream
+                stream._consumed -= len(head)
+            elif frame.type == DATA:
+                if stream is None:
+                    stream = accepted = self._accept(frame.stream_id)
+                    if stream is None:
+                        return
+                if len(frame.payload) > stream.recv_window:
+                    # The peer doesn't respect the window, the data would
+                    # pile up in the stream
+                    log.warning(f"Stream {stream.id} exceeded its window")
+                    stream.reset()
+                    return
+                stream.recv_window -= len(frame.payload)
+                if frame.payload:
+                    stream._incoming.append(frame.payload)
+                if frame.flags & END_STREAM:
+                    stream._end_received = True
+                    if stream.finished:
+                        self._remove(stream)
+            elif frame.type == WINDOW_UPDATE:
+                if stream is not None:
+                    stream.send_window += parse_increment(frame.payload)
+                    if stream._scheduled:
+                        self._cond.notify_all()
+            elif frame.type == RST_STREAM:
+                if stream is not None:
+                    stream.error = StreamReset(
+                        f"Stream {stream.id} has been reset by the peer."
+                    )
+                    self._remove(stream)
+            else:
+                log.warning(f"Ignoring frame of unknown type {frame.type}")
+            self._cond.notify_all()
+
+        if accepted is not None and self.accept is not None:
+            self.accept(accepted)
+
+    def _pending_size(self):
+        # must be called with the lock held
+        return (
+            sum(len(s._outgoing) for s in self._ready)
+            + sum(len(frame) for frame in self._control)
+            + sum(len(block) for _, block in self._heads)
+        )
+
+    def _delay(self):
+        """Returns the number of seconds to wait for further frames."""
+        # must be called with the lock held
+        if not self.flush_delay or self._pending_since is None:
+            return 0
+        if self.closed or self._pending_size() >= self.max_payload:
+            return 0
+        return self._pending_since + self.flush_delay - time.time()
+
+    def _collect(self):
+        """Returns the frames that fit into the next payload."""
+        # must be called with the lock held
+        budget = self.max_payload
+        parts = []
+        while self._control and len(self._control[0]) <= budget:
+            frame = self._control.pop(0)
+            parts.append(frame)
+            budget -= len(frame)
+
+        # The heads go out in the order they have been encoded in, the
+        # pieces of one head are never interleaved with another one
+        while self._heads and budget > FRAME_HEADER.size:
+            stream, block = self._heads[0]
+            n = min(len(block), self.max_frame, budget - FRAME_HEADER.size)
+            last = n == len(block)
+            parts.append(headers_frame(stream.id, block[:n], last))
+            budget -= FRAME_HEADER.size + n
+            if not last:
+                self._heads[0][1] = block[n:]
+                break
+            self._heads.popleft()
+            stream._heads_pending -= 1
+            if stream._reset_pending and not stream._heads_pending:
+                self._control.append(rst_stream_frame(stream.id))
+
+        progress = True
+        while progress and budget > FRAME_HEADER.size:
+            progress = False
+            for _ in range(len(self._ready)):
+                stream = self._ready.popleft()
+                if stream.error is not None:
+                    stream._scheduled = False
+                    continue
+                if stream._heads_pending:
+                    self._ready.append(stream)
+                    continue
+
+                n = min(
+                    len(stream._outgoing),
+                    stream.send_window,
+                    self.max_frame,
+                    budget - FRAME_HEADER.size,
+                )
+                end = stream._end_pending and n == len(stream._outgoing)
+                if n > 0 or (end and not stream._end_sent):
+                    parts.append(
+                        data_frame(stream.id, bytes(stream._outgoing[:n]), end)
+                    )
+                    del stream._outgoing[:n]
+                    stream.send_window -= n
+                    budget -= FRAME_HEADER.size + n
+                    progress = True
+                    if end:
+                        stream._end_sent = True
+                        if stream.finished:
+                            self._remove(stream)
+
+                if stream._outgoing or (
+                    stream._end_pending and not stream._end_sent
+                ):
+                    self._ready.append(stream)
+                else:
+                    stream._scheduled = False
+                if budget <= FRAME_HEADER.size:
+                    break
+
+        if not self._ready and not self._control and not self._heads:
+            self._pending_since = None
+        if parts:
+            # Writers might be waiting for room in their streams
+            self._cond.notify_all()
+        return b"".join(parts)
+
+    def _wait(self):
+        """Waits until there is something to send and returns it. Returns
+        ``None`` once the session has been closed.
+        """
+        with self._cond:
+            while True:
+                if self._error is not None:
+                    return None
+                delay = self._delay()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                payload = self._collect()
+                if payload:
+                    return payload
+                if self.closed:
+                    return None
+
+                if self.idle_timeout is None or self._streams:
+                    self._cond.wait()
+                    continue
+                idle = time.time() - self._last_active
+                if idle >= self.idle_timeout:
+                    log.debug("Closing idle tunnel")
+                    self.closed = True
+                    return None
+                self._cond.wait(self.idle_timeout - idle)
+
+    def _write_loop(self):
+        try:
+            while True:
+                payload = self._wait()
+                if payload is None:
+                    break
+                # The streams can queue further frames while the payload
+                # is being embedded
+                self.send_payload(payload)
+        except Exception as e:
+            log.error(f"Tunnel failed: {e}")
+            self.terminate(e)
+            return
+
+        log.debug(
+            f"Compressed {self._encoder.raw_size} bytes of heads to "
+            f"{self._encoder.encoded_size} bytes"
+        )
+
+        if self.on_close is not None and self._error is None:
+            try:
+                self.on_close()
+            except Exception as e:
+                log.error(f"Couldn't close tunnel: {e}")
+
+
+def splice(sock, stream, bufsize=65536):
+    """Relays data between a socket and a stream in both directions until
+    both of them are done.
+    """
+
+    def to_socket():
+        try:
+            for data in stream:
+                sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+        except Exception as e:
+            log.debug(f"Stream {stream.id} ended: {e}")
+            # Unblock the other direction
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    t = threading.Thread(target=to_socket)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            data = sock.recv(bufsize)
+            if not data:
+                break
+            stream.write(data)
+        stream.close()
+    except Exception as e:
+        log.debug(f"Stream {stream.id} ended: {e}")
+        stream.reset()
+    t.join()
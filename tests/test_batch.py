@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.batch`."""
+
+import threading
+
+import pytest
+
+from stegoproxy.batch import (
+    RequestBatcher,
+    batch_size,
+    is_batch,
+    pack_batch,
+    unpack_batch,
+)
+
+
+def run_concurrently(target, messages):
+    threads = [threading.Thread(target=target, args=(m,)) for m in messages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_pack_unpack():
+    messages = [b"GET / HTTP/1.1\r\n\r\n", b"", b"\x00" * 100]
+    data = pack_batch(messages)
+    assert is_batch(data)
+    assert len(data) == batch_size(messages)
+    assert unpack_batch(data) == messages
+
+
+def test_unpack_truncated():
+    with pytest.raises(ValueError):
+        unpack_batch(pack_batch([b"request"])[:-1])
+
+
+def test_unpack_plain_request():
+    with pytest.raises(ValueError):
+        unpack_batch(b"GET / HTTP/1.1\r\n\r\n")
+
+
+def test_lone_request_is_not_batched():
+    batcher = RequestBatcher(window=0.01, max_size=1024)
+    assert batcher.submit(b"request", send=None) is None
+
+
+def test_concurrent_requests_are_batched():
+    batcher = RequestBatcher(window=1, max_size=1024, max_requests=2)
+    batches = []
+    responses = {}
+
+    def send(messages):
+        batches.append(messages)
+        return [m.upper() for m in messages]
+
+    def submit(message):
+        responses[message] = batcher.submit(message, send)
+
+    run_concurrently(submit, [b"a", b"b"])
+
+    assert len(batches) == 1
+    assert sorted(batches[0]) == [b"a", b"b"]
+    assert responses == {b"a": b"A", b"b": b"B"}
+
+
+def test_errors_reach_every_request():
+    batcher = RequestBatcher(window=1, max_size=1024, max_requests=2)
+    errors = []
+
+    def send(messages):
+        raise OSError("broken")
+
+    def submit(message):
+        try:
+            batcher.submit(message, send)
+        except OSError as e:
+            errors.append(e)
+
+    run_concurrently(submit, [b"a", b"b"])
+
+    assert len(errors) == 2
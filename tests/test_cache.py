@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.cache`."""
+
+import io
+import time
+from email.utils import formatdate
+from http.client import parse_headers
+
+import pytest
+
+from stegoproxy.cache import HTTPCache, parse_cache_control
+
+URL = "http://example.com/"
+
+
+def make_headers(*lines):
+    data = "".join(f"{line}\r\n" for line in lines) + "\r\n"
+    return parse_headers(io.BytesIO(data.encode("latin-1")))
+
+
+def store(cache, *lines, request_headers=None, body=b"body"):
+    now = time.time()
+    return cache.store(
+        "GET",
+        URL,
+        request_headers or make_headers(),
+        200,
+        "OK",
+        make_headers(*lines),
+        body,
+        request_time=now,
+        response_time=now,
+    )
+
+
+@pytest.fixture
+def cache():
+    return HTTPCache()
+
+
+def test_parse_cache_control():
+    assert parse_cache_control('max-age=60, No-Cache, private="x"') == {
+        "max-age": "60",
+        "no-cache": None,
+        "private": "x",
+    }
+
+
+def test_fresh_response(cache):
+    store(cache, "Cache-Control: max-age=60")
+    entry, fresh = cache.lookup("GET", URL, make_headers())
+    assert entry.body == b"body"
+    assert fresh
+
+
+def test_stale_response(cache):
+    store(cache, "Cache-Control: max-age=60", "Age: 120")
+    entry, fresh = cache.lookup("GET", URL, make_headers())
+    assert entry is not None
+    assert not fresh
+
+
+def test_expires(cache):
+    now = time.time()
+    store(
+        cache,
+        f"Date: {formatdate(now, usegmt=True)}",
+        f"Expires: {formatdate(now + 60, usegmt=True)}",
+    )
+    assert cache.lookup("GET", URL, make_headers())[1]
+
+
+def test_request_no_cache(cache):
+    store(cache, "Cache-Control: max-age=60")
+    request_headers = make_headers("Cache-Control: no-cache")
+    entry, fresh = cache.lookup("GET", URL, request_headers)
+    assert entry is not None
+    assert not fresh
+
+
+def test_heuristic_freshness(cache):
+    now = time.time()
+    store(
+        cache,
+        f"Date: {formatdate(now, usegmt=True)}",
+        f"Last-Modified: {formatdate(now - 3600, usegmt=True)}",
+    )
+    assert cache.lookup("GET", URL, make_headers())[1]
+
+
+def test_not_storable(cache):
+    assert store(cache, "Cache-Control: no-store, max-age=60") is None
+    assert store(cache, "Cache-Control: max-age=60", "Vary: *") is None
+    # Neither explicit freshness nor a validator
+    assert store(cache) is None
+
+
+def test_shared_cache_skips_private_responses():
+    cache = HTTPCache(shared=True)
+    assert store(cache, "Cache-Control: private, max-age=60") is None
+    assert store(cache, "Cache-Control: max-age=60") is not None
+
+
+def test_vary(cache):
+    store(
+        cache,
+        "Cache-Control: max-age=60",
+        "Vary: Accept-Encoding",
+        request_headers=make_headers("Accept-Encoding: gzip"),
+        body=b"gzip",
+    )
+    store(
+        cache,
+        "Cache-Control: max-age=60",
+        "Vary: Accept-Encoding",
+        request_headers=make_headers("Accept-Encoding: br"),
+        body=b"br",
+    )
+
+    entry, _ = cache.lookup("GET", URL, make_headers("Accept-Encoding: gzip"))
+    assert entry.body == b"gzip"
+    entry, _ = cache.lookup("GET", URL, make_headers("Accept-Encoding: br"))
+    assert entry.body == b"br"
+    entry, _ = cache.lookup("GET", URL, make_headers())
+    assert entry is None
+
+
+def test_not_modified(cache):
+    entry = store(
+        cache,
+        "Cache-Control: max-age=60",
+        'ETag: "v1"',
+    )
+    assert entry.not_modified(make_headers('If-None-Match: W/"v1"'))
+    assert not entry.not_modified(make_headers('If-None-Match: "v2"'))
+    assert cache.conditional_headers(entry) == {"If-None-Match": '"v1"'}
+
+
+def test_eviction():
+    cache = HTTPCache(max_size=1000)
+    store(cache, "Cache-Control: max-age=60", body=b"x" * 700)
+    cache.store(
+        "GET",
+        "http://example.com/other",
+        make_headers(),
+        200,
+        "OK",
+        make_headers("Cache-Control: max-age=60"),
+        b"y" * 300,
+        request_time=time.time(),
+    )
+    assert cache.lookup("GET", URL, make_headers()) == (None, False)
+    assert cache.stats()["evictions"] == 1
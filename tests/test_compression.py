@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.compression`."""
+
+import gzip
+import io
+import zlib
+
+import pytest
+
+from stegoproxy.compression import (
+    CompressingReader,
+    accepts_encoding,
+    compress,
+    decode,
+    is_compressible,
+    iter_decoded,
+    parse_stego_encoding,
+    widen_accept_encoding,
+)
+
+BODY = b"<p>A paragraph that compresses well.</p>\n" * 1000
+
+
+@pytest.mark.parametrize(
+    "content_type, expected",
+    [
+        ("text/html; charset=utf-8", True),
+        ("application/json", True),
+        ("application/ld+json", True),
+        ("image/svg+xml", True),
+        ("image/png", False),
+        ("font/woff2", False),
+        ("application/octet-stream", False),
+        (None, False),
+    ],
+)
+def test_is_compressible(content_type, expected):
+    assert is_compressible(content_type) is expected
+
+
+def test_accepts_encoding():
+    assert accepts_encoding("gzip, deflate", "gzip")
+    assert accepts_encoding("x-gzip", "gzip")
+    assert not accepts_encoding("gzip;q=0, *", "gzip")
+    assert accepts_encoding("*", "br")
+    assert not accepts_encoding(None, "gzip")
+    assert accepts_encoding(None, "identity")
+    assert not accepts_encoding("identity;q=0", "identity")
+
+
+def test_widen_accept_encoding():
+    assert widen_accept_encoding("br") == "br, gzip, deflate"
+    assert widen_accept_encoding("gzip;q=0.5") == "gzip;q=0.5, deflate"
+    assert widen_accept_encoding(None) == "gzip, deflate"
+
+
+def test_parse_stego_encoding():
+    assert parse_stego_encoding("Deflate; length=42") == ("deflate", 42)
+    assert parse_stego_encoding("deflate") == ("deflate", None)
+
+
+@pytest.mark.parametrize(
+    "coding, data",
+    [
+        ("gzip", gzip.compress(BODY)),
+        ("deflate", zlib.compress(BODY)),
+        # Raw deflate data without the zlib header
+        ("deflate", zlib.compress(BODY)[2:-4]),
+    ],
+    ids=["gzip", "deflate", "raw-deflate"],
+)
+def test_decode(coding, data):
+    assert decode(data, coding) == BODY
+    pieces = [data[i : i + 100] for i in range(0, len(data), 100)]
+    assert b"".join(iter_decoded(pieces, coding)) == BODY
+
+
+def test_decode_limits():
+    with pytest.raises(ValueError):
+        decode(compress(BODY, 6), "deflate", max_size=len(BODY) - 1)
+    with pytest.raises(ValueError):
+        decode(b"not compressed", "gzip")
+
+
+def test_compressing_reader_read():
+    sizes = []
+    reader = CompressingReader(
+        io.BytesIO(BODY), 6, lambda *args: sizes.append(args)
+    )
+    data = reader.read()
+    assert zlib.decompress(data) == BODY
+    assert sizes == [(len(BODY), len(data))]
+
+
+def test_compressing_reader_read1():
+    reader = CompressingReader(io.BufferedReader(io.BytesIO(BODY)), 6)
+    pieces = []
+    while True:
+        piece = reader.read1(1024)
+        if not piece:
+            break
+        assert len(piece) <= 1024
+        pieces.append(piece)
+    data = b"".join(pieces)
+    assert len(pieces) > 1
+    assert zlib.decompress(data) == BODY
+    assert reader.compressed_size == len(data)
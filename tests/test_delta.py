@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.delta`."""
+
+import os
+
+import pytest
+
+from stegoproxy.delta import DeltaStore, apply_delta, digest, make_delta
+
+BASE = b"".join(b"line %d of a polled page\n" % i for i in range(500))
+
+
+@pytest.mark.parametrize(
+    "target",
+    [
+        BASE,
+        BASE.replace(b"line 250 ", b"LINE 250 "),
+        b"new first line\n" + BASE[:5000] + BASE[6000:] + b"appended\n",
+    ],
+)
+def test_round_trip(target):
+    delta = make_delta(BASE, target)
+    assert delta is not None
+    assert len(delta) < len(target) // 10
+    assert apply_delta(BASE, delta) == target
+
+
+def test_different_bodies():
+    assert make_delta(BASE, os.urandom(len(BASE))) is None
+
+
+def test_max_size():
+    target = BASE.replace(b"line 250 ", b"LINE 250 ")
+    size = len(make_delta(BASE, target))
+    assert make_delta(BASE, target, max_size=size) is None
+    assert make_delta(BASE, target, max_size=size + 1) is not None
+
+
+def test_wrong_base():
+    delta = make_delta(BASE, BASE.replace(b"line 1 ", b"LINE 1 "))
+    with pytest.raises(ValueError):
+        apply_delta(BASE.replace(b"line 400 ", b"LINE 400 "), delta)
+
+
+def test_truncated_delta():
+    delta = make_delta(BASE, BASE + b"appended\n")
+    with pytest.raises(ValueError):
+        apply_delta(BASE, delta[:-3])
+
+
+def test_store():
+    store = DeltaStore(max_size=100)
+    store.put("a", b"x" * 60)
+    assert store.get("a") == (digest(b"x" * 60), b"x" * 60)
+    store.put("b", b"y" * 60)
+    # The least recently used version is dropped
+    assert store.get("a") is None
+    assert store.get("b") is not None
+    store.put("b", b"z" * 101)
+    assert store.get("b") is None
+    assert store.size == 0
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.framing`."""
+
+from stegoproxy.framing import (
+    DATA,
+    END_HEADERS,
+    END_STREAM,
+    HEADERS,
+    RST_STREAM,
+    WINDOW_UPDATE,
+    FrameParser,
+    data_frame,
+    headers_frame,
+    parse_increment,
+    rst_stream_frame,
+    window_update_frame,
+)
+
+
+def test_frames_round_trip():
+    data = b"".join(
+        (
+            headers_frame(1, b"head"),
+            data_frame(1, b"body", end_stream=True),
+            window_update_frame(3, 65536),
+            rst_stream_frame(5),
+        )
+    )
+    frames = FrameParser().feed(data)
+
+    assert [(f.type, f.flags, f.stream_id) for f in frames] == [
+        (HEADERS, END_HEADERS, 1),
+        (DATA, END_STREAM, 1),
+        (WINDOW_UPDATE, 0, 3),
+        (RST_STREAM, 0, 5),
+    ]
+    assert frames[0].payload == b"head"
+    assert frames[1].payload == b"body"
+    assert parse_increment(frames[2].payload) == 65536
+    assert frames[3].payload == b""
+
+
+def test_frames_spanning_several_media():
+    parser = FrameParser()
+    data = data_frame(1, b"x" * 100) + data_frame(3, b"y")
+
+    assert parser.feed(data[:5]) == []
+    assert parser.feed(data[5:50]) == []
+    frames = parser.feed(data[50:])
+    assert [(f.stream_id, f.payload) for f in frames] == [
+        (1, b"x" * 100),
+        (3, b"y"),
+    ]
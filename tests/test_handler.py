@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.handler`."""
+
+import io
+from http.client import HTTPResponse, IncompleteRead, parse_headers
+
+import pytest
+
+from stegoproxy.handler import BaseProxyHandler
+
+
+class FakeSocket(object):
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, mode):
+        return io.BytesIO(self.data)
+
+
+class Browser(object):
+    def __init__(self):
+        self.data = bytearray()
+
+    def sendall(self, data):
+        self.data += data
+
+
+def make_handler(request_version="HTTP/1.1", headers=b"", body=b""):
+    handler = BaseProxyHandler.__new__(BaseProxyHandler)
+    handler.request_version = request_version
+    handler.close_connection = False
+    handler.headers = parse_headers(io.BytesIO(headers + b"\r\n"))
+    handler.rfile = io.BytesIO(body)
+    handler.client = Browser()
+    return handler
+
+
+def relay(handler, response, method="GET"):
+    """Relays a response like ``do_COMMAND`` and returns the status, the
+    headers and the raw body the browser gets.
+    """
+    h = HTTPResponse(FakeSocket(response), method=method)
+    h.begin()
+    handler.filter_headers(h.msg)
+    handler._relay_response(h)
+
+    fp = io.BytesIO(handler.client.data)
+    status = fp.readline().split(None, 1)[1].strip()
+    headers = parse_headers(fp)
+    return status, headers, fp.read()
+
+
+def test_iter_chunked():
+    body = (
+        b"5;name=value\r\nhello\r\n"
+        b"7\r\n, world\r\n"
+        b"0\r\nX-Trailer: 1\r\nX-Other: 2\r\n\r\n"
+        b"next request"
+    )
+    fp = io.BytesIO(body)
+    pieces = list(make_handler()._iter_chunked(fp, size=3))
+    assert pieces == [b"hel", b"lo", b", w", b"orl", b"d"]
+    # The trailer has been read, the next request follows
+    assert fp.read() == b"next request"
+
+
+@pytest.mark.parametrize(
+    "body", [b"5\r\nhel", b"5\r\nhello\r\n", b"5\r\nhello\r\n3\r\n"]
+)
+def test_iter_chunked_truncated(body):
+    with pytest.raises(IncompleteRead):
+        list(make_handler()._iter_chunked(io.BytesIO(body)))
+
+
+def test_request_body_with_content_length():
+    handler = make_handler(
+        headers=b"Content-Length: 5\r\n", body=b"hello, world"
+    )
+    assert b"".join(handler._iter_request_body()) == b"hello"
+
+
+def test_request_body_chunked():
+    handler = make_handler(
+        headers=b"Transfer-Encoding: gzip, chunked\r\n",
+        body=b"5\r\nhello\r\n0\r\n\r\n",
+    )
+    assert b"".join(handler._iter_request_body()) == b"hello"
+
+
+def test_request_body_truncated():
+    handler = make_handler(headers=b"Content-Length: 10\r\n", body=b"hello")
+    with pytest.raises(IncompleteRead):
+        list(handler._iter_request_body())
+
+
+def test_request_without_body():
+    handler = make_handler(body=b"GET / HTTP/1.1\r\n\r\n")
+    assert list(handler._iter_request_body()) == []
+
+
+def test_relay_content_length():
+    status, headers, body = relay(
+        make_handler(),
+        b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello, world",
+    )
+    assert status == b"200 OK"
+    assert headers["Content-Length"] == "5"
+    assert body == b"hello"
+
+
+def test_relay_chunked():
+    handler = make_handler()
+    _, headers, body = relay(
+        handler,
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"5\r\nhello\r\n0\r\n\r\n",
+    )
+    assert headers.get_all("Transfer-Encoding") == ["chunked"]
+    assert body == b"5\r\nhello\r\n0\r\n\r\n"
+    assert not handler.close_connection
+
+
+def test_relay_until_eof_to_http11_browser():
+    handler = make_handler()
+    _, headers, body = relay(handler, b"HTTP/1.0 200 OK\r\n\r\nhello")
+    # A body of unknown length is sent in chunks
+    assert headers["Transfer-Encoding"] == "chunked"
+    assert body == b"5\r\nhello\r\n0\r\n\r\n"
+    assert not handler.close_connection
+
+
+def test_relay_to_http10_browser():
+    handler = make_handler("HTTP/1.0")
+    _, headers, body = relay(
+        handler,
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"5\r\nhello\r\n0\r\n\r\n",
+    )
+    # HTTP/1.0 doesn't know chunks, the end of the body is signaled by
+    # closing the connection
+    assert "Transfer-Encoding" not in headers
+    assert headers["Connection"] == "close"
+    assert body == b"hello"
+    assert handler.close_connection
+
+
+@pytest.mark.parametrize(
+    "response, method, length",
+    [
+        (b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n", "HEAD", "5"),
+        (b"HTTP/1.1 204 No Content\r\n\r\n", "GET", None),
+        (
+            b"HTTP/1.1 304 Not Modified\r\nContent-Length: 5\r\n\r\n",
+            "GET",
+            "5",
+        ),
+    ],
+)
+def test_relay_without_body(response, method, length):
+    handler = make_handler()
+    _, headers, body = relay(handler, response + b"garbage", method)
+    assert headers["Content-Length"] == length
+    assert "Transfer-Encoding" not in headers
+    assert body == b""
+    assert not handler.close_connection
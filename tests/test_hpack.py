@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.hpack`."""
+
+import pytest
+
+from stegoproxy.hpack import (
+    HeaderDecoder,
+    HeaderEncoder,
+    decode_integer,
+    encode_integer,
+)
+
+REQUEST = (
+    b"GET /index.html HTTP/1.1\r\n"
+    b"Host: example.com\r\n"
+    b"User-Agent: Mozilla/5.0\r\n"
+    b"Accept: */*\r\n"
+    b"Authorization: Basic c2VjcmV0\r\n"
+    b"\r\n"
+)
+RESPONSE = (
+    b"HTTP/1.1 404 Not Found\r\n"
+    b"Content-Type: text/html\r\n"
+    b"Content-Length: 0\r\n"
+    b"\r\n"
+)
+
+
+@pytest.mark.parametrize("value", [0, 30, 31, 127, 128, 1337, 2 ** 20])
+def test_integer_round_trip(value):
+    data = encode_integer(value, 5, 0x20) + b"rest"
+    assert data[0] & 0xE0 == 0x20
+    assert decode_integer(data, 0, 5) == (value, len(data) - 4)
+
+
+def test_truncated_integer():
+    with pytest.raises(ValueError):
+        decode_integer(encode_integer(1337, 5)[:-1], 0, 5)
+
+
+def test_heads_round_trip():
+    encoder = HeaderEncoder()
+    decoder = HeaderDecoder()
+    for head in (REQUEST, RESPONSE, REQUEST):
+        assert decoder.decode(encoder.encode(head)) == head
+
+
+def test_repeated_heads_are_smaller():
+    encoder = HeaderEncoder()
+    first = encoder.encode(REQUEST)
+    second = encoder.encode(REQUEST)
+    assert len(second) < len(first)
+    # Credentials are sent as they are every time
+    assert b"c2VjcmV0" in second
+
+
+def test_table_size_update():
+    encoder = HeaderEncoder(table_size=256)
+    decoder = HeaderDecoder()
+    for _ in range(2):
+        assert decoder.decode(encoder.encode(REQUEST)) == REQUEST
+    assert decoder.table.max_size == 256
+
+
+def test_block_without_start_line():
+    with pytest.raises(ValueError):
+        HeaderDecoder().decode(b"")
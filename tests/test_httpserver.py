@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.httpserver`."""
+
+import os
+import signal
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from stegoproxy.httpserver import (
+    BaseHTTPServer,
+    PooledHTTPServer,
+    PreforkServer,
+)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def get(port):
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+        return sock.makefile("rb").read()
+
+
+class BlockingHandler(BaseHTTPRequestHandler):
+    """Counts the requests that are handled at the same time and blocks
+    until ``release`` is set.
+    """
+
+    lock = threading.Lock()
+    release = threading.Event()
+    running = 0
+    max_running = 0
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+        cls.release.wait(5)
+        with cls.lock:
+            cls.running -= 1
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PidHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = str(os.getpid()).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_pool_bounds_concurrency():
+    server = PooledHTTPServer(
+        "127.0.0.1", 0, BlockingHandler, pool_size=2, pool_queue_size=1
+    )
+    port = server.socket.getsockname()[1]
+    serving = threading.Thread(target=server.serve_forever)
+    serving.start()
+
+    responses = []
+    clients = [
+        threading.Thread(target=lambda: responses.append(get(port)))
+        for _ in range(4)
+    ]
+    for client in clients:
+        client.start()
+    try:
+        # Two requests are handled, one is queued and the accept loop
+        # waits with the last one
+        wait_until(lambda: server.queued_requests == 1)
+        time.sleep(0.1)
+        assert server.workers == 2
+        assert server.active_workers == 2
+        assert server.queued_requests == 1
+        assert BlockingHandler.running == 2
+    finally:
+        BlockingHandler.release.set()
+        for client in clients:
+            client.join(5)
+        server.shutdown()
+        serving.join(5)
+
+    assert len(responses) == 4
+    assert all(r.endswith(b"\r\n\r\nok") for r in responses)
+    assert BlockingHandler.max_running == 2
+    assert server.active_workers == 0
+    assert server.workers == 0
+
+
+def test_prefork_restarts_workers():
+    server = PreforkServer(
+        lambda: BaseHTTPServer("127.0.0.1", 0, PidHandler), workers=2
+    )
+    server.restart_delay = 0
+    port = server.socket.getsockname()[1]
+    master = threading.Thread(target=server.serve_forever)
+    master.start()
+    try:
+        wait_until(lambda: len(server.children) == 2)
+        first = set(server.children)
+        pid = int(get(port).split(b"\r\n\r\n")[1])
+        assert pid in first
+
+        killed = first.pop()
+        os.kill(killed, signal.SIGKILL)
+        wait_until(
+            lambda: killed not in server.children
+            and len(server.children) == 2
+        )
+        workers = set(server.children)
+        assert first < workers
+    finally:
+        server._stop()
+        master.join(5)
+
+    assert not master.is_alive()
+    assert not server.children
+    for pid in workers | {killed}:
+        # The workers have been stopped and reaped
+        try:
+            os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            continue
+        raise AssertionError(f"Worker {pid} is still running")
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.minify`."""
+
+import json
+
+from stegoproxy.minify import get_minifier, minify
+
+
+def test_css():
+    body = b"""
+    /* layout */
+    body  {
+        margin: 0 ;
+        font-family: "Open  Sans", sans-serif;
+    }
+    /*! license */
+    a > b { color: red }
+    """
+    assert minify(body, "text/css") == (
+        b'body{margin: 0;font-family: "Open  Sans",sans-serif;}'
+        b"/*! license */ a>b{color: red}"
+    )
+
+
+def test_js():
+    body = b"""
+    // setup
+    var a = 1
+    var b = "two"
+
+    function f() { return a }
+    """
+    assert minify(body, "application/javascript") == (
+        b'var a = 1\nvar b = "two"\nfunction f() { return a }'
+    )
+
+
+def test_js_multiline_strings():
+    body = b"var s = `a\n    b`;\n    var t = 1;\n"
+    assert minify(body, "text/javascript") is None
+
+
+def test_json():
+    body = b'{\n  "a": [1, 2],\n  "b": "x  y"\n}\n'
+    minified = minify(body, "application/json; charset=utf-8")
+    assert minified == b'{"a":[1,2],"b":"x  y"}'
+    assert json.loads(minified) == json.loads(body)
+
+
+def test_invalid_json():
+    assert minify(b'{"a":  ', "application/json") is None
+
+
+def test_html():
+    body = b"""<html>
+      <!-- comment -->
+      <!--[if IE]><p>IE</p><![endif]-->
+      <style>  p  { color: red; }  </style>
+      <pre>  keep
+        this  </pre>
+      <p title="a  b">   text   </p>
+    </html>
+    """
+    assert minify(body, "text/html") == (
+        b"<html>\n\n<!--[if IE]><p>IE</p><![endif]-->\n"
+        b"<style>p{color: red;}</style>\n"
+        b"<pre>  keep\n        this  </pre>\n"
+        b'<p title="a  b"> text </p>\n</html>\n'
+    )
+
+
+def test_unknown_and_utf16_bodies():
+    assert minify(b"  data  ", "application/octet-stream") is None
+    assert minify(b"  data  ", None) is None
+    body = "{ }".encode("utf-16")
+    assert minify(body, "application/json; charset=utf-16") is None
+
+
+def test_json_suffix():
+    assert get_minifier("application/ld+json") is get_minifier(
+        "application/json"
+    )
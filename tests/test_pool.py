@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.pool`."""
+
+import socket
+import threading
+import time
+
+import pytest
+
+from stegoproxy.exceptions import PoolExhausted
+from stegoproxy.pool import ConnectionPool
+
+
+class Listener(object):
+    """Accepts connections on a local port and keeps them open."""
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.accepted = []
+        t = threading.Thread(target=self._accept, daemon=True)
+        t.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.accepted.append(conn)
+
+    def wait_for(self, count):
+        deadline = time.time() + 1
+        while len(self.accepted) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.accepted[:count]
+
+    def close(self):
+        self.sock.close()
+        for conn in self.accepted:
+            conn.close()
+
+
+@pytest.fixture
+def listener():
+    listener = Listener()
+    yield listener
+    listener.close()
+
+
+def test_reuse(listener):
+    pool = ConnectionPool()
+    conn = pool.acquire("127.0.0.1", listener.port)
+    assert not conn.reused
+    pool.release(conn)
+
+    again = pool.acquire("127.0.0.1", listener.port)
+    assert again is conn
+    assert again.reused
+    assert pool.stats() == {f"127.0.0.1:{listener.port}": dict(open=1, idle=0)}
+
+
+def test_release_unusable(listener):
+    pool = ConnectionPool()
+    conn = pool.acquire("127.0.0.1", listener.port)
+    pool.release(conn, reusable=False)
+    assert conn.closed
+    assert pool.acquire("127.0.0.1", listener.port) is not conn
+
+
+def test_health_check(listener):
+    pool = ConnectionPool()
+    conn = pool.acquire("127.0.0.1", listener.port)
+    pool.release(conn)
+    # The peer closes the idle connection
+    listener.wait_for(1)[0].close()
+    time.sleep(0.05)
+
+    again = pool.acquire("127.0.0.1", listener.port)
+    assert again is not conn
+    assert not again.reused
+    assert conn.closed
+
+
+def test_idle_eviction(listener):
+    pool = ConnectionPool(idle_timeout=10)
+    conn = pool.acquire("127.0.0.1", listener.port)
+    # The peer keeps the connection open for a shorter time
+    pool.release(conn, timeout=0.05)
+    time.sleep(0.1)
+
+    assert pool.acquire("127.0.0.1", listener.port) is not conn
+    assert conn.closed
+
+
+def test_block_timeout(listener):
+    pool = ConnectionPool(maxsize=1, block_timeout=0.1)
+    pool.acquire("127.0.0.1", listener.port)
+    start = time.time()
+    with pytest.raises(PoolExhausted):
+        pool.acquire("127.0.0.1", listener.port)
+    assert time.time() - start >= 0.1
+
+
+def test_waits_for_released_connection(listener):
+    pool = ConnectionPool(maxsize=1, block_timeout=1)
+    conn = pool.acquire("127.0.0.1", listener.port)
+    threading.Timer(0.1, pool.release, args=(conn,)).start()
+    assert pool.acquire("127.0.0.1", listener.port) is conn
+
+
+def test_prewarm(listener):
+    pool = ConnectionPool(maxsize=3)
+    pool.prewarm("127.0.0.1", listener.port, 5)
+    listener.wait_for(3)
+    deadline = time.time() + 1
+    key = f"127.0.0.1:{listener.port}"
+    while pool.stats().get(key, {}).get("idle") != 3:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    conns = [pool.acquire("127.0.0.1", listener.port) for _ in range(3)]
+    assert all(conn.reused for conn in conns)
+    pool.clear()
+
+
+@pytest.mark.parametrize("read_timeout", [None, 5])
+def test_read_timeout(listener, read_timeout):
+    pool = ConnectionPool(read_timeout=read_timeout)
+    conn = pool.acquire("127.0.0.1", listener.port)
+    assert conn.conn.gettimeout() == read_timeout
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.prefetch`."""
+
+import threading
+
+import pytest
+
+from stegoproxy.prefetch import (
+    BundleParser,
+    PendingPushes,
+    PieceReader,
+    find_subresources,
+    pack_message,
+)
+
+PAGE = b"""<!doctype html>
+<html>
+<head>
+  <link rel="stylesheet" href="/style.css">
+  <link rel="icon" href="favicon.ico">
+  <link rel="alternate" href="/feed.xml">
+  <link rel="stylesheet" href="https://cdn.example.org/lib.css">
+  <script src="app.js?v=1#main"></script>
+  <script>var inline = 1;</script>
+</head>
+<body>
+  <img src="/style.css">
+  <img src="//example.com/logo.png">
+  <img src="http://example.com:8080/other-port.png">
+  <input type="image" src="button.png">
+  <input type="text" src="ignored.png">
+  <a href="/page.html">link</a>
+  <img src="">
+</body>
+</html>
+"""
+
+
+def test_find_subresources():
+    assert find_subresources(PAGE, "https://example.com/dir/", 16) == [
+        "https://example.com/style.css",
+        "https://example.com/dir/favicon.ico",
+        "https://example.com/dir/app.js?v=1",
+        "https://example.com/logo.png",
+        "https://example.com/dir/button.png",
+    ]
+
+
+def test_find_subresources_max_count():
+    assert find_subresources(PAGE, "https://example.com/dir/", 2) == [
+        "https://example.com/style.css",
+        "https://example.com/dir/favicon.ico",
+    ]
+
+
+def test_find_subresources_skips_the_page():
+    html = b'<img src="/"><img src="/a.png"><img src="/a.png">'
+    assert find_subresources(html, "http://example.com/", 16) == [
+        "http://example.com/a.png"
+    ]
+
+
+def test_find_subresources_invalid_html():
+    html = b"<img src='/a.png'><script src=\xff\xfe"
+    assert find_subresources(html, "http://example.com/", 16) == [
+        "http://example.com/a.png"
+    ]
+
+
+@pytest.mark.parametrize("step", [1, 3, 7, 1000])
+def test_bundle_framing(step):
+    messages = [b"urls", b"", b"x" * 300, b"response"]
+    data = b"".join(pack_message(m) for m in messages)
+
+    parser = BundleParser()
+    parsed = []
+    for offset in range(0, len(data), step):
+        parsed.extend(parser.feed(data[offset : offset + step]))
+    assert parsed == messages
+
+
+def test_piece_reader():
+    reader = PieceReader([b"abc", b"", b"defg", b"h"])
+    assert reader.read(2) == b"ab"
+    # A read returns what is there without waiting for the next piece
+    assert reader.read(5) == b"c"
+    assert reader.read1(2) == b"de"
+    assert reader.read() == b"fgh"
+    assert reader.read(1) == b""
+
+
+def test_pending_pushes():
+    pushes = PendingPushes()
+    assert not pushes.wait("http://example.com/a.png", 0)
+
+    pushes.add(["http://example.com/a.png"])
+    threading.Timer(0.05, pushes.done, ["http://example.com/a.png"]).start()
+    assert pushes.wait("http://example.com/a.png", 1)
+    assert not pushes.wait("http://example.com/a.png", 0)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.resolver`."""
+
+import errno
+import socket
+import time
+
+import pytest
+
+from stegoproxy import resolver
+from stegoproxy.resolver import (
+    Resolver,
+    create_connection,
+    interleave_addrinfos,
+)
+
+
+def addrinfo(address, family=socket.AF_INET):
+    return (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", address)
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """Counts the lookups and resolves every host to 127.0.0.1, except for
+    ``invalid`` which doesn't exist.
+    """
+    lookups = []
+
+    def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+        lookups.append(host)
+        if host == "invalid":
+            raise socket.gaierror(socket.EAI_NONAME, "Name not known")
+        return [addrinfo(("127.0.0.1", port))]
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    return lookups
+
+
+def test_cached_lookup(lookups):
+    dns = Resolver(ttl=0.05)
+    assert dns.resolve("example.com", 80) == [addrinfo(("127.0.0.1", 80))]
+    dns.resolve("example.com", 80)
+    assert lookups == ["example.com"]
+
+    time.sleep(0.1)
+    dns.resolve("example.com", 80)
+    assert lookups == ["example.com"] * 2
+
+
+def test_failed_lookup(lookups):
+    dns = Resolver(negative_ttl=60)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            dns.resolve("invalid", 80)
+    assert lookups == ["invalid"]
+
+
+def test_invalidate_and_maxsize(lookups):
+    dns = Resolver(maxsize=2)
+    for host in ("a", "b", "c"):
+        dns.resolve(host, 80)
+    # The oldest host has been dropped
+    dns.resolve("a", 80)
+    dns.invalidate("a", 80)
+    dns.resolve("a", 80)
+    assert lookups == ["a", "b", "c", "a", "a"]
+
+
+def test_interleave_addrinfos():
+    v4 = [addrinfo((f"10.0.0.{i}", 80)) for i in range(3)]
+    v6 = [addrinfo((f"::{i}", 80, 0, 0), socket.AF_INET6) for i in range(2)]
+    assert interleave_addrinfos(v6 + v4) == [
+        v6[0],
+        v4[0],
+        v6[1],
+        v4[1],
+        v4[2],
+    ]
+
+
+class FakeResolver(object):
+    def __init__(self, *addresses):
+        self.addrinfos = [addrinfo(address) for address in addresses]
+        self.invalidated = False
+
+    def resolve(self, host, port):
+        return list(self.addrinfos)
+
+    def invalidate(self, host, port):
+        self.invalidated = True
+
+
+class FakeSocket(object):
+    """A socket whose connection attempt to an address takes the given
+    time and ends with the given error.
+    """
+
+    attempts = {}  # address -> (seconds, error)
+
+    def __init__(self, family, type, proto):
+        self.address = None
+        self.closed = False
+
+    def setblocking(self, flag):
+        pass
+
+    def connect_ex(self, address):
+        self.address = address
+        self.ready_at = time.time() + self.attempts[address][0]
+        return errno.EINPROGRESS
+
+    def getsockopt(self, level, option):
+        return self.attempts[self.address][1]
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def fake_select(rlist, wlist, xlist, timeout=None):
+    deadline = time.time() + (timeout if timeout is not None else 10)
+    while True:
+        ready = [s for s in wlist if s.ready_at <= time.time()]
+        if ready or time.time() >= deadline:
+            return [], ready, []
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def attempts(monkeypatch):
+    monkeypatch.setattr(socket, "socket", FakeSocket)
+    monkeypatch.setattr(resolver.select, "select", fake_select)
+    FakeSocket.attempts = {}
+    return FakeSocket.attempts
+
+
+def test_next_address_wins_after_delay(attempts):
+    attempts[("10.0.0.1", 80)] = (60, 0)
+    attempts[("10.0.0.2", 80)] = (0, 0)
+    dns = FakeResolver(("10.0.0.1", 80), ("10.0.0.2", 80))
+
+    start = time.time()
+    sock = create_connection(("example.com", 80), delay=0.1, resolver=dns)
+    assert time.time() - start >= 0.1
+    assert sock.address == ("10.0.0.2", 80)
+    assert not sock.closed
+
+
+def test_failed_address_skips_delay(attempts):
+    attempts[("10.0.0.1", 80)] = (0, errno.ECONNREFUSED)
+    attempts[("10.0.0.2", 80)] = (0, 0)
+    dns = FakeResolver(("10.0.0.1", 80), ("10.0.0.2", 80))
+
+    start = time.time()
+    sock = create_connection(("example.com", 80), delay=5, resolver=dns)
+    assert time.time() - start < 1
+    assert sock.address == ("10.0.0.2", 80)
+
+
+def test_all_addresses_fail(attempts):
+    attempts[("10.0.0.1", 80)] = (0, errno.ECONNREFUSED)
+    attempts[("10.0.0.2", 80)] = (0.05, errno.EHOSTUNREACH)
+    dns = FakeResolver(("10.0.0.1", 80), ("10.0.0.2", 80))
+
+    with pytest.raises(OSError) as excinfo:
+        create_connection(("example.com", 80), delay=0.01, resolver=dns)
+    assert excinfo.value.errno == errno.EHOSTUNREACH
+    # The addresses might be outdated
+    assert dns.invalidated
+
+
+def test_connect_timeout(attempts):
+    attempts[("10.0.0.1", 80)] = (60, 0)
+    dns = FakeResolver(("10.0.0.1", 80))
+
+    with pytest.raises(socket.timeout):
+        create_connection(("example.com", 80), timeout=0.1, resolver=dns)
+
+
+def test_socket_keeps_timeout():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    address = listener.getsockname()
+
+    sock = create_connection(
+        address, timeout=5, resolver=FakeResolver(address)
+    )
+    assert sock.gettimeout() == 5
+    sock.close()
+    listener.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.resume`."""
+
+import pytest
+
+from stegoproxy.resume import (
+    Transfer,
+    TransferCache,
+    announce_transfer,
+    is_resume,
+    pack_resume,
+    parse_announcement,
+    unpack_resume,
+)
+
+
+def test_pack_unpack_resume():
+    transfer = Transfer()
+    data = pack_resume(transfer.id, 7)
+    assert is_resume(data)
+    assert unpack_resume(data) == (transfer.id, 7)
+
+
+def test_unpack_invalid_resume():
+    with pytest.raises(ValueError):
+        unpack_resume(b"GET / HTTP/1.1\r\n\r\n")
+    with pytest.raises(ValueError):
+        unpack_resume(pack_resume(Transfer().id, 7)[:-1])
+
+
+def test_announcement():
+    transfer = Transfer()
+    message = announce_transfer(transfer.id) + b"HTTP/1.1 200 OK\r\n"
+    assert parse_announcement(message) == (
+        transfer.id,
+        b"HTTP/1.1 200 OK\r\n",
+    )
+    assert parse_announcement(b"HTTP/1.1 200 OK\r\n") == (
+        None,
+        b"HTTP/1.1 200 OK\r\n",
+    )
+    with pytest.raises(ValueError):
+        parse_announcement(message[:20])
+
+
+def test_window():
+    transfer = Transfer(window=250)
+    for _ in range(3):
+        transfer.add(b"x" * 100)
+    # The first chunk has been dropped to keep the window
+    assert transfer.size == 200
+    assert not transfer.can_resume(0)
+    assert transfer.can_resume(1)
+    assert transfer.can_resume(3)
+    assert not transfer.can_resume(4)
+    assert transfer.get(2) == b"x" * 100
+
+
+def test_not_resumable():
+    transfer = Transfer()
+    assert not transfer.resumable
+    assert transfer.add(b"chunk") == 0
+    assert transfer.size == 0
+    assert not transfer.can_resume(0)
+
+
+def test_close():
+    closed = []
+    transfer = Transfer(window=100)
+    transfer.start(iter(()), None, closed.append)
+    transfer.add(b"chunk")
+    transfer.finish()
+    assert closed == [True]
+    transfer.close()
+    assert closed == [True]
+    assert transfer.size == 0
+
+
+def test_cache():
+    cache = TransferCache(max_transfers=1, ttl=60)
+    transfer = Transfer(window=100)
+    transfer.lock.acquire()
+    cache.add(transfer)
+    # It is sent by another handler
+    assert cache.acquire(transfer.id, timeout=0) is None
+
+    cache.release(transfer)
+    assert cache.acquire(transfer.id, timeout=0) is transfer
+    cache.release(transfer, keep=False)
+    assert cache.acquire(transfer.id, timeout=0) is None
+    assert cache.stats()["kept"] == 0
+
+
+def test_cache_evicts_transfers():
+    cache = TransferCache(max_transfers=1, ttl=60)
+    first, second = Transfer(window=100), Transfer(window=100)
+    for transfer in (first, second):
+        transfer.lock.acquire()
+        cache.add(transfer)
+        cache.release(transfer)
+    assert cache.acquire(first.id, timeout=0) is None
+    assert cache.acquire(second.id, timeout=0) is second
+    cache.release(second, keep=False)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.scheduler`."""
+
+import itertools
+
+import pytest
+
+from stegoproxy.scheduler import ChunkScheduler
+
+
+def take(scheduler, n):
+    return list(itertools.islice(scheduler, n))
+
+
+def test_no_ramp():
+    assert take(ChunkScheduler(1000, policy="none"), 3) == [1000] * 3
+
+
+def test_exponential_ramp():
+    scheduler = ChunkScheduler(1000, start=100, factor=2)
+    assert take(scheduler, 6) == [100, 200, 400, 800, 1000, 1000]
+
+
+def test_linear_ramp():
+    scheduler = ChunkScheduler(1000, policy="linear", start=300, factor=1)
+    assert take(scheduler, 5) == [300, 600, 900, 1000, 1000]
+
+
+def test_start_is_capped():
+    assert take(ChunkScheduler(100, start=8192), 2) == [100, 100]
+
+
+@pytest.mark.parametrize(
+    "policy, factor", [("unknown", 2), ("exponential", 1), ("linear", 0)]
+)
+def test_invalid_ramp(policy, factor):
+    with pytest.raises(ValueError):
+        ChunkScheduler(1000, policy=policy, factor=factor)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.singleflight`."""
+
+import threading
+import time
+
+import pytest
+
+from stegoproxy.singleflight import Group, request_key
+
+
+def test_request_key():
+    headers = {"Host": "example.com", "Accept": "text/html"}
+    key = request_key("GET", "/", headers)
+    # Header order, whitespace and hop-by-hop headers don't matter
+    assert key == request_key(
+        "GET",
+        "/",
+        {"Accept": " text/html ", "Host": "example.com", "Keep-Alive": "5"},
+    )
+    assert key != request_key("HEAD", "/", headers)
+    assert key != request_key("GET", "/other", headers)
+
+
+def test_request_key_unsafe_requests():
+    assert request_key("POST", "/", {}) is None
+    assert request_key("GET", "/", {"Content-Length": "3"}) is None
+    assert request_key("GET", "/", {"Transfer-Encoding": "chunked"}) is None
+
+
+def test_single_call():
+    group = Group()
+    assert group.do("key", lambda: 42) == (42, False)
+    assert group.stats() == dict(in_flight=0, coalesced=0)
+
+
+def test_concurrent_calls_are_coalesced():
+    group = Group()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "result"
+
+    leader = threading.Thread(target=lambda: results.append(group.do(1, fn)))
+    leader.start()
+    started.wait()
+    waiter = threading.Thread(target=lambda: results.append(group.do(1, fn)))
+    waiter.start()
+    while group.stats()["coalesced"] == 0:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    waiter.join()
+
+    assert len(calls) == 1
+    assert sorted(results) == [("result", False), ("result", True)]
+
+
+def test_errors_are_raised():
+    group = Group()
+
+    def fn():
+        raise OSError("broken")
+
+    with pytest.raises(OSError):
+        group.do("key", fn)
+    assert group.stats()["in_flight"] == 0
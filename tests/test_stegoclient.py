@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.stegoclient`."""
+
+import socket
+import threading
+
+import pytest
+
+from stegoproxy.pool import ConnectionPool
+from stegoproxy.stegoclient import ClientProxyHandler
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+
+class StegoServer(object):
+    """Reads a stego-request from every connection and either answers it
+    or closes the connection, like a stegoserver that has closed an idle
+    connection just as the request arrived.
+    """
+
+    def __init__(self, actions):
+        self.actions = list(actions)
+        self.requests = []
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        t = threading.Thread(target=self._serve, daemon=True)
+        t.start()
+
+    def _serve(self):
+        while self.actions:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._handle,
+                args=(conn, self.actions.pop(0)),
+                daemon=True,
+            ).start()
+
+    def _handle(self, conn, action):
+        with conn:
+            data = b""
+            while b"\r\n\r\n" not in data:
+                data += conn.recv(65536)
+            if b"chunked" in data:
+                while not data.endswith(b"0\r\n\r\n"):
+                    data += conn.recv(65536)
+            self.requests.append(data)
+            if action == "respond":
+                conn.sendall(RESPONSE)
+                conn.recv(1)
+
+    def close(self):
+        self.sock.close()
+
+
+def make_handler(monkeypatch, server, command):
+    pool = ConnectionPool()
+    monkeypatch.setattr(ClientProxyHandler, "pool", pool)
+    handler = ClientProxyHandler.__new__(ClientProxyHandler)
+    handler.command = command
+    handler.hostname = "127.0.0.1"
+    handler.port = server.port
+    return handler
+
+
+def stale_connection(handler):
+    """Puts an idle connection into the pool that the stegoserver is going
+    to drop.
+    """
+    conn = handler.pool.acquire(handler.hostname, handler.port)
+    handler.pool.release(conn)
+
+
+def send(handler, stego_chunks=None, idempotent=None):
+    h = handler._send_to_stegoserver(
+        b"POST / HTTP/1.1\r\nContent-Length: 0\r\n\r\n",
+        stego_chunks,
+        idempotent=idempotent,
+    )
+    return h.read()
+
+
+@pytest.mark.parametrize(
+    "command, idempotent", [("GET", None), ("POST", True)]
+)
+def test_idempotent_request_is_sent_again(monkeypatch, command, idempotent):
+    server = StegoServer(["drop", "respond"])
+    handler = make_handler(monkeypatch, server, command)
+    stale_connection(handler)
+
+    assert send(handler, idempotent=idempotent) == b"ok"
+    assert len(server.requests) == 2
+    server.close()
+
+
+def test_non_idempotent_request_is_not_sent_again(monkeypatch):
+    server = StegoServer(["drop", "respond"])
+    handler = make_handler(monkeypatch, server, "POST")
+    stale_connection(handler)
+
+    with pytest.raises(ConnectionError):
+        send(handler)
+    assert len(server.requests) == 1
+    server.close()
+
+
+def test_chunked_request_is_not_sent_again(monkeypatch):
+    server = StegoServer(["drop", "respond"])
+    handler = make_handler(monkeypatch, server, "GET")
+    stale_connection(handler)
+
+    with pytest.raises(ConnectionError):
+        send(handler, stego_chunks=iter([b"chunk"]))
+    assert len(server.requests) == 1
+    server.close()
+
+
+def test_new_connection_is_not_retried(monkeypatch):
+    server = StegoServer(["drop", "respond"])
+    handler = make_handler(monkeypatch, server, "GET")
+
+    with pytest.raises(ConnectionError):
+        send(handler)
+    assert len(server.requests) == 1
+    server.close()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.transcode`."""
+
+import io
+import os
+from http.client import HTTPResponse
+
+import pytest
+from PIL import Image
+
+from stegoproxy.config import cfg
+from stegoproxy.stegoserver import ServerProxyHandler
+from stegoproxy.transcode import transcode
+
+
+def make_image(mode, size, format, **params):
+    # Noise doesn't compress, the images are as large as they get
+    image = Image.frombytes(
+        mode, size, os.urandom(size[0] * size[1] * len(mode))
+    )
+    output = io.BytesIO()
+    image.save(output, format=format, **params)
+    return output.getvalue()
+
+
+def test_jpeg_is_scaled_down():
+    body = make_image("RGB", (600, 400), "JPEG", quality=95)
+    data, content_type = transcode(body, 60, 300, 300)
+    assert content_type == "image/jpeg"
+    assert len(data) < len(body)
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.size == (300, 200)
+
+
+def test_png_with_alpha_keeps_transparency():
+    body = make_image("RGBA", (200, 200), "PNG")
+    data, content_type = transcode(body, 60, 1280, 1280)
+    assert content_type == "image/png"
+    assert len(data) < len(body)
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.mode == "P"
+
+
+def test_no_smaller_variant():
+    body = make_image("L", (4, 4), "PNG")
+    assert transcode(body, 95, 1280, 1280) is None
+
+
+def test_invalid_image():
+    assert transcode(b"not an image", 60, 1280, 1280) is None
+
+
+class FakeSocket(object):
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, mode):
+        return io.BytesIO(self.data)
+
+
+def fetch_image(body, request_headers=None):
+    """Runs an image response through the transcoding stage of the
+    stegoserver. Returns the headers and the body it sends on.
+    """
+    response = (
+        b"HTTP/1.1 200 OK\r\nContent-Type: image/jpeg\r\n"
+        b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+    )
+    h = HTTPResponse(FakeSocket(response), method="GET")
+    h.begin()
+    handler = ServerProxyHandler.__new__(ServerProxyHandler)
+    reader = handler._transcode(
+        "GET", "http://example.com/a.jpg", request_headers, h, h
+    )
+    return h.msg, reader.read()
+
+
+@pytest.fixture
+def transcoding(monkeypatch):
+    monkeypatch.setattr(cfg, "TRANSCODE", True)
+    monkeypatch.setattr(cfg, "TRANSCODE_MAX_WIDTH", 300)
+    monkeypatch.setattr(cfg, "TRANSCODE_MAX_HEIGHT", 300)
+
+
+def test_server_transcodes_large_images(transcoding):
+    body = make_image("RGB", (600, 400), "JPEG", quality=95)
+    assert len(body) >= cfg.TRANSCODE_MIN_SIZE
+    headers, data = fetch_image(body)
+    assert len(data) < len(body)
+    assert headers["Content-Length"] == str(len(data))
+    assert headers["Warning"] == '214 - "Transformation Applied"'
+
+
+def test_server_leaves_small_images_alone(transcoding):
+    body = make_image("RGB", (32, 32), "JPEG", quality=95)
+    assert len(body) < cfg.TRANSCODE_MIN_SIZE
+    headers, data = fetch_image(body)
+    assert data == body
+    assert "Warning" not in headers
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stegoproxy.tunnel`."""
+
+import queue
+import socket
+import threading
+
+import pytest
+
+from stegoproxy.exceptions import StreamReset, TunnelClosed
+from stegoproxy.framing import (
+    DATA,
+    RST_STREAM,
+    FrameParser,
+    data_frame,
+    rst_stream_frame,
+)
+from stegoproxy.tunnel import Session, splice
+
+REQUEST = b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n"
+
+
+class Loopback(object):
+    """Connects a client and a server session, the payloads one of them
+    sends are fed to the other one. The frames are recorded on the way.
+    """
+
+    def __init__(self, **kwargs):
+        self.accepted = queue.Queue()
+        self.payloads = []
+        self.client = Session(self._to_server, client=True, **kwargs)
+        self.server = Session(
+            self._to_client, client=False, accept=self.accepted.put, **kwargs
+        )
+        self._parser = FrameParser()
+
+    def _to_server(self, payload):
+        self.payloads.append(self._parser.feed(payload))
+        self.server.feed(payload)
+
+    def _to_client(self, payload):
+        self.client.feed(payload)
+
+    def start(self):
+        self.client.start()
+        self.server.start()
+
+    def close(self):
+        self.client.close()
+        self.server.close()
+        self.client.join(1)
+        self.server.join(1)
+
+
+@pytest.fixture
+def loopback():
+    loopback = Loopback(max_payload=4096, max_frame=1024, window=16384)
+    loopback.start()
+    yield loopback
+    loopback.close()
+
+
+def read_all(stream):
+    return b"".join(stream)
+
+
+def test_request_and_response(loopback):
+    stream = loopback.client.open_stream()
+    stream.write_head(REQUEST)
+    stream.close()
+
+    peer = loopback.accepted.get(timeout=1)
+    assert peer.id == stream.id
+    assert read_all(peer) == REQUEST
+    peer.write_head(b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\n")
+    peer.write(b"body")
+    peer.close()
+
+    assert read_all(stream) == (
+        b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbody"
+    )
+
+
+def test_streams_are_interleaved(loopback):
+    first = loopback.client.open_stream()
+    second = loopback.client.open_stream()
+    for stream, byte in ((first, b"a"), (second, b"b")):
+        stream.write(byte * 10000)
+        stream.close()
+
+    peers = {}
+    for _ in range(2):
+        peer = loopback.accepted.get(timeout=1)
+        peers[peer.id] = peer
+    assert read_all(peers[first.id]) == b"a" * 10000
+    assert read_all(peers[second.id]) == b"b" * 10000
+
+    # Both streams share the payloads instead of being sent one by one
+    mixed = [
+        frames
+        for frames in loopback.payloads
+        if {f.stream_id for f in frames if f.type == DATA}
+        == {first.id, second.id}
+    ]
+    assert len(mixed) > 1
+
+
+def test_writer_waits_for_window_update(loopback):
+    window = loopback.client.window
+    stream = loopback.client.open_stream()
+    written = threading.Event()
+
+    def write():
+        # One window is sent, one is buffered and the rest has to wait
+        stream.write(b"x" * (window * 2 + 1))
+        written.set()
+
+    threading.Thread(target=write, daemon=True).start()
+    peer = loopback.accepted.get(timeout=1)
+    assert not written.wait(0.2)
+    assert stream.send_window == 0
+
+    received = 0
+    while received < window:
+        received += len(peer.read())
+    assert written.wait(1)
+    stream.close()
+    assert received + len(read_all(peer)) == window * 2 + 1
+
+
+def test_stream_exceeding_its_window():
+    sent = []
+    session = Session(sent.append, 4096, client=False, window=100)
+    session.start()
+    session.feed(data_frame(1, b"x" * 100))
+    session.feed(data_frame(1, b"y"))
+    session.close()
+    session.join(1)
+
+    assert session.active_streams == 0
+    assert rst_stream_frame(1) in b"".join(sent)
+
+
+def test_reset_while_head_is_pending():
+    loopback = Loopback(max_payload=4096)
+    stream = loopback.client.open_stream()
+    stream.write_head(REQUEST)
+    stream.reset()
+    with pytest.raises(StreamReset):
+        stream.write(b"data")
+    # The head is still sent so that the peer's header table stays the
+    # same, the reset follows it
+    loopback.start()
+    try:
+        peer = loopback.accepted.get(timeout=1)
+        with pytest.raises(StreamReset):
+            read_all(peer)
+        frames = [f for frames in loopback.payloads for f in frames]
+        assert frames[-1].type == RST_STREAM
+
+        other = loopback.client.open_stream()
+        other.write_head(REQUEST)
+        other.close()
+        assert read_all(loopback.accepted.get(timeout=1)) == REQUEST
+    finally:
+        loopback.close()
+
+
+def test_idle_session_is_closed():
+    closed = threading.Event()
+    session = Session(
+        lambda payload: None, 4096, idle_timeout=0.1, on_close=closed.set
+    )
+    stream = session.open_stream()
+    session.start()
+    # A session with a stream isn't idle
+    assert not closed.wait(0.2)
+
+    stream.reset()
+    assert closed.wait(1)
+    session.join(1)
+    assert session.closed
+    with pytest.raises(TunnelClosed):
+        session.open_stream()
+
+
+def test_close_resets_streams(loopback):
+    stream = loopback.client.open_stream()
+    loopback.client.close()
+    with pytest.raises(TunnelClosed):
+        stream.write(b"data")
+
+
+def test_splice(loopback):
+    browser, proxy = socket.socketpair()
+    stream = loopback.client.open_stream()
+    t = threading.Thread(target=splice, args=(proxy, stream), daemon=True)
+    t.start()
+
+    browser.sendall(b"ping")
+    browser.shutdown(socket.SHUT_WR)
+    peer = loopback.accepted.get(timeout=1)
+    assert read_all(peer) == b"ping"
+    peer.write(b"pong")
+    peer.close()
+
+    assert browser.makefile("rb").read() == b"pong"
+    t.join(1)
+    assert not t.is_alive()
+    browser.close()
+    proxy.close()